@@ -1,5 +1,54 @@
 from ceilometer_local_lib import PoolConnection
 import datetime
+import time
+
+CHUNK_SIZE = 10000
+CHUNK_SLEEP = 0.1
+
+# Note: tables referencing dimension rows, samples are deleted already.
+REFERENCES = (
+    ('resources', (('samples', 'resource_id'),)),
+    ('meters', (('samples', 'meter_id'),)),
+    ('users', (('resources', 'user_id'), ('samples', 'user_id'))),
+    ('projects', (('resources', 'project_id'), ('samples', 'project_id'))),
+)
+
+
+def delete_expired_samples(date):
+    """Delete samples older than date in chunks of id ranges.
+
+    Every chunk is committed on its own, so writers wait for one chunk
+    at most.
+    """
+    with PoolConnection() as cur:
+        cur.execute("SELECT min(id), max(id) FROM samples"
+                    " WHERE timestamp < %s", (date,))
+        first, last = cur.fetchone()
+    if first is None:
+        return 0
+    deleted = 0
+    for start in range(first, last + 1, CHUNK_SIZE):
+        with PoolConnection() as cur:
+            cur.execute("DELETE FROM samples"
+                        " WHERE id >= %s AND id < %s AND timestamp < %s",
+                        (start, start + CHUNK_SIZE, date))
+            deleted += cur.rowcount
+        print 'Deleted %d samples, %.0f%% done' % (
+            deleted, 100.0 * (start + CHUNK_SIZE - first) / (last + 1 - first))
+        time.sleep(CHUNK_SLEEP)
+    return deleted
+
+
+def delete_unreferenced_dimensions():
+    """Delete resources, meters, users and projects without references."""
+    for table, references in REFERENCES:
+        conditions = ["NOT EXISTS (SELECT 1 FROM {0} WHERE {0}.{1} = {2}.id)"
+                      .format(ref_table, ref_column, table)
+                      for ref_table, ref_column in references]
+        with PoolConnection() as cur:
+            cur.execute("DELETE FROM {0} WHERE {1}".format(
+                table, " AND ".join(conditions)))
+            print 'Deleted %d unreferenced rows of %s' % (cur.rowcount, table)
 
 
 def clear_expired_metering_data(ttl):
@@ -10,9 +59,7 @@ def clear_expired_metering_data(ttl):
     """
     date = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
     print date
-    query = "DELETE FROM samples WHERE samples.timestamp < %s;"
-    with PoolConnection() as cur:
-        cur.execute(query, [date])
-    # TODO Remove Meter definitions with no matching samples
+    delete_expired_samples(date)
+    delete_unreferenced_dimensions()
 
 clear_expired_metering_data(360)
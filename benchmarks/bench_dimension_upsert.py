@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Throughput of concurrent writers creating dimension rows.
+
+Compares the former select / insert in a subtransaction / catch
+UniqueViolation upsert on a table without unique constraint against a
+single INSERT ... ON CONFLICT DO UPDATE ... RETURNING id backed by a
+unique index. Scratch tables are created and dropped by the benchmark:
+
+    python benchmarks/bench_dimension_upsert.py "dbname=ceilometer" \\
+        --writers 8 --operations 5000 --keys 2000
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import random
+import time
+
+import psycopg2
+
+SETUP = {
+    'legacy': ("CREATE TABLE bench_meters_legacy ("
+               " id bigserial PRIMARY KEY, name text, type text, unit text)"),
+    'on_conflict': ("CREATE TABLE bench_meters_on_conflict ("
+                    " id bigserial PRIMARY KEY, name text, type text,"
+                    " unit text);"
+                    "CREATE UNIQUE INDEX ON bench_meters_on_conflict"
+                    " (name, type, unit)"),
+}
+
+
+def legacy_upsert(cur, key):
+    select = ("SELECT id FROM bench_meters_legacy"
+              " WHERE name = %s AND type = %s AND unit = %s")
+    cur.execute(select, key)
+    res = cur.fetchone()
+    if res:
+        return res[0]
+    cur.execute('SAVEPOINT upsert')
+    try:
+        cur.execute("INSERT INTO bench_meters_legacy (name, type, unit)"
+                    " VALUES (%s, %s, %s) RETURNING id", key)
+    except psycopg2.IntegrityError:
+        cur.execute('ROLLBACK TO SAVEPOINT upsert')
+        cur.execute(select, key)
+    else:
+        cur.execute('RELEASE SAVEPOINT upsert')
+    return cur.fetchone()[0]
+
+
+def on_conflict_upsert(cur, key):
+    cur.execute("SELECT id FROM bench_meters_on_conflict"
+                " WHERE name = %s AND type = %s AND unit = %s", key)
+    res = cur.fetchone()
+    if not res:
+        cur.execute("INSERT INTO bench_meters_on_conflict (name, type, unit)"
+                    " VALUES (%s, %s, %s)"
+                    " ON CONFLICT (name, type, unit) DO UPDATE"
+                    " SET name = EXCLUDED.name RETURNING id", key)
+        res = cur.fetchone()
+    return res[0]
+
+
+UPSERTS = {
+    'legacy': legacy_upsert,
+    'on_conflict': on_conflict_upsert,
+}
+
+
+def writer(args):
+    dsn, mode, operations, keys, seed = args
+    rnd = random.Random(seed)
+    con = psycopg2.connect(dsn)
+    cur = con.cursor()
+    for _ in range(operations):
+        UPSERTS[mode](cur, ('meter-%d' % rnd.randrange(keys), 'gauge', 'B'))
+        con.commit()
+    con.close()
+
+
+def run(dsn, mode, writers, operations, keys):
+    table = 'bench_meters_%s' % mode
+    con = psycopg2.connect(dsn)
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS %s' % table)
+    cur.execute(SETUP[mode])
+    con.commit()
+
+    pool = multiprocessing.Pool(writers)
+    started = time.time()
+    pool.map(writer, [(dsn, mode, operations, keys, n)
+                      for n in range(writers)])
+    elapsed = time.time() - started
+    pool.close()
+
+    cur.execute('SELECT count(*), count(DISTINCT name) FROM %s' % table)
+    rows, distinct = cur.fetchone()
+    cur.execute('DROP TABLE %s' % table)
+    con.commit()
+    con.close()
+    print('%-12s %10.0f upserts/sec %8d rows for %d distinct keys'
+          % (mode, writers * operations / elapsed, rows, distinct))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dsn', help='libpq connection string')
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=5000,
+                        help='upserts done by every writer')
+    parser.add_argument('--keys', type=int, default=2000,
+                        help='number of distinct dimension keys')
+    args = parser.parse_args()
+    for mode in ('legacy', 'on_conflict'):
+        run(args.dsn, mode, args.writers, args.operations, args.keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Latency of listing resources by scanning samples and from the summary.
+
+Without a time window get_resources reads resource_summary, which the
+trigger on samples keeps up to date, instead of grouping every sample of
+the matching resources. Run it against a database upgraded by the driver
+and loaded with samples, optionally narrowed to one project:
+
+    python benchmarks/bench_get_resources.py "dbname=ceilometer" \\
+        --project 2f5a4a5e-0cb4-4a04-a0a3-6b4c2c1f0e11 --repeat 5
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import psycopg2
+
+SCAN = ("SELECT resource_id, source_id, user_id, project_id,"
+        " max(timestamp) as max_ts, min(timestamp) as min_ts,"
+        " LAST(metadata_id) as metadata_id"
+        " FROM samples{where}"
+        " GROUP BY resource_id, source_id, user_id, project_id")
+SUMMARY = ("SELECT resource_id, source_id, user_id, project_id,"
+           " last_timestamp as max_ts, first_timestamp as min_ts,"
+           " metadata_id FROM resource_summary{where}")
+QUERY = ("SELECT resources.resource_id, projects.uuid, sources.name,"
+         " s.min_ts, s.max_ts, users.uuid, sample_metadata.metadata"
+         " FROM ({subq}) as s"
+         " JOIN resources ON resources.id = s.resource_id"
+         " JOIN projects ON projects.id = s.project_id"
+         " JOIN sources ON sources.id = s.source_id"
+         " LEFT JOIN users ON users.id = s.user_id"
+         " LEFT JOIN sample_metadata ON sample_metadata.id = s.metadata_id")
+
+MODES = (('scan', SCAN), ('summary', SUMMARY))
+
+
+def run(cur, subq, values, repeat):
+    latencies = []
+    for _i in range(repeat):
+        started = time.time()
+        cur.execute(QUERY.format(subq=subq), values)
+        rows = len(cur.fetchall())
+        latencies.append(time.time() - started)
+    latencies.sort()
+    return rows, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dsn', help='libpq connection string')
+    parser.add_argument('--project', help='list resources of this project')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='executions of every query')
+    args = parser.parse_args()
+
+    con = psycopg2.connect(args.dsn)
+    cur = con.cursor()
+    cur.execute('SELECT count(*) FROM samples')
+    print('%d samples' % cur.fetchone()[0])
+    where, values = '', ()
+    if args.project:
+        where = (" WHERE project_id IN"
+                 " (SELECT id FROM projects WHERE uuid = %s)")
+        values = (args.project,)
+    for mode, subq in MODES:
+        rows, latencies = run(cur, subq.format(where=where), values,
+                              args.repeat)
+        print('%-8s %7d resources   median %9.1f ms   max %9.1f ms'
+              % (mode, rows, latencies[len(latencies) // 2] * 1e3,
+                 latencies[-1] * 1e3))
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""CPU spent per sample by the json and typed ingest modes.
+
+The json mode dumps the whole sample and passes it to the write_sample
+server function, which parses it again and dumps the metadata once more.
+The typed mode executes a prepared INSERT with typed parameters. Dimension
+and metadata ids are resolved through a client side cache in both modes,
+as the driver does. Run it against a scratch database
+upgraded by the driver with maelnor.py loaded:
+
+    python benchmarks/bench_ingest_modes.py "dbname=ceilometer" \\
+        --samples 20000
+
+Server CPU is read from /proc of the backend process, so it is only
+reported when the benchmark runs on the database host.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import uuid
+
+import psycopg2
+
+PROJECT = '2f5a4a5e-0cb4-4a04-a0a3-6b4c2c1f0e11'
+DIMENSIONS = (
+    ('source_id', "INSERT INTO sources (name) VALUES ('bench')"
+                  " ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name"
+                  " RETURNING id"),
+    ('project_id', "INSERT INTO projects (uuid, source_id)"
+                   " VALUES (%(project)s, %(source_id)s)"
+                   " ON CONFLICT (uuid, source_id) DO UPDATE"
+                   " SET uuid = EXCLUDED.uuid RETURNING id"),
+    ('resource_id', "INSERT INTO resources"
+                    " (resource_id, project_id, source_id)"
+                    " VALUES ('bench-resource', %(project_id)s, %(source_id)s)"
+                    " ON CONFLICT (resource_id, (COALESCE(user_id, 0)),"
+                    " project_id, source_id) DO UPDATE"
+                    " SET resource_id = EXCLUDED.resource_id RETURNING id"),
+    ('meter_id', "INSERT INTO meters (name, type, unit)"
+                 " VALUES ('bench.meter', 'gauge', 'B')"
+                 " ON CONFLICT (name, type, unit) DO UPDATE"
+                 " SET name = EXCLUDED.name RETURNING id"),
+)
+
+METADATA = ("INSERT INTO sample_metadata (hash, metadata)"
+            " SELECT md5(m::text)::uuid, m FROM (SELECT %s::jsonb as m) as v"
+            " ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash"
+            " RETURNING id")
+INSERT_TYPES = ('bigint, bigint, bigint, bigint, timestamp, text, text,'
+                ' double precision, bigint')
+INSERT = ("INSERT INTO samples (project_id, resource_id, meter_id,"
+          " source_id, timestamp, message_id, message_signature,"
+          " recorded_at, volume, metadata_id)"
+          " VALUES ($1, $2, $3, $4, $5, $6, $7, now(), $8, $9)"
+          " ON CONFLICT DO NOTHING")
+
+
+def dthandler(obj):
+    return obj.isoformat() if isinstance(obj, datetime.datetime) else None
+
+
+def make_sample(n):
+    return {'source': 'bench',
+            'user_id': None,
+            'project_id': PROJECT,
+            'resource_id': 'bench-resource',
+            'counter_name': 'bench.meter',
+            'counter_type': 'gauge',
+            'counter_unit': 'B',
+            'counter_volume': float(n),
+            'timestamp': datetime.datetime.utcnow(),
+            'message_id': 'bench-%s' % uuid.uuid4(),
+            'message_signature': uuid.uuid4().hex,
+            'resource_metadata': {'name': 'bench-%d' % (n % 100),
+                                  'flavor': {'id': 1, 'ram': 512,
+                                             'vcpus': 1, 'disk': 1},
+                                  'state': 'active',
+                                  'image_ref': str(uuid.UUID(int=n % 100)),
+                                  'properties': {'a': 'b' * 64}}}
+
+
+def metadata_id(cur, cache, metadata):
+    metadata = json.dumps(metadata, sort_keys=True, separators=(',', ':'),
+                          default=dthandler)
+    key = hashlib.md5(metadata.encode('utf-8')).hexdigest()
+    if key not in cache:
+        cur.execute(METADATA, (metadata,))
+        cache[key] = cur.fetchone()[0]
+    return cache[key]
+
+
+def write_json(cur, sample, ids, cache):
+    ids = dict(ids, metadata_id=metadata_id(cur, cache,
+                                            sample['resource_metadata']))
+    cur.execute('SELECT write_sample(%s)',
+                (json.dumps(dict(sample, dimension_ids=ids),
+                            ensure_ascii=False, default=dthandler),))
+
+
+def write_typed(cur, sample, ids, cache):
+    cur.execute('EXECUTE bench_insert (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
+                (ids['project_id'], ids['resource_id'], ids['meter_id'],
+                 ids['source_id'], sample['timestamp'], sample['message_id'],
+                 sample['message_signature'], sample['counter_volume'],
+                 metadata_id(cur, cache, sample['resource_metadata'])))
+
+
+MODES = (('json', write_json), ('typed', write_typed))
+
+
+def backend_cpu(pid):
+    """User and system CPU seconds of a local backend, or None."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    return ((int(fields[11]) + int(fields[12])) /
+            float(os.sysconf('SC_CLK_TCK')))
+
+
+def client_cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run(cur, con, mode, write, ids, samples, commit_every):
+    cur.execute('SELECT pg_backend_pid()')
+    pid = cur.fetchone()[0]
+    batch = [make_sample(n) for n in range(samples)]
+    cache = {}
+    client_started, server_started = client_cpu(), backend_cpu(pid)
+    for n, sample in enumerate(batch, 1):
+        write(cur, sample, ids, cache)
+        if not n % commit_every:
+            con.commit()
+    con.commit()
+    client = client_cpu() - client_started
+    line = '%-6s client %7.1f us/sample' % (mode, client / samples * 1e6)
+    if server_started is not None:
+        server = backend_cpu(pid) - server_started
+        line += '   server %7.1f us/sample' % (server / samples * 1e6)
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dsn', help='libpq connection string')
+    parser.add_argument('--samples', type=int, default=20000,
+                        help='samples written in every mode')
+    parser.add_argument('--commit-every', type=int, default=100,
+                        help='samples written per transaction')
+    args = parser.parse_args()
+
+    con = psycopg2.connect(args.dsn)
+    cur = con.cursor()
+    ids = {}
+    for name, statement in DIMENSIONS:
+        cur.execute(statement, dict(ids, project=PROJECT))
+        ids[name] = cur.fetchone()[0]
+    cur.execute('PREPARE bench_insert (%s) AS %s' % (INSERT_TYPES, INSERT))
+    con.commit()
+    for mode, write in MODES:
+        run(cur, con, mode, write, ids, args.samples, args.commit_every)
+    cur.execute("DELETE FROM samples WHERE message_id LIKE 'bench-%'")
+    con.commit()
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
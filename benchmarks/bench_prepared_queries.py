@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Planning time saved by executing read queries as prepared templates.
+
+The driver prepares every query shape once per connection and EXECUTEs
+it afterwards. This compares the statistics query the driver builds for
+a meter, sent as text, with the same query run through QueryTemplates,
+by the planning time EXPLAIN ANALYZE reports and by the latency seen by
+the client. Run it where the driver is importable, against a database
+upgraded by the driver and loaded with samples of the meter:
+
+    python benchmarks/bench_prepared_queries.py "dbname=ceilometer" \\
+        --meter cpu_util --hours 24 --repeat 50
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import time
+
+import psycopg2
+
+from ceilometer import storage
+from ceilometer.storage.postgresql import impl_postgresql
+import ceilometer.storage.postgresql.utils as psql_utils
+
+
+def explain(cur, query, values):
+    """Return planning and execution times in ms of a query."""
+    cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, values)
+    plan = cur.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time'], plan[0]['Execution Time']
+
+
+def latency(cur, execute, query, values):
+    started = time.time()
+    execute(cur, query, values)
+    cur.fetchall()
+    return (time.time() - started) * 1e3
+
+
+def text(cur, query, values):
+    cur.execute(query, values)
+
+
+def report(mode, times):
+    times = sorted(times)
+    print('%-9s median %8.3f ms   max %8.3f ms'
+          % (mode, times[len(times) // 2], times[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dsn', help='libpq connection string')
+    parser.add_argument('--meter', required=True,
+                        help='meter the statistics are computed of')
+    parser.add_argument('--hours', type=int, default=24,
+                        help='time window ending now')
+    parser.add_argument('--period', type=int, default=3600,
+                        help='statistics period in seconds')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='executions of every query')
+    args = parser.parse_args()
+
+    con = psycopg2.connect(args.dsn)
+    con.autocommit = True
+    cur = con.cursor()
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(hours=args.hours)
+    sample_filter = storage.SampleFilter(meter=args.meter, start=start,
+                                         end=end)
+    templates = psql_utils.QueryTemplates(16)
+    resolver = psql_utils.DimensionResolver(16, 3600)
+
+    # NOTE: the first query resolves the meter into its id, as the driver
+    # does, the query built afterwards is the one it keeps sending.
+    query, values = impl_postgresql.Connection._stats_query(
+        sample_filter, None, None, args.period, start, end, resolver)
+    templates.execute(cur, query, values)
+    cur.fetchall()
+    resolver.resolve_pending(cur)
+    query, values = impl_postgresql.Connection._stats_query(
+        sample_filter, None, None, args.period, start, end, resolver)
+    templates.execute(cur, query, values)
+    cur.fetchall()
+    template = templates.get(query)
+    if not template or not templates.executes:
+        raise SystemExit('The statistics query is not run as a template')
+    execute = 'EXECUTE {0} ({1})'.format(
+        template.name, ', '.join(['%s'] * template.params))
+
+    planning = {'text': [], 'prepared': []}
+    latencies = {'text': [], 'prepared': []}
+    for _i in range(args.repeat):
+        planning['text'].append(explain(cur, query, values)[0])
+        planning['prepared'].append(explain(cur, execute, values)[0])
+        latencies['text'].append(latency(cur, text, query, values))
+        latencies['prepared'].append(
+            latency(cur, templates.execute, query, values))
+
+    print('Planning time per call')
+    for mode in ('text', 'prepared'):
+        report(mode, planning[mode])
+    print('Latency per call')
+    for mode in ('text', 'prepared'):
+        report(mode, latencies[mode])
+    saved = (sum(planning['text']) - sum(planning['prepared'])) / args.repeat
+    print('Planning time saved per call %.3f ms' % saved)
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,8 +24,16 @@ from eventlet.support.psycopg2_patcher import make_psycopg_green
 make_psycopg_green()
 
 import psycopg2
+import atexit
+import copy
+import hashlib
 import json
+import math
 import datetime
+import re
+import time
+
+import six
 
 from urlparse import urlparse
 
@@ -42,8 +50,135 @@ from oslo.config import cfg
 
 import ceilometer.storage.postgresql.utils as psql_utils
 from ceilometer.storage.postgresql.utils import PoolConnection
+from ceilometer.storage.postgresql import write_buffer
 LOG = log.getLogger(__name__)
 
+# NOTE: lengths of the samples partitions, weekly ones start on Monday.
+PARTITION_INTERVALS = {
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(days=7),
+}
+
+OPTS = [
+    cfg.IntOpt('dimension_cache_size',
+               default=10000,
+               help='Number of source, user, project, resource and meter ids '
+                    'cached by the driver to skip their lookups on write, '
+                    '0 disables the cache.'),
+    cfg.BoolOpt('write_behind',
+                default=False,
+                help='Queue samples in memory and write them in batches '
+                     'from a background green thread.'),
+    cfg.IntOpt('write_behind_buffer_size',
+               default=10000,
+               help='Maximum number of samples queued for writing.'),
+    cfg.IntOpt('write_behind_batch_size',
+               default=500,
+               help='Number of queued samples which triggers a write.'),
+    cfg.FloatOpt('write_behind_max_age',
+                 default=1.0,
+                 help='Age in seconds of the oldest queued sample which '
+                      'triggers a write.'),
+    cfg.StrOpt('write_behind_overflow',
+               default='block',
+               choices=write_buffer.OVERFLOW_POLICIES,
+               help='What to do with a new sample when the buffer is full: '
+                    'block the caller, drop the oldest queued sample or '
+                    'raise an error.'),
+    cfg.IntOpt('prebill_batch_size',
+               default=10000,
+               help='Number of samples accumulated into prebill per '
+                    'transaction.'),
+    cfg.IntOpt('prebill_settle_time',
+               default=60,
+               help='Age in seconds a sample must reach before it is '
+                    'accumulated into prebill.'),
+    cfg.IntOpt('rollup_batch_size',
+               default=100000,
+               help='Number of samples merged into the statistics rollups '
+                    'per transaction.'),
+    cfg.IntOpt('rollup_settle_time',
+               default=60,
+               help='Age in seconds a sample must reach before it is '
+                    'merged into the statistics rollups.'),
+    cfg.IntOpt('metadata_cache_size',
+               default=1000,
+               help='Number of resource metadata ids cached by the driver '
+                    'by the hash of the metadata, 0 disables the cache.'),
+    cfg.StrOpt('ingest_mode',
+               default='json',
+               choices=('json', 'typed'),
+               help='How record_metering_data writes a sample: json passes '
+                    'the whole sample to the write_sample server function, '
+                    'typed executes a prepared INSERT with typed parameters.'),
+    cfg.BoolOpt('stream_results',
+                default=False,
+                help='Read samples, resources and meters through server-side '
+                     'cursors instead of fetching whole results at once.'),
+    cfg.IntOpt('stream_itersize',
+               default=1000,
+               help='Number of rows fetched at a time from a server-side '
+                    'cursor.'),
+    cfg.IntOpt('recent_messages_size',
+               default=100000,
+               help='Number of recently written message ids remembered to '
+                    'drop redelivered samples before they reach the '
+                    'database, 0 disables it.'),
+    cfg.IntOpt('expiry_chunk_size',
+               default=10000,
+               help='Maximum number of expired samples deleted per '
+                    'transaction.'),
+    cfg.FloatOpt('expiry_chunk_sleep',
+                 default=0.1,
+                 help='Seconds to sleep between two chunks of expired '
+                      'samples, giving way to writes.'),
+    cfg.FloatOpt('expiry_chunk_time',
+                 default=0.5,
+                 help='Time budget in seconds of a chunk of expired samples. '
+                      'Chunks are shrunk when they take longer, so that '
+                      'writes waiting on them are delayed at most that '
+                      'long.'),
+    cfg.StrOpt('samples_partition_interval',
+               choices=tuple(PARTITION_INTERVALS),
+               help='Partition samples by timestamp into daily or weekly '
+                    'partitions, expired partitions are dropped as a '
+                    'whole. Unset keeps samples in a single table.'),
+    cfg.IntOpt('samples_partitions_ahead',
+               default=7,
+               help='Number of future samples partitions kept created.'),
+    cfg.IntOpt('stats_cache_memory',
+               default=64,
+               help='Megabytes of memory used to cache statistics of closed '
+                    'periods, 0 disables the cache.'),
+    cfg.IntOpt('stats_cache_settle_time',
+               default=600,
+               help='Age in seconds the end of a period must reach before '
+                    'its statistics are cached. Samples arriving later are '
+                    'taken into account once the cache is invalidated, '
+                    'as writes of such samples do.'),
+    cfg.IntOpt('query_templates',
+               default=256,
+               help='Number of read query templates kept compiled, and of '
+                    'statements prepared on every connection. 0 disables '
+                    'prepared read queries.'),
+    cfg.IntOpt('dimension_resolver_size',
+               default=10000,
+               help='Number of external ids of resources, users, projects, '
+                    'sources and meters kept resolved into their internal '
+                    'ids for read queries.'),
+    cfg.IntOpt('dimension_resolver_ttl',
+               default=60,
+               help='Seconds an external id stays resolved, or unknown, for '
+                    'read queries.'),
+    cfg.IntOpt('migration_lock_timeout',
+               default=5,
+               help='Seconds an upgrade waits for the short exclusive lock '
+                    'of samples it needs to change their table, before '
+                    'giving up to be run again.'),
+]
+
+cfg.CONF.register_opts(OPTS, group='database')
+
 
 AVAILABLE_CAPABILITIES = {
     'meters': {'query': {'simple': True,
@@ -76,6 +211,10 @@ AVAILABLE_STORAGE_CAPABILITIES = {
 }
 
 
+def dthandler(obj):
+    return obj.isoformat() if isinstance(obj, datetime.datetime) else None
+
+
 def make_list(resp):
     result = []
     for r in resp:
@@ -90,6 +229,421 @@ STANDARD_AGGREGATES = dict(
     max='max(samples.volume)',
     count='count(samples.volume)'
 )
+# NOTE: bucket sizes in seconds of the statistics rollup tables, coarsest
+# first. rollup_<size> holds the samples up to the 'rollup' watermark
+# aggregated per meter, resource and bucket, the bucket start being stored
+# as timestamp.
+ROLLUP_SIZES = (86400, 3600, 60)
+# NOTE: partial statistics of samples and rollups merged by the statistics
+# query built from the rollups.
+ROLLUP_PARTIALS = {
+    'samples': ("min(samples.timestamp) as tsmin,"
+                " max(samples.timestamp) as tsmax, meters.unit as unit,"
+                " count(samples.volume) as count, sum(samples.volume) as sum,"
+                " min(samples.volume) as min, max(samples.volume) as max"),
+    'rollup': ("min(samples.first_timestamp) as tsmin,"
+               " max(samples.last_timestamp) as tsmax, meters.unit as unit,"
+               " sum(samples.volume_count) as count,"
+               " sum(samples.volume_sum) as sum,"
+               " min(samples.volume_min) as min,"
+               " max(samples.volume_max) as max"),
+}
+ROLLUP_AGGREGATES = dict(
+    avg='sum(sum) / nullif(sum(count), 0) as avg',
+    sum='sum(sum) as sum',
+    min='min(min) as min',
+    max='max(max) as max',
+    count='sum(count)::bigint as count'
+)
+# NOTE: joins of the dimension tables to samples, users are optional.
+DIMENSION_JOINS = {
+    'meters': " JOIN meters ON samples.meter_id = meters.id",
+    'resources': " JOIN resources ON samples.resource_id = resources.id",
+    'sources': " JOIN sources ON samples.source_id = sources.id",
+    'projects': " JOIN projects ON samples.project_id = projects.id",
+    'users': " LEFT JOIN users ON samples.user_id = users.id",
+}
+# NOTE: columns of samples read before the dimensions are joined.
+SAMPLE_COLUMNS = ("samples.id, samples.meter_id, samples.resource_id,"
+                  " samples.source_id, samples.user_id, samples.project_id,"
+                  " samples.volume, samples.timestamp, samples.recorded_at,"
+                  " samples.message_id, samples.message_signature,"
+                  " samples.metadata_id")
+SAMPLE_JOINS = ''.join(DIMENSION_JOINS[t] for t in
+                       ('meters', 'users', 'projects', 'resources',
+                        'sources')) + (" LEFT JOIN sample_metadata"
+                                       " ON samples.metadata_id ="
+                                       " sample_metadata.id")
+# NOTE: ids every sample is written with, samples with a user need its id
+# too.
+SAMPLE_DIMENSION_IDS = frozenset(['source_id', 'project_id', 'resource_id',
+                                  'meter_id', 'metadata_id'])
+# NOTE: (select, insert) statements for dimensions missed by the cache.
+DIMENSION_UPSERTS = {
+    'source_id': ("SELECT id FROM sources WHERE name = %s",
+                  "INSERT INTO sources (name) VALUES (%s)"
+                  " ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name"
+                  " RETURNING id"),
+    'user_id': ("SELECT id FROM users WHERE uuid = %s AND source_id = %s",
+                "INSERT INTO users (uuid, source_id) VALUES (%s, %s)"
+                " ON CONFLICT (uuid, source_id) DO UPDATE"
+                " SET uuid = EXCLUDED.uuid RETURNING id"),
+    'project_id': ("SELECT id FROM projects"
+                   " WHERE uuid = %s AND source_id = %s",
+                   "INSERT INTO projects (uuid, source_id) VALUES (%s, %s)"
+                   " ON CONFLICT (uuid, source_id) DO UPDATE"
+                   " SET uuid = EXCLUDED.uuid RETURNING id"),
+    'resource_id': ("SELECT id FROM resources WHERE resource_id = %s"
+                    " AND user_id = %s AND project_id = %s"
+                    " AND source_id = %s",
+                    "INSERT INTO resources (resource_id, user_id, project_id,"
+                    " source_id) VALUES (%s, %s, %s, %s)"
+                    " ON CONFLICT (resource_id, (COALESCE(user_id, 0)),"
+                    " project_id, source_id) DO UPDATE"
+                    " SET resource_id = EXCLUDED.resource_id RETURNING id"),
+    'resource_id_without_user': ("SELECT id FROM resources"
+                                 " WHERE resource_id = %s AND user_id IS NULL"
+                                 " AND project_id = %s AND source_id = %s",
+                                 "INSERT INTO resources (resource_id,"
+                                 " project_id, source_id) VALUES (%s, %s, %s)"
+                                 " ON CONFLICT (resource_id,"
+                                 " (COALESCE(user_id, 0)), project_id,"
+                                 " source_id) DO UPDATE"
+                                 " SET resource_id = EXCLUDED.resource_id"
+                                 " RETURNING id"),
+    'meter_id': ("SELECT id FROM meters"
+                 " WHERE name = %s AND type = %s AND unit = %s",
+                 "INSERT INTO meters (name, type, unit) VALUES (%s, %s, %s)"
+                 " ON CONFLICT (name, type, unit) DO UPDATE"
+                 " SET name = EXCLUDED.name RETURNING id"),
+    'metadata_id': ("SELECT id FROM sample_metadata"
+                    " WHERE hash = md5(%s::jsonb::text)::uuid",
+                    "INSERT INTO sample_metadata (hash, metadata)"
+                    " SELECT md5(m::text)::uuid, m"
+                    " FROM (SELECT %s::jsonb as m) as v"
+                    " ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash"
+                    " RETURNING id"),
+}
+
+# NOTE: dimension tables with their natural keys and the columns referencing
+# them, in the order their duplicates have to be merged.
+DIMENSION_REFERENCES = (
+    ('sources', 'name',
+     (('users', 'source_id'), ('projects', 'source_id'),
+      ('resources', 'source_id'), ('samples', 'source_id'))),
+    ('users', 'uuid, source_id',
+     (('resources', 'user_id'), ('samples', 'user_id'),
+      ('alarm', 'user_id'), ('alarm_change', 'user_id'))),
+    ('projects', 'uuid, source_id',
+     (('resources', 'project_id'), ('samples', 'project_id'),
+      ('alarm', 'project_id'), ('alarm_change', 'project_id'),
+      ('alarm_change', 'on_behalf_of'))),
+    ('resources', 'resource_id, (COALESCE(user_id, 0)), project_id, source_id',
+     (('samples', 'resource_id'),)),
+    ('meters', 'name, type, unit',
+     (('samples', 'meter_id'),)),
+)
+
+# NOTE: index migrations run by upgrade as (version, index, table, method
+# and columns, unique), a version is recorded in schema_version once its
+# index is built. Dimension lookups by uuid, name or resource id are served by the
+# unique natural keys of the dimension tables.
+INDEX_MIGRATIONS = (
+    (1, 'samples_meter_timestamp', 'samples', 'btree (meter_id, timestamp)',
+     False),
+    (2, 'samples_resource_meter_timestamp', 'samples',
+     'btree (resource_id, meter_id, timestamp)', False),
+    (3, 'samples_timestamp_brin', 'samples', 'brin (timestamp)', False),
+    (4, 'sample_metadata_metadata', 'sample_metadata',
+     'gin (metadata jsonb_path_ops)', False),
+    (5, 'alarm_alarm_id', 'alarm', 'btree (alarm_id)', False),
+    (6, 'alarm_change_alarm_timestamp', 'alarm_change',
+     'btree (alarm_id, timestamp)', False),
+    (7, 'samples_timestamp_id', 'samples', 'btree (timestamp, id)', False),
+    # NOTE: samples are deduplicated right before the build, partitioned
+    # samples get a unique index of message ids and timestamps when
+    # partitioned.
+    (8, 'samples_message_id', 'samples', 'btree (message_id)', True),
+    # NOTE: serve the foreign key checks of users and projects deleted by
+    # collect_orphan_dimensions.
+    (9, 'samples_user_id', 'samples', 'btree (user_id)', False),
+    (10, 'samples_project_id', 'samples', 'btree (project_id)', False),
+    # NOTE: duplicated dimension rows are merged right before the build,
+    # dimension tables are migrated by upgrade before the others.
+    (11, 'sources_natural_key', 'sources', 'btree (name)', True),
+    (12, 'users_natural_key', 'users', 'btree (uuid, source_id)', True),
+    (13, 'projects_natural_key', 'projects', 'btree (uuid, source_id)',
+     True),
+    (14, 'resources_natural_key', 'resources',
+     'btree (resource_id, (COALESCE(user_id, 0)), project_id, source_id)',
+     True),
+    (15, 'meters_natural_key', 'meters', 'btree (name, type, unit)', True),
+)
+
+# NOTE: tables telling which resources and meters still have samples, kept
+# up to date by the triggers on samples. They replace the references from
+# samples when unreferenced dimension rows are garbage collected.
+SAMPLE_REFERENCES = {
+    'resources': ('resource_summary', 'resource_id'),
+    'meters': ('meter_resource_latest', 'meter_id'),
+}
+# NOTE: dimension tables garbage collected after expiry, in the order
+# their rows stop being referenced.
+COLLECTED_DIMENSIONS = ('resources', 'meters', 'users', 'projects')
+FOREIGN_KEY_VIOLATION = '23503'
+UNIQUE_VIOLATION = '23505'
+# NOTE: builds of unique indexes failing on rows duplicated meanwhile are
+# retried after another deduplication.
+UNIQUE_INDEX_ATTEMPTS = 3
+
+# NOTE: invalidations of cached statistics, polled by every driver instance
+# using the database. A null meter invalidates all the statistics.
+STATS_INVALIDATE = ("INSERT INTO statistics_invalidations (meter)"
+                    " SELECT unnest(%s::text[])")
+# NOTE: ids of invalidations are not in commit order, invalidations created
+# within the margin before the previous poll are read again.
+STATS_INVALIDATIONS = ("SELECT clock_timestamp()::timestamp as polled_at,"
+                       " i.id, i.meter, i.created_at FROM (SELECT 1) as now"
+                       " LEFT JOIN statistics_invalidations as i"
+                       " ON i.created_at > %s ORDER BY i.id")
+STATS_INVALIDATIONS_MARGIN = datetime.timedelta(minutes=1)
+
+# NOTE: tables cached by aggregate_prebill, every change of them makes the
+# server functions reload the cache.
+REFERENCE_TABLES = ('glance_images', 'glance_image_properties',
+                    'volume_types')
+
+# NOTE: aggregate_prebill keys prebill by project ids read back from the
+# projects uuid, lower case without dashes. Tenant keys written from raw
+# project ids in another format are normalised, unless the normalised key
+# already has rows.
+PREBILL_NORMALIZE = ("UPDATE prebill SET tenant_key ="
+                     " replace(lower(tenant_key), '-', '')"
+                     " WHERE tenant_key ~* '^[0-9a-f]{8}-?[0-9a-f]{4}-?"
+                     "[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$'"
+                     " AND tenant_key != replace(lower(tenant_key), '-', '')"
+                     " AND NOT EXISTS (SELECT 1 FROM prebill as p"
+                     "  WHERE p.class = prebill.class"
+                     "  AND p.obj_key = prebill.obj_key"
+                     "  AND p.event_type = prebill.event_type"
+                     "  AND p.owner_key = prebill.owner_key"
+                     "  AND p.tenant_key ="
+                     "   replace(lower(prebill.tenant_key), '-', '')"
+                     "  AND p.counter_type = prebill.counter_type"
+                     "  AND p.updating = prebill.updating)")
+
+BULK_COPY = ("COPY samples_staging (source, user_id, project_id, resource_id,"
+             " counter_name, counter_type, counter_unit, counter_volume,"
+             " timestamp, message_id, message_signature, resource_metadata)"
+             " FROM STDIN")
+# NOTE: every statement sees only the rows copied by the current
+# transaction, so concurrent bulk loads share the staging table safely.
+BULK_MERGE = (
+    "INSERT INTO sources (name)"
+    " SELECT DISTINCT st.source FROM samples_staging st"
+    " WHERE st.batch_id = txid_current()"
+    " ON CONFLICT DO NOTHING",
+
+    "INSERT INTO users (uuid, source_id)"
+    " SELECT DISTINCT st.user_id::uuid, sources.id FROM samples_staging st"
+    " JOIN sources ON sources.name = st.source"
+    " WHERE st.batch_id = txid_current() AND st.user_id IS NOT NULL"
+    " ON CONFLICT DO NOTHING",
+
+    "INSERT INTO projects (uuid, source_id)"
+    " SELECT DISTINCT st.project_id::uuid, sources.id FROM samples_staging st"
+    " JOIN sources ON sources.name = st.source"
+    " WHERE st.batch_id = txid_current()"
+    " ON CONFLICT DO NOTHING",
+
+    "INSERT INTO resources (resource_id, user_id, project_id, source_id)"
+    " SELECT DISTINCT st.resource_id, users.id, projects.id, sources.id"
+    " FROM samples_staging st"
+    " JOIN sources ON sources.name = st.source"
+    " LEFT JOIN users ON users.uuid = st.user_id::uuid"
+    "  AND users.source_id = sources.id"
+    " JOIN projects ON projects.uuid = st.project_id::uuid"
+    "  AND projects.source_id = sources.id"
+    " WHERE st.batch_id = txid_current()"
+    " ON CONFLICT DO NOTHING",
+
+    "INSERT INTO meters (name, type, unit)"
+    " SELECT DISTINCT st.counter_name, st.counter_type, st.counter_unit"
+    " FROM samples_staging st"
+    " WHERE st.batch_id = txid_current()"
+    " ON CONFLICT DO NOTHING",
+
+    "INSERT INTO sample_metadata (hash, metadata)"
+    " SELECT DISTINCT md5(st.resource_metadata::text)::uuid,"
+    " st.resource_metadata"
+    " FROM samples_staging st"
+    " WHERE st.batch_id = txid_current()"
+    " AND st.resource_metadata IS NOT NULL"
+    " ON CONFLICT DO NOTHING",
+)
+# NOTE: returns the number of staged samples whose dimensions were found
+# and the number of them inserted, the others were already written.
+BULK_INSERT = (
+    "WITH staged AS ("
+    " SELECT DISTINCT ON (st.message_id)"
+    " users.id as user_id, projects.id as project_id,"
+    " resources.id as resource_id, meters.id as meter_id,"
+    " sources.id as source_id, st.timestamp, st.message_id,"
+    " st.message_signature, st.counter_volume,"
+    " sample_metadata.id as metadata_id"
+    " FROM samples_staging st"
+    " JOIN sources ON sources.name = st.source"
+    " LEFT JOIN users ON users.uuid = st.user_id::uuid"
+    "  AND users.source_id = sources.id"
+    " JOIN projects ON projects.uuid = st.project_id::uuid"
+    "  AND projects.source_id = sources.id"
+    " JOIN resources ON resources.resource_id = st.resource_id"
+    "  AND resources.user_id IS NOT DISTINCT FROM users.id"
+    "  AND resources.project_id = projects.id"
+    "  AND resources.source_id = sources.id"
+    " JOIN meters ON meters.name = st.counter_name"
+    "  AND meters.type = st.counter_type AND meters.unit = st.counter_unit"
+    " LEFT JOIN sample_metadata"
+    "  ON sample_metadata.hash = md5(st.resource_metadata::text)::uuid"
+    " WHERE st.batch_id = txid_current()),"
+    " inserted AS ("
+    " INSERT INTO samples (user_id, project_id, resource_id, meter_id,"
+    " source_id, timestamp, message_id, message_signature, recorded_at,"
+    " volume, metadata_id)"
+    " SELECT user_id, project_id, resource_id, meter_id, source_id,"
+    " timestamp, message_id, message_signature, now(), counter_volume,"
+    " metadata_id FROM staged"
+    " ON CONFLICT DO NOTHING RETURNING 1)"
+    " SELECT (SELECT count(*) FROM staged) as staged,"
+    " (SELECT count(*) FROM inserted) as loaded")
+# NOTE: prepared once per connection by the typed ingest path.
+SAMPLE_INSERT = (
+    'insert_sample',
+    ('bigint', 'bigint', 'bigint', 'bigint', 'bigint', 'timestamp', 'text',
+     'text', 'double precision', 'bigint'),
+    "INSERT INTO samples (user_id, project_id, resource_id, meter_id,"
+    " source_id, timestamp, message_id, message_signature, recorded_at,"
+    " volume, metadata_id)"
+    " VALUES ($1, $2, $3, $4, $5, $6, $7, $8, now(), $9, $10)"
+    " ON CONFLICT DO NOTHING")
+# NOTE: meter_resource_latest holds the ids of the latest sample of every
+# meter and resource id, maintained by a trigger on samples.
+# The rebuild merges the samples of an id range like the trigger does.
+LATEST_REBUILD = (
+    "INSERT INTO meter_resource_latest (meter_id, resource_id, sample_id,"
+    " user_id, project_id, source_id, metadata_id)"
+    " SELECT DISTINCT ON (samples.meter_id, resources.resource_id)"
+    " samples.meter_id, resources.resource_id, samples.id, samples.user_id,"
+    " samples.project_id, samples.source_id, samples.metadata_id"
+    " FROM samples JOIN resources ON samples.resource_id = resources.id"
+    " WHERE samples.id > %(start)s AND samples.id <= %(end)s"
+    " ORDER BY samples.meter_id, resources.resource_id, samples.id DESC"
+    " ON CONFLICT (meter_id, resource_id) DO UPDATE"
+    " SET sample_id = EXCLUDED.sample_id, user_id = EXCLUDED.user_id,"
+    " project_id = EXCLUDED.project_id, source_id = EXCLUDED.source_id,"
+    " metadata_id = EXCLUDED.metadata_id"
+    " WHERE meter_resource_latest.sample_id < EXCLUDED.sample_id",
+)
+# NOTE: points rows whose latest sample was deleted to the latest remaining
+# sample, rows without any sample left are deleted. Run by chunks of meter
+# id ranges.
+LATEST_REPAIR = (
+    "INSERT INTO meter_resource_latest (meter_id, resource_id, sample_id,"
+    " user_id, project_id, source_id, metadata_id)"
+    " SELECT DISTINCT ON (samples.meter_id, resources.resource_id)"
+    " samples.meter_id, resources.resource_id, samples.id, samples.user_id,"
+    " samples.project_id, samples.source_id, samples.metadata_id"
+    " FROM meter_resource_latest as latest"
+    " JOIN resources ON resources.resource_id = latest.resource_id"
+    " JOIN samples ON samples.resource_id = resources.id"
+    "  AND samples.meter_id = latest.meter_id"
+    " WHERE latest.meter_id >= %(start)s AND latest.meter_id < %(end)s"
+    " AND NOT EXISTS (SELECT 1 FROM samples as s"
+    "  WHERE s.id = latest.sample_id)"
+    " ORDER BY samples.meter_id, resources.resource_id, samples.id DESC"
+    " ON CONFLICT (meter_id, resource_id) DO UPDATE"
+    " SET sample_id = EXCLUDED.sample_id, user_id = EXCLUDED.user_id,"
+    " project_id = EXCLUDED.project_id, source_id = EXCLUDED.source_id,"
+    " metadata_id = EXCLUDED.metadata_id",
+
+    "DELETE FROM meter_resource_latest as latest"
+    " WHERE latest.meter_id >= %(start)s AND latest.meter_id < %(end)s"
+    " AND NOT EXISTS (SELECT 1 FROM samples"
+    "  WHERE samples.id = latest.sample_id)",
+)
+# NOTE: resource_summary holds the first and last sample timestamps and the
+# latest metadata of every resource, maintained by a trigger on samples.
+# The rebuild merges the samples of an id range like the trigger does.
+RESOURCE_SUMMARY_REBUILD = (
+    "INSERT INTO resource_summary (resource_id, source_id, user_id,"
+    " project_id, first_timestamp, last_timestamp, metadata_id)"
+    " SELECT DISTINCT ON (resource_id) resource_id, source_id, user_id,"
+    " project_id, min(timestamp) OVER (PARTITION BY resource_id),"
+    " timestamp, metadata_id"
+    " FROM samples WHERE id > %(start)s AND id <= %(end)s"
+    " ORDER BY resource_id, timestamp DESC, id DESC"
+    " ON CONFLICT (resource_id) DO UPDATE"
+    " SET first_timestamp = least(resource_summary.first_timestamp,"
+    " EXCLUDED.first_timestamp),"
+    " last_timestamp = greatest(resource_summary.last_timestamp,"
+    " EXCLUDED.last_timestamp),"
+    " metadata_id = CASE WHEN EXCLUDED.last_timestamp"
+    " >= resource_summary.last_timestamp THEN EXCLUDED.metadata_id"
+    " ELSE resource_summary.metadata_id END",
+)
+# NOTE: deletes summaries of resources without any sample left. Run by
+# chunks of resource id ranges, like the expiry.
+RESOURCE_SUMMARY_REPAIR = (
+    "DELETE FROM resource_summary"
+    " WHERE resource_id >= %(start)s AND resource_id < %(end)s"
+    " AND NOT EXISTS (SELECT 1 FROM samples"
+    " WHERE samples.resource_id = resource_summary.resource_id)",
+)
+# NOTE: samples are expired by timestamp, so resources last seen before the
+# expiry date have no samples left.
+RESOURCE_SUMMARY_EXPIRE = (
+    "DELETE FROM resource_summary"
+    " WHERE resource_id >= %(start)s AND resource_id < %(end)s"
+    " AND last_timestamp < %(date)s",
+
+    "UPDATE resource_summary SET first_timestamp = ("
+    " SELECT min(timestamp) FROM samples"
+    " WHERE samples.resource_id = resource_summary.resource_id)"
+    " WHERE resource_id >= %(start)s AND resource_id < %(end)s"
+    " AND first_timestamp < %(date)s",
+)
+# NOTE: expires the rollups of a meter id range.
+ROLLUPS_EXPIRE = ("SELECT expire_rollups(%(date)s, %(start)s, %(end)s)",)
+# NOTE: filter attributes of get_resources and the sample fields they
+# match, see psql_utils.SAMPLE_FIELDS. A resource or project id may stand
+# for several rows of the dimension table.
+RESOURCE_FILTER_FIELDS = (
+    ('resource', 'resource_id'),
+    ('user', 'user_id'),
+    ('project', 'project_id'),
+    ('source', 'source_id'),
+)
+# NOTE: moves metadata of the samples in an id range into sample_metadata,
+# used by the upgrade from samples with the metadata column.
+METADATA_MOVE = (
+    "INSERT INTO sample_metadata (hash, metadata)"
+    " SELECT DISTINCT md5(metadata::text)::uuid, metadata FROM samples"
+    " WHERE id > %(start)s AND id <= %(end)s AND metadata IS NOT NULL"
+    " ON CONFLICT DO NOTHING",
+
+    "UPDATE samples SET metadata_id = sample_metadata.id"
+    " FROM sample_metadata"
+    " WHERE samples.id > %(start)s AND samples.id <= %(end)s"
+    " AND sample_metadata.hash = md5(samples.metadata::text)::uuid",
+)
+BULK_CLEANUP = "DELETE FROM samples_staging WHERE batch_id = txid_current()"
+
+# NOTE: bounds of a range partition as shown by pg_get_expr(relpartbound).
+PARTITION_BOUND = re.compile(r"FROM \((.*)\) TO \((.*)\)")
+# NOTE: statement triggers of samples, moved to the partitioned table when
+# samples are partitioned.
+SAMPLES_TRIGGERS = ('samples_meter_resource_latest', 'samples_resource_summary')
+
 ID_UUID_NAME_CONFORMITY = {
     'source_id': 'sources.name',
     'project_id': 'projects.uuid',
@@ -111,6 +665,32 @@ class Connection(base.Connection):
     def __init__(self, conf):
         """Constructor."""
         self.conn_pool = self._get_connection_pool()
+        self._dimension_cache = psql_utils.LRUCache(
+            cfg.CONF.database.dimension_cache_size)
+        self._prebill_stats = {'runs': 0, 'samples': 0, 'refdata_lookups': 0}
+        self._metadata_cache = psql_utils.LRUCache(
+            cfg.CONF.database.metadata_cache_size)
+        self._recent_messages = psql_utils.LRUCache(
+            cfg.CONF.database.recent_messages_size)
+        self._duplicates = {'in_process': 0, 'database': 0}
+        self._stats_cache = psql_utils.MemoryLRUCache(
+            cfg.CONF.database.stats_cache_memory * 1024 * 1024)
+        self._stats_polled_at = None
+        self._stats_invalidations = {}
+        self._query_templates = psql_utils.QueryTemplates(
+            cfg.CONF.database.query_templates)
+        self._resolver = psql_utils.DimensionResolver(
+            cfg.CONF.database.dimension_resolver_size,
+            cfg.CONF.database.dimension_resolver_ttl)
+        self._write_buffer = None
+        if cfg.CONF.database.write_behind:
+            self._write_buffer = write_buffer.WriteBehindBuffer(
+                self.record_metering_data_batch,
+                max_size=cfg.CONF.database.write_behind_buffer_size,
+                batch_size=cfg.CONF.database.write_behind_batch_size,
+                max_age=cfg.CONF.database.write_behind_max_age,
+                overflow=cfg.CONF.database.write_behind_overflow)
+            atexit.register(self._write_buffer.stop)
 
     @staticmethod
     def _get_connection_pool():
@@ -126,16 +706,951 @@ class Connection(base.Connection):
                                   port=connection.port or 5432,
                                   user=connection.username,
                                   password=connection.password,
-                                  database=connection.path[1:])
+                                  database=connection.path[1:],
+                                  connection_factory=(
+                                      psql_utils.PreparingConnection))
         else:
             raise Exception('Wrong connection string is set')
 
     def upgrade(self):
         """Migrate the database to `version` or the most recent version."""
+        if cfg.CONF.database.samples_partition_interval:
+            self._partition_samples()
         with PoolConnection(self.conn_pool) as db:
+            db.execute("SELECT to_regclass('meter_resource_latest'),"
+                       " to_regclass('resource_summary')")
+            build_latest, build_summary = [
+                table is None for table in db.fetchone()]
             db.execute("""
-                      
-                      """)
+                CREATE UNLOGGED TABLE IF NOT EXISTS samples_staging (
+                    batch_id bigint DEFAULT txid_current(),
+                    source text,
+                    user_id text,
+                    project_id text,
+                    resource_id text,
+                    counter_name text,
+                    counter_type text,
+                    counter_unit text,
+                    counter_volume double precision,
+                    timestamp timestamp,
+                    message_id text,
+                    message_signature text,
+                    resource_metadata jsonb);
+                CREATE TABLE IF NOT EXISTS sample_metadata (
+                    id bigserial PRIMARY KEY,
+                    hash uuid NOT NULL UNIQUE,
+                    metadata jsonb NOT NULL);
+                ALTER TABLE samples ADD COLUMN IF NOT EXISTS
+                    metadata_id bigint REFERENCES sample_metadata (id);
+                CREATE TABLE IF NOT EXISTS statistics_invalidations (
+                    id bigserial PRIMARY KEY,
+                    meter text,
+                    created_at timestamp NOT NULL DEFAULT clock_timestamp());
+                ALTER TABLE statistics_invalidations
+                    ALTER COLUMN created_at SET DEFAULT clock_timestamp();
+                CREATE INDEX IF NOT EXISTS statistics_invalidations_created_at
+                    ON statistics_invalidations (created_at);
+                CREATE TABLE IF NOT EXISTS aggregation_watermarks (
+                    name text PRIMARY KEY,
+                    last_sample_id bigint NOT NULL);
+                INSERT INTO aggregation_watermarks (name, last_sample_id)
+                    SELECT 'prebill', coalesce(max(id), 0) FROM samples
+                    ON CONFLICT (name) DO NOTHING;
+                INSERT INTO aggregation_watermarks (name, last_sample_id)
+                    VALUES ('rollup', 0) ON CONFLICT (name) DO NOTHING;
+                CREATE TABLE IF NOT EXISTS reference_data_version (
+                    version bigint NOT NULL);
+                INSERT INTO reference_data_version (version)
+                    SELECT 0 WHERE NOT EXISTS (
+                        SELECT 1 FROM reference_data_version);
+                CREATE OR REPLACE FUNCTION bump_reference_data_version()
+                RETURNS trigger AS $$
+                BEGIN
+                    UPDATE reference_data_version SET version = version + 1;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                CREATE TABLE IF NOT EXISTS glance_image_roots (
+                    image_id text PRIMARY KEY,
+                    root_id text NOT NULL);
+                DROP FUNCTION IF EXISTS refresh_glance_image_roots();
+                CREATE OR REPLACE FUNCTION refresh_glance_image_roots(
+                    images text[] DEFAULT NULL)
+                RETURNS bigint AS $$
+                DECLARE
+                    refreshed bigint;
+                BEGIN
+                    IF images IS NULL THEN
+                        LOCK TABLE glance_image_roots IN EXCLUSIVE MODE;
+                        DELETE FROM glance_image_roots;
+                    ELSE
+                        WITH RECURSIVE refs AS (
+                            SELECT image_id, value AS base_id
+                            FROM glance_image_properties
+                            WHERE name = 'base_image_ref'
+                            AND value IS NOT NULL AND value != ''
+                        ), affected (image_id) AS (
+                            SELECT unnest(images)
+                            UNION
+                            SELECT refs.image_id FROM refs
+                            JOIN affected ON refs.base_id = affected.image_id
+                        )
+                        SELECT coalesce(array_agg(image_id), '{}')
+                        INTO images FROM affected;
+                        DELETE FROM glance_image_roots
+                        WHERE image_id = ANY(images);
+                    END IF;
+                    INSERT INTO glance_image_roots (image_id, root_id)
+                    WITH RECURSIVE refs AS (
+                        SELECT image_id, value AS base_id
+                        FROM glance_image_properties
+                        WHERE name = 'base_image_ref'
+                        AND value IS NOT NULL AND value != ''
+                    ), chains (image_id, root_id, path, depth) AS (
+                        SELECT id, id, ARRAY[id], 0 FROM glance_images
+                        WHERE images IS NULL OR id = ANY(images)
+                        UNION ALL
+                        SELECT chains.image_id, refs.base_id,
+                               chains.path || refs.base_id, chains.depth + 1
+                        FROM chains
+                        JOIN refs ON refs.image_id = chains.root_id
+                        WHERE refs.base_id != ALL(chains.path)
+                        AND chains.depth < 64
+                    )
+                    SELECT DISTINCT ON (image_id) image_id, root_id
+                    FROM chains ORDER BY image_id, depth DESC
+                    ON CONFLICT (image_id)
+                    DO UPDATE SET root_id = EXCLUDED.root_id;
+                    GET DIAGNOSTICS refreshed = ROW_COUNT;
+                    RETURN refreshed;
+                END;
+                $$ LANGUAGE plpgsql;
+                CREATE OR REPLACE FUNCTION refresh_glance_image_roots_trigger()
+                RETURNS trigger AS $$
+                BEGIN
+                    PERFORM refresh_glance_image_roots();
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                CREATE OR REPLACE FUNCTION glance_images_roots_trigger()
+                RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        PERFORM refresh_glance_image_roots(
+                            ARRAY(SELECT id::text FROM new_rows));
+                    ELSIF TG_OP = 'UPDATE' THEN
+                        PERFORM refresh_glance_image_roots(
+                            ARRAY(SELECT id::text FROM new_rows
+                                  UNION SELECT id::text FROM old_rows));
+                    ELSE
+                        PERFORM refresh_glance_image_roots(
+                            ARRAY(SELECT id::text FROM old_rows));
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                CREATE OR REPLACE FUNCTION
+                glance_image_properties_roots_trigger()
+                RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        PERFORM refresh_glance_image_roots(
+                            ARRAY(SELECT image_id FROM new_rows
+                                  WHERE name = 'base_image_ref'));
+                    ELSIF TG_OP = 'UPDATE' THEN
+                        PERFORM refresh_glance_image_roots(
+                            ARRAY(SELECT image_id FROM new_rows
+                                  WHERE name = 'base_image_ref'
+                                  UNION SELECT image_id FROM old_rows
+                                  WHERE name = 'base_image_ref'));
+                    ELSE
+                        PERFORM refresh_glance_image_roots(
+                            ARRAY(SELECT image_id FROM old_rows
+                                  WHERE name = 'base_image_ref'));
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                CREATE TABLE IF NOT EXISTS meter_resource_latest (
+                    meter_id bigint NOT NULL,
+                    resource_id text NOT NULL,
+                    sample_id bigint NOT NULL,
+                    user_id bigint,
+                    project_id bigint,
+                    source_id bigint,
+                    metadata_id bigint,
+                    PRIMARY KEY (meter_id, resource_id));
+                CREATE OR REPLACE FUNCTION update_meter_resource_latest()
+                RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO meter_resource_latest (meter_id, resource_id,
+                        sample_id, user_id, project_id, source_id,
+                        metadata_id)
+                    SELECT DISTINCT ON (n.meter_id, resources.resource_id)
+                        n.meter_id, resources.resource_id, n.id, n.user_id,
+                        n.project_id, n.source_id, n.metadata_id
+                    FROM new_samples as n
+                    JOIN resources ON n.resource_id = resources.id
+                    ORDER BY n.meter_id, resources.resource_id, n.id DESC
+                    ON CONFLICT (meter_id, resource_id) DO UPDATE
+                    SET sample_id = EXCLUDED.sample_id,
+                        user_id = EXCLUDED.user_id,
+                        project_id = EXCLUDED.project_id,
+                        source_id = EXCLUDED.source_id,
+                        metadata_id = EXCLUDED.metadata_id
+                    WHERE meter_resource_latest.sample_id < EXCLUDED.sample_id;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                DROP TRIGGER IF EXISTS samples_meter_resource_latest
+                    ON samples;
+                CREATE TRIGGER samples_meter_resource_latest
+                    AFTER INSERT ON samples
+                    REFERENCING NEW TABLE AS new_samples
+                    FOR EACH STATEMENT
+                    EXECUTE PROCEDURE update_meter_resource_latest();
+                CREATE TABLE IF NOT EXISTS resource_summary (
+                    resource_id bigint PRIMARY KEY,
+                    source_id bigint,
+                    user_id bigint,
+                    project_id bigint,
+                    first_timestamp timestamp NOT NULL,
+                    last_timestamp timestamp NOT NULL,
+                    metadata_id bigint);
+                CREATE OR REPLACE FUNCTION update_resource_summary()
+                RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO resource_summary (resource_id, source_id,
+                        user_id, project_id, first_timestamp, last_timestamp,
+                        metadata_id)
+                    SELECT DISTINCT ON (n.resource_id) n.resource_id,
+                        n.source_id, n.user_id, n.project_id,
+                        min(n.timestamp) OVER (PARTITION BY n.resource_id),
+                        n.timestamp, n.metadata_id
+                    FROM new_samples as n
+                    ORDER BY n.resource_id, n.timestamp DESC, n.id DESC
+                    ON CONFLICT (resource_id) DO UPDATE
+                    SET first_timestamp = least(
+                            resource_summary.first_timestamp,
+                            EXCLUDED.first_timestamp),
+                        last_timestamp = greatest(
+                            resource_summary.last_timestamp,
+                            EXCLUDED.last_timestamp),
+                        metadata_id = CASE
+                            WHEN EXCLUDED.last_timestamp
+                                >= resource_summary.last_timestamp
+                            THEN EXCLUDED.metadata_id
+                            ELSE resource_summary.metadata_id END;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                DROP TRIGGER IF EXISTS samples_resource_summary ON samples;
+                CREATE TRIGGER samples_resource_summary
+                    AFTER INSERT ON samples
+                    REFERENCING NEW TABLE AS new_samples
+                    FOR EACH STATEMENT
+                    EXECUTE PROCEDURE update_resource_summary();
+                DROP FUNCTION IF EXISTS merge_rollup(
+                    integer, bigint, bigint, timestamp, timestamp);
+                CREATE OR REPLACE FUNCTION merge_rollup(
+                    size integer, first_id bigint, last_id bigint,
+                    start timestamp, stop timestamp,
+                    first_meter bigint DEFAULT NULL,
+                    last_meter bigint DEFAULT NULL)
+                RETURNS void AS $$
+                BEGIN
+                    EXECUTE format('
+                        INSERT INTO rollup_%1$s AS r (meter_id, timestamp,
+                            resource_id, project_id, user_id, source_id,
+                            first_timestamp, last_timestamp, volume_count,
+                            volume_sum, volume_min, volume_max,
+                            volume_sum_sq)
+                        SELECT meter_id, timestamp ''epoch'' + floor(
+                                extract(epoch from timestamp) / %1$s)
+                                * %1$s * interval ''1 second'',
+                            resource_id, project_id, user_id, source_id,
+                            min(timestamp), max(timestamp), count(volume),
+                            sum(volume), min(volume), max(volume),
+                            sum(volume * volume)
+                        FROM samples
+                        WHERE id > $1 AND id <= $2
+                        AND timestamp >= coalesce($3, ''-infinity'')
+                        AND timestamp < coalesce($4, ''infinity'')
+                        AND ($5 IS NULL OR meter_id >= $5)
+                        AND ($6 IS NULL OR meter_id < $6)
+                        GROUP BY 1, 2, 3, 4, 5, 6
+                        ON CONFLICT (meter_id, timestamp, resource_id)
+                        DO UPDATE SET
+                            first_timestamp = least(r.first_timestamp,
+                                EXCLUDED.first_timestamp),
+                            last_timestamp = greatest(r.last_timestamp,
+                                EXCLUDED.last_timestamp),
+                            volume_count = r.volume_count
+                                + EXCLUDED.volume_count,
+                            volume_sum = coalesce(
+                                r.volume_sum + EXCLUDED.volume_sum,
+                                r.volume_sum, EXCLUDED.volume_sum),
+                            volume_min = least(r.volume_min,
+                                EXCLUDED.volume_min),
+                            volume_max = greatest(r.volume_max,
+                                EXCLUDED.volume_max),
+                            volume_sum_sq = coalesce(
+                                r.volume_sum_sq + EXCLUDED.volume_sum_sq,
+                                r.volume_sum_sq, EXCLUDED.volume_sum_sq)',
+                        size) USING first_id, last_id, start, stop,
+                            first_meter, last_meter;
+                END;
+                $$ LANGUAGE plpgsql;
+                CREATE OR REPLACE FUNCTION refresh_rollups(
+                    batch_size integer, settle_time interval)
+                RETURNS integer AS $$
+                DECLARE
+                    watermark bigint;
+                    upto bigint;
+                    size integer;
+                    processed integer;
+                BEGIN
+                    SELECT last_sample_id INTO watermark
+                    FROM aggregation_watermarks
+                    WHERE name = 'rollup' FOR UPDATE;
+                    SELECT coalesce(min(id) FILTER (
+                        WHERE recorded_at >= now() - settle_time) - 1,
+                        max(id)) INTO upto
+                    FROM (SELECT id, recorded_at FROM samples
+                          WHERE id > watermark
+                          ORDER BY id LIMIT batch_size) as batch;
+                    IF upto IS NULL OR upto <= watermark THEN
+                        RETURN 0;
+                    END IF;
+                    FOREACH size IN ARRAY ARRAY[60, 3600, 86400] LOOP
+                        PERFORM merge_rollup(size, watermark, upto,
+                                             NULL, NULL);
+                    END LOOP;
+                    SELECT count(*) INTO processed FROM samples
+                    WHERE id > watermark AND id <= upto;
+                    UPDATE aggregation_watermarks SET last_sample_id = upto
+                    WHERE name = 'rollup';
+                    RETURN processed;
+                END;
+                $$ LANGUAGE plpgsql;
+                DROP FUNCTION IF EXISTS expire_rollups(timestamp);
+                CREATE OR REPLACE FUNCTION expire_rollups(
+                    expiry timestamp, first_meter bigint DEFAULT NULL,
+                    last_meter bigint DEFAULT NULL)
+                RETURNS void AS $$
+                DECLARE
+                    watermark bigint;
+                    size integer;
+                    boundary timestamp;
+                BEGIN
+                    SELECT last_sample_id INTO watermark
+                    FROM aggregation_watermarks
+                    WHERE name = 'rollup' FOR UPDATE;
+                    FOREACH size IN ARRAY ARRAY[60, 3600, 86400] LOOP
+                        EXECUTE format(
+                            'DELETE FROM rollup_%s WHERE timestamp < $1'
+                            ' AND ($2 IS NULL OR meter_id >= $2)'
+                            ' AND ($3 IS NULL OR meter_id < $3)',
+                            size) USING expiry, first_meter, last_meter;
+                        boundary := timestamp 'epoch' + floor(
+                            extract(epoch from expiry) / size)
+                            * size * interval '1 second';
+                        IF boundary < expiry THEN
+                            PERFORM merge_rollup(
+                                size, 0, watermark, expiry,
+                                boundary + size * interval '1 second',
+                                first_meter, last_meter);
+                        END IF;
+                    END LOOP;
+                END;
+                $$ LANGUAGE plpgsql;
+                """)
+            for size in ROLLUP_SIZES:
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS rollup_{0} (
+                        meter_id bigint NOT NULL,
+                        timestamp timestamp NOT NULL,
+                        resource_id bigint NOT NULL,
+                        project_id bigint,
+                        user_id bigint,
+                        source_id bigint,
+                        first_timestamp timestamp NOT NULL,
+                        last_timestamp timestamp NOT NULL,
+                        volume_count bigint NOT NULL,
+                        volume_sum double precision,
+                        volume_min double precision,
+                        volume_max double precision,
+                        volume_sum_sq double precision,
+                        PRIMARY KEY (meter_id, timestamp, resource_id));
+                    """.format(size))
+            for table in REFERENCE_TABLES:
+                db.execute("DROP TRIGGER IF EXISTS {0}_version ON {0};"
+                           " CREATE TRIGGER {0}_version"
+                           " AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE"
+                           " ON {0} FOR EACH STATEMENT"
+                           " EXECUTE PROCEDURE bump_reference_data_version()"
+                           .format(table))
+            # Row changes refresh only the touched images and their
+            # descendants from the transition tables, TRUNCATE rebuilds all.
+            for table in ('glance_images', 'glance_image_properties'):
+                db.execute("DROP TRIGGER IF EXISTS {0}_roots ON {0};"
+                           " DROP TRIGGER IF EXISTS {0}_roots_insert ON {0};"
+                           " CREATE TRIGGER {0}_roots_insert"
+                           " AFTER INSERT ON {0}"
+                           " REFERENCING NEW TABLE AS new_rows"
+                           " FOR EACH STATEMENT"
+                           " EXECUTE PROCEDURE {0}_roots_trigger();"
+                           " DROP TRIGGER IF EXISTS {0}_roots_update ON {0};"
+                           " CREATE TRIGGER {0}_roots_update"
+                           " AFTER UPDATE ON {0}"
+                           " REFERENCING OLD TABLE AS old_rows"
+                           " NEW TABLE AS new_rows"
+                           " FOR EACH STATEMENT"
+                           " EXECUTE PROCEDURE {0}_roots_trigger();"
+                           " DROP TRIGGER IF EXISTS {0}_roots_delete ON {0};"
+                           " CREATE TRIGGER {0}_roots_delete"
+                           " AFTER DELETE ON {0}"
+                           " REFERENCING OLD TABLE AS old_rows"
+                           " FOR EACH STATEMENT"
+                           " EXECUTE PROCEDURE {0}_roots_trigger();"
+                           " DROP TRIGGER IF EXISTS {0}_roots_truncate ON {0};"
+                           " CREATE TRIGGER {0}_roots_truncate"
+                           " AFTER TRUNCATE ON {0}"
+                           " FOR EACH STATEMENT"
+                           " EXECUTE PROCEDURE"
+                           " refresh_glance_image_roots_trigger()"
+                           .format(table))
+            db.execute("SELECT refresh_glance_image_roots()")
+            db.execute("SELECT to_regclass('prebill')")
+            if db.fetchone()[0] is not None:
+                db.execute(PREBILL_NORMALIZE)
+                if db.rowcount:
+                    LOG.info(_("Normalised tenant keys of {0} prebill rows"
+                               .format(db.rowcount)))
+        # NOTE: dimension upserts rely on the unique natural keys.
+        self._migrate_indexes([table for table, _key, _refs
+                               in DIMENSION_REFERENCES])
+        self._move_metadata()
+        if build_latest:
+            self.rebuild_meter_resource_latest()
+        if build_summary:
+            self.rebuild_resource_summary()
+        self.create_samples_partitions()
+        self._migrate_indexes()
+
+    def _migrate_indexes(self, tables=None):
+        """Run the index migrations not recorded in schema_version yet.
+
+        Indexes are built with CREATE INDEX CONCURRENTLY, so samples keep
+        being written meanwhile. Migrations of tables which do not exist
+        are left for a later upgrade.
+
+        :param tables: optional list of tables to run the migrations of
+        :returns: the versions applied
+        """
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                       " version integer PRIMARY KEY,"
+                       " name text NOT NULL,"
+                       " applied_at timestamp NOT NULL DEFAULT now())")
+            db.execute("SELECT version FROM schema_version")
+            applied = set(row.version for row in db.fetchall())
+        migrated = []
+        for version, name, table, definition, unique in INDEX_MIGRATIONS:
+            if version in applied or (tables is not None and
+                                      table not in tables):
+                continue
+            # NOTE: readonly connections are in autocommit mode, which
+            # CREATE INDEX CONCURRENTLY requires.
+            with PoolConnection(self.conn_pool, readonly=True) as db:
+                db.execute("SELECT to_regclass(%s)", (table,))
+                if db.fetchone()[0] is None:
+                    continue
+                if table == 'samples' and self._samples_partitioned(db):
+                    self._create_partitioned_index(db, name, definition,
+                                                   unique)
+                elif unique:
+                    self._create_unique_index(db, name, table, definition)
+                else:
+                    self._create_index(db, name, table, definition, unique)
+                db.execute("INSERT INTO schema_version (version, name)"
+                           " VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                           (version, name))
+            LOG.info(_("Applied migration {0}, index {1}".format(version,
+                                                                 name)))
+            migrated.append(version)
+        return migrated
+
+    @staticmethod
+    def _index_valid(db, name):
+        """Return True for a valid index, False for an invalid one and None
+        if the index does not exist.
+        """
+        db.execute("SELECT indisvalid FROM pg_index"
+                   " WHERE indexrelid = to_regclass(%s)", (name,))
+        index = db.fetchone()
+        return index[0] if index else None
+
+    @staticmethod
+    def _create_index(db, name, table, definition, unique=False):
+        """Build an index concurrently unless a valid one exists.
+
+        An index left invalid by an interrupted build is dropped and built
+        again.
+        """
+        valid = Connection._index_valid(db, name)
+        if valid:
+            return
+        if valid is not None:
+            db.execute("DROP INDEX CONCURRENTLY {0}".format(name))
+        db.execute("CREATE {0}INDEX CONCURRENTLY {1} ON {2} USING {3}"
+                   .format('UNIQUE ' if unique else '', name, table,
+                           definition))
+
+    def _create_unique_index(self, db, name, table, definition):
+        """Build a unique index concurrently, removing duplicates first.
+
+        Duplicated samples are deleted, or duplicated dimension rows
+        merged, right before the build. A build failing on duplicates
+        written meanwhile leaves an invalid index, which is dropped before
+        duplicates are removed again and the build is retried.
+        """
+        if self._index_valid(db, name):
+            return
+        for attempt in six.moves.range(1, UNIQUE_INDEX_ATTEMPTS + 1):
+            if table == 'samples':
+                self._deduplicate_samples()
+            else:
+                self._merge_duplicate_dimensions(table)
+            try:
+                self._create_index(db, name, table, definition, unique=True)
+                return
+            except psycopg2.IntegrityError as e:
+                if (e.pgcode != UNIQUE_VIOLATION or
+                        attempt == UNIQUE_INDEX_ATTEMPTS):
+                    raise
+                LOG.warning(_("Rows of {0} were duplicated while index {1}"
+                              " was built, retrying: {2}".format(table, name,
+                                                                 e)))
+                db.execute("DROP INDEX CONCURRENTLY IF EXISTS {0}"
+                           .format(name))
+
+    def _create_partitioned_index(self, db, name, definition, unique=False):
+        """Build an index of partitioned samples without blocking writes.
+
+        The index is created on the partitioned table only and stays
+        invalid until the indexes of all partitions, built concurrently,
+        are attached to it. Partitions created later get it on attach.
+        A valid index, e.g. made when samples were partitioned, is kept.
+        """
+        if self._index_valid(db, name):
+            return
+        db.execute("CREATE {0}INDEX IF NOT EXISTS {1} ON ONLY samples"
+                   " USING {2}".format('UNIQUE ' if unique else '', name,
+                                       definition))
+        db.execute("SELECT c.relname FROM pg_inherits"
+                   " JOIN pg_class c ON c.oid = inhrelid"
+                   " WHERE inhparent = 'samples'::regclass")
+        for partition in [row[0] for row in db.fetchall()]:
+            index = '{0}_{1}'.format(partition, name[len('samples_'):])
+            self._create_index(db, index, partition, definition, unique)
+            db.execute("SELECT 1 FROM pg_inherits"
+                       " WHERE inhrelid = to_regclass(%s)"
+                       " AND inhparent = to_regclass(%s)", (index, name))
+            if not db.fetchone():
+                db.execute("ALTER INDEX {0} ATTACH PARTITION {1}"
+                           .format(name, index))
+
+    def _samples_in_chunks(self, statements, chunk_size=10000, first=None,
+                           last=None):
+        """Run statements over the samples of id ranges.
+
+        Every chunk of `chunk_size` ids is one transaction, so samples are
+        not locked against writes. Statements take the range as the
+        `start` and `end` parameters, by default the ids of all samples.
+
+        :returns: the summed row count of the last statement and the last
+                  id covered
+        """
+        if first is None or last is None:
+            with PoolConnection(self.conn_pool) as db:
+                db.execute("SELECT coalesce(min(id), 1) - 1,"
+                           " coalesce(max(id), 0) FROM samples")
+                first, last = db.fetchone()
+        count = 0
+        for start in six.moves.range(first, last, chunk_size):
+            with PoolConnection(self.conn_pool) as db:
+                for statement in statements:
+                    db.execute(statement, {'start': start,
+                                           'end': min(start + chunk_size,
+                                                      last)})
+                count += db.rowcount
+        return count, last
+
+    def rebuild_meter_resource_latest(self):
+        """Rebuild the table of latest samples of meters and resources.
+
+        Samples are merged into the table by chunks of ids without locking
+        them against writes, the trigger on samples merges the ones written
+        meanwhile. Rows whose latest sample is gone are repaired last.
+
+        :returns: the number of meters and resources in the table
+        """
+        self._samples_in_chunks(LATEST_REBUILD)
+        self._key_ranges_in_chunks('meter_resource_latest', 'meter_id',
+                                   LATEST_REPAIR)
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("SELECT count(*) FROM meter_resource_latest")
+            rebuilt = db.fetchone()[0]
+        LOG.info(_("Rebuilt {0} latest samples of meters and resources"
+                   .format(rebuilt)))
+        return rebuilt
+
+    @staticmethod
+    def _samples_partitioned(db):
+        db.execute("SELECT relkind = 'p' FROM pg_class"
+                   " WHERE oid = 'samples'::regclass")
+        return db.fetchone()[0]
+
+    @staticmethod
+    def _samples_partitions(db):
+        """Return (name, lower, upper) of the range partitions of samples.
+
+        MINVALUE and MAXVALUE bounds are returned as None, the default
+        partition is left out.
+        """
+        def bound(value):
+            if value in ('MINVALUE', 'MAXVALUE'):
+                return None
+            return datetime.datetime.strptime(value.strip("'")[:19],
+                                              '%Y-%m-%d %H:%M:%S')
+
+        db.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)"
+                   " FROM pg_inherits JOIN pg_class c ON c.oid = inhrelid"
+                   " WHERE inhparent = 'samples'::regclass")
+        partitions = []
+        for name, expr in db.fetchall():
+            match = PARTITION_BOUND.search(expr)
+            if match:
+                partitions.append((name, bound(match.group(1)),
+                                   bound(match.group(2))))
+        return partitions
+
+    @staticmethod
+    def _partition_start(timestamp, interval):
+        """Return the start of the partition interval of a timestamp."""
+        start = datetime.datetime(timestamp.year, timestamp.month,
+                                  timestamp.day)
+        if interval == 'week':
+            start -= datetime.timedelta(days=start.weekday())
+        return start
+
+    def _partition_samples(self):
+        """Turn samples into a table partitioned by timestamp.
+
+        The existing table becomes the samples_legacy partition holding
+        every timestamp up to the end of the intervals samples partitions
+        are created ahead for, so no sample is copied. Samples without a
+        timestamp are moved to the default partition.
+
+        What ATTACH PARTITION would do under the lock is done beforehand
+        without blocking writes: the indexes of the partitioned table
+        missing on the table are built concurrently, and a validated CHECK
+        constraint of the partition bounds spares the scan of the table.
+        The other indexes are attached where they match. The constraint
+        is dropped again if samples cannot be partitioned.
+        """
+        interval = cfg.CONF.database.samples_partition_interval
+        with PoolConnection(self.conn_pool) as db:
+            if self._samples_partitioned(db):
+                return
+            db.execute("SELECT max(timestamp) FROM samples")
+            last = db.fetchone()[0]
+        with PoolConnection(self.conn_pool, readonly=True) as db:
+            self._create_index(db, 'samples_id', 'samples', 'btree (id)')
+            self._create_unique_index(db, 'samples_message_id_timestamp',
+                                      'samples',
+                                      'btree (message_id, timestamp)')
+
+        # NOTE: the bound leaves room for the validation of the constraint,
+        # samples of later timestamps or without one are refused until
+        # samples is partitioned.
+        now = datetime.datetime.now()
+        upper = self._partition_start(max(last or now, now), interval)
+        upper += PARTITION_INTERVALS[interval] * (
+            cfg.CONF.database.samples_partitions_ahead + 1)
+        try:
+            with PoolConnection(self.conn_pool) as db:
+                db.execute("CREATE TABLE IF NOT EXISTS samples_default"
+                           " (LIKE samples INCLUDING DEFAULTS)")
+                db.execute("ALTER TABLE samples"
+                           " DROP CONSTRAINT IF EXISTS samples_legacy_bound")
+                db.execute("ALTER TABLE samples ADD CONSTRAINT"
+                           " samples_legacy_bound CHECK (timestamp IS NOT NULL"
+                           " AND timestamp < %s) NOT VALID",
+                           (upper.isoformat(' '),))
+                db.execute("WITH moved AS ("
+                           " DELETE FROM samples WHERE timestamp IS NULL"
+                           " RETURNING *)"
+                           " INSERT INTO samples_default SELECT * FROM moved")
+            with PoolConnection(self.conn_pool) as db:
+                db.execute("ALTER TABLE samples"
+                           " VALIDATE CONSTRAINT samples_legacy_bound")
+            self._attach_samples_legacy(upper)
+        except Exception:
+            LOG.error(_("Samples could not be partitioned, dropping the"
+                        " bound of samples_legacy"))
+            self._drop_samples_legacy_bound()
+            raise
+        LOG.info(_("Partitioned samples by {0}, existing samples are kept in"
+                   " samples_legacy up to {1}".format(interval, upper)))
+
+    def _attach_samples_legacy(self, upper):
+        """Swap samples for a partitioned table attaching it as legacy.
+
+        The swap runs under an ACCESS EXCLUSIVE lock of samples, waited for
+        migration_lock_timeout at most.
+        """
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("SET LOCAL lock_timeout = %s",
+                       (cfg.CONF.database.migration_lock_timeout * 1000,))
+            db.execute("LOCK TABLE samples IN ACCESS EXCLUSIVE MODE")
+            db.execute("SELECT indexname, indexdef FROM pg_indexes"
+                       " WHERE tablename = 'samples'")
+            indexes = db.fetchall()
+            db.execute("SELECT pg_get_constraintdef(oid) FROM pg_constraint"
+                       " WHERE conrelid = 'samples'::regclass"
+                       " AND contype = 'f'")
+            foreign_keys = make_list(db.fetchall())
+            db.execute("SELECT pg_get_serial_sequence('samples', 'id')")
+            sequence = db.fetchone()[0]
+
+            for name, definition in indexes:
+                db.execute("ALTER INDEX {0} RENAME TO {0}_legacy".format(name))
+            db.execute("ALTER TABLE samples RENAME TO samples_legacy")
+            for trigger in SAMPLES_TRIGGERS:
+                db.execute("DROP TRIGGER IF EXISTS {0} ON samples_legacy"
+                           .format(trigger))
+            db.execute("CREATE TABLE samples (LIKE samples_legacy"
+                       " INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                       " PARTITION BY RANGE (timestamp)")
+            db.execute("ALTER TABLE samples"
+                       " DROP CONSTRAINT samples_legacy_bound")
+            if sequence:
+                db.execute("ALTER SEQUENCE {0} OWNED BY samples.id"
+                           .format(sequence))
+            db.execute("CREATE INDEX samples_id ON samples (id)")
+            db.execute("CREATE UNIQUE INDEX samples_message_id"
+                       " ON samples (message_id, timestamp)")
+            for name, definition in indexes:
+                if definition.startswith('CREATE UNIQUE'):
+                    continue
+                db.execute(re.sub(r" ON (\S+\.)?samples ", " ON samples ",
+                                  definition, count=1)
+                           .replace('IF NOT EXISTS ', '')
+                           .replace('INDEX {0} '.format(name),
+                                    'INDEX IF NOT EXISTS {0} '.format(name),
+                                    1))
+            for foreign_key in foreign_keys:
+                db.execute("ALTER TABLE samples ADD {0}".format(foreign_key))
+            db.execute("ALTER TABLE samples ATTACH PARTITION samples_default"
+                       " DEFAULT")
+            db.execute("ALTER TABLE samples ATTACH PARTITION samples_legacy"
+                       " FOR VALUES FROM (MINVALUE) TO (%s)",
+                       (upper.isoformat(' '),))
+            db.execute("ALTER TABLE samples_legacy"
+                       " DROP CONSTRAINT samples_legacy_bound")
+
+    def _drop_samples_legacy_bound(self):
+        """Undo the preparation of samples for a failed partitioning.
+
+        Samples without a timestamp are moved back from samples_default.
+        """
+        with PoolConnection(self.conn_pool) as db:
+            if self._samples_partitioned(db):
+                return
+            db.execute("ALTER TABLE samples"
+                       " DROP CONSTRAINT IF EXISTS samples_legacy_bound")
+            db.execute("SELECT to_regclass('samples_default')")
+            if db.fetchone()[0] is not None:
+                db.execute("INSERT INTO samples SELECT * FROM samples_default")
+                db.execute("DROP TABLE samples_default")
+
+    def create_samples_partitions(self):
+        """Create the samples partitions of the coming intervals.
+
+        Partitions are created from the current interval on, for
+        samples_partitions_ahead intervals more. Samples of their ranges
+        are moved out of the default partition first.
+
+        :returns: the number of partitions created
+        """
+        interval = cfg.CONF.database.samples_partition_interval
+        if not interval:
+            return 0
+        length = PARTITION_INTERVALS[interval]
+        created = 0
+        with PoolConnection(self.conn_pool) as db:
+            if not self._samples_partitioned(db):
+                return 0
+            partitions = self._samples_partitions(db)
+            lower = self._partition_start(datetime.datetime.now(), interval)
+            for _i in range(cfg.CONF.database.samples_partitions_ahead + 1):
+                upper = lower + length
+                start = lower
+                for name, p_lower, p_upper in partitions:
+                    if ((p_lower is None or p_lower < upper) and
+                            (p_upper is None or p_upper > start)):
+                        start = max(start, p_upper or upper)
+                if start < upper:
+                    name = 'samples_{0:%Y%m%d}'.format(start)
+                    db.execute("CREATE TABLE {0} (LIKE samples"
+                               " INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                               .format(name))
+                    db.execute("WITH moved AS ("
+                               " DELETE FROM samples_default"
+                               " WHERE timestamp >= %s AND timestamp < %s"
+                               " RETURNING *)"
+                               " INSERT INTO {0} SELECT * FROM moved"
+                               .format(name), (start, upper))
+                    db.execute("ALTER TABLE samples ATTACH PARTITION {0}"
+                               " FOR VALUES FROM (%s) TO (%s)".format(name),
+                               (start.isoformat(' '), upper.isoformat(' ')))
+                    partitions.append((name, start, upper))
+                    created += 1
+                lower = upper
+        if created:
+            LOG.info(_("Created {0} samples partitions".format(created)))
+        return created
+
+    def _drop_expired_partitions(self, date):
+        """Detach and drop the samples partitions older than `date`.
+
+        Every partition is dropped in a transaction of its own, so samples
+        are locked against writes only briefly.
+        """
+        with PoolConnection(self.conn_pool) as db:
+            if not self._samples_partitioned(db):
+                return
+            expired = [name for name, lower, upper
+                       in self._samples_partitions(db)
+                       if upper is not None and upper <= date]
+        for name in expired:
+            with PoolConnection(self.conn_pool) as db:
+                db.execute("ALTER TABLE samples DETACH PARTITION {0}"
+                           .format(name))
+                db.execute("DROP TABLE {0}".format(name))
+            LOG.info(_("Dropped expired samples partition {0}".format(name)))
+
+    def _merge_duplicate_dimensions(self, table):
+        """Merge duplicated rows of a dimension table.
+
+        References to duplicates are moved to the row with the lowest id
+        before the duplicates are deleted, in one short transaction
+        holding the table against concurrent inserts. The lock is given up
+        after migration_lock_timeout at most.
+
+        :returns: the number of rows merged
+        """
+        key, references = [(key, refs) for name, key, refs
+                           in DIMENSION_REFERENCES if name == table][0]
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("SET LOCAL lock_timeout = %s",
+                       (cfg.CONF.database.migration_lock_timeout * 1000,))
+            db.execute("LOCK TABLE {0} IN SHARE ROW EXCLUSIVE MODE"
+                       .format(table))
+            db.execute("CREATE TEMP TABLE {0}_duplicates ON COMMIT DROP AS"
+                       " SELECT id, keep_id FROM ("
+                       "  SELECT id, min(id) OVER (PARTITION BY {1})"
+                       "  as keep_id FROM {0}) as d"
+                       " WHERE id != keep_id".format(table, key))
+            for ref_table, ref_column in references:
+                db.execute("SELECT to_regclass(%s)", (ref_table,))
+                if db.fetchone()[0] is None:
+                    continue
+                db.execute("UPDATE {0} SET {1} = d.keep_id"
+                           " FROM {2}_duplicates as d"
+                           " WHERE {0}.{1} = d.id".format(ref_table,
+                                                          ref_column, table))
+            db.execute("DELETE FROM {0} USING {0}_duplicates as d"
+                       " WHERE {0}.id = d.id".format(table))
+            merged = db.rowcount
+        LOG.info(_("Merged {0} duplicated rows of {1}".format(merged, table)))
+        return merged
+
+    def _move_metadata(self, chunk_size=10000):
+        """Move metadata of samples into sample_metadata.
+
+        Samples are migrated in chunks of ids, one transaction per chunk,
+        until less than a chunk was written meanwhile. The samples.metadata
+        column is dropped afterwards under a lock held only to move those
+        last samples, which gives up after `lock_timeout` instead of
+        queueing writes behind long readers. The space of the column is
+        given back only when the table is rewritten, e.g. by VACUUM FULL.
+        """
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("SELECT 1 FROM information_schema.columns"
+                       " WHERE table_name = 'samples'"
+                       " AND column_name = 'metadata'")
+            if not db.fetchone():
+                return
+        moved, last = self._samples_in_chunks(METADATA_MOVE, chunk_size)
+        while True:
+            with PoolConnection(self.conn_pool) as db:
+                db.execute("SELECT coalesce(max(id), 0) FROM samples")
+                end = db.fetchone()[0]
+            if end - last <= chunk_size:
+                break
+            count, last = self._samples_in_chunks(METADATA_MOVE, chunk_size,
+                                                  last, end)
+            moved += count
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("SET LOCAL lock_timeout = %s",
+                       (cfg.CONF.database.migration_lock_timeout * 1000,))
+            db.execute("LOCK TABLE samples IN ACCESS EXCLUSIVE MODE")
+            db.execute("SELECT coalesce(max(id), 0) FROM samples")
+            end = db.fetchone()[0]
+            if end > last:
+                for statement in METADATA_MOVE:
+                    db.execute(statement, {'start': last, 'end': end})
+                moved += db.rowcount
+            db.execute("ALTER TABLE samples DROP COLUMN metadata")
+        LOG.info(_("Moved metadata of {0} samples into sample_metadata"
+                   .format(moved)))
+
+    def _deduplicate_samples(self, chunk_size=10000):
+        """Delete redelivered samples before message ids are made unique.
+
+        The first written copy of every message is kept. Ids of duplicates
+        are streamed from one read of samples and deleted by chunks, one
+        transaction per chunk, so samples are not locked against writes.
+
+        :returns: the number of duplicates deleted
+        """
+        duplicates = psql_utils.stream_query(
+            self.conn_pool,
+            "SELECT id FROM ("
+            " SELECT id, row_number() OVER ("
+            "  PARTITION BY message_id ORDER BY id) as copy"
+            " FROM samples WHERE message_id IS NOT NULL) as s"
+            " WHERE copy > 1", None, chunk_size)
+        deleted = 0
+        chunk = []
+        for row in duplicates:
+            chunk.append(row.id)
+            if len(chunk) < chunk_size:
+                continue
+            deleted += self._delete_samples(chunk)
+            chunk = []
+        if chunk:
+            deleted += self._delete_samples(chunk)
+        LOG.info(_("Deleted {0} duplicated samples".format(deleted)))
+        return deleted
+
+    def _delete_samples(self, ids):
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("DELETE FROM samples WHERE id = ANY(%s)", (ids,))
+            return db.rowcount
 
     @staticmethod
     def _retrieve_sample(s):
@@ -181,10 +1696,39 @@ class Connection(base.Connection):
         return functions
 
     @staticmethod
-    def _make_stats_query(sample_filter, groupby, aggregate):
+    def _stats_joins(groupby):
+        """Return the joins statistics grouped by `groupby` need.
+
+        Meters provide the unit, the other dimensions are joined only to
+        be grouped by, filters compare ids of samples columns.
+        """
+        tables = ['meters'] + [ID_UUID_NAME_CONFORMITY[g].split('.')[0]
+                               for g in groupby or ()]
+        return ''.join(DIMENSION_JOINS[t] for t in tables)
+
+    @staticmethod
+    def _make_stats_query(sample_filter, groupby, aggregate, period=None,
+                          start=None, end=None, resolver=None):
+        """Return the statistics query and its values.
+
+        With a period, statistics are grouped by the number of the period
+        since `start` as `bucket` too, and only samples in [start, end) are
+        taken into account. Dimensions filtered on are resolved into ids by
+        the DimensionResolver, if any.
+        """
         sql_select = ("SELECT min(samples.timestamp) as tsmin,"
                       " max(samples.timestamp) as tsmax,"
                       " meters.unit as unit")
+        select_values = []
+        if period:
+            sql_select += (", floor(extract(epoch from samples.timestamp - %s)"
+                           " / %s)::bigint as bucket")
+            select_values.extend([start, period])
+            sample_filter = copy.copy(sample_filter)
+            sample_filter.start = start
+            sample_filter.start_timestamp_op = 'ge'
+            sample_filter.end = end
+            sample_filter.end_timestamp_op = 'lt'
         aggr = Connection._get_aggregate_functions(aggregate)
         for a in aggr:
             sql_select += ", {}".format(a)
@@ -195,21 +1739,159 @@ class Connection(base.Connection):
                 ID_UUID_NAME_CONFORMITY[g], g)
                 for g in groupby])
             sql_select += ', {}'.format(group_attributes)
-        sql_select += (" FROM samples"
-                       " JOIN resources ON samples.resource_id = resources.id"
-                       " JOIN meters ON samples.meter_id = meters.id"
-                       " JOIN sources ON samples.source_id = sources.id"
-                       " JOIN projects ON samples.project_id = projects.id"
-                       " JOIN users ON samples.user_id = users.id")
+        sql_select += " FROM samples" + Connection._stats_joins(groupby)
         sql_select, values = psql_utils.make_sql_query_from_filter(
-            sql_select, sample_filter)
+            sql_select, sample_filter, resolver=resolver)
         sql_select += " GROUP BY meters.unit"
         if groupby:
             group_attributes = ', '.join([ID_UUID_NAME_CONFORMITY[g]
                                           for g in groupby])
             sql_select += ', {}'.format(group_attributes)
+        if period:
+            sql_select += ", bucket ORDER BY bucket"
         sql_select += ";"
-        return sql_select, values
+        return sql_select, select_values + values
+
+    @staticmethod
+    def _rollup_size(sample_filter, aggregate, period, start, end):
+        """Return the bucket size of the rollups answering a query, or None.
+
+        With a period, rollup buckets must tile the periods starting at
+        `start`. Otherwise the coarsest rollup aligned to the time window is
+        taken, or the finest one, the unaligned edges being read from
+        samples.
+        """
+        if (sample_filter.metaquery or sample_filter.message_id or
+                sample_filter.start_timestamp_op == 'gt' or
+                sample_filter.end_timestamp_op == 'le'):
+            return None
+        if aggregate and any(a.func not in STANDARD_AGGREGATES or a.param
+                             for a in aggregate):
+            return None
+        epoch = datetime.datetime(1970, 1, 1)
+        offsets = [timeutils.delta_seconds(epoch, timeutils.normalize_time(t))
+                   for t in (start, end) if t]
+        for size in ROLLUP_SIZES:
+            if period:
+                if not period % size and not offsets[0] % size:
+                    return size
+            elif not any(offset % size for offset in offsets):
+                return size
+        return None if period else ROLLUP_SIZES[-1]
+
+    @staticmethod
+    def _make_stats_part(table, sample_filter, groupby, period, start,
+                         conditions=(), resolver=None):
+        """Return a query of partial statistics of samples or a rollup."""
+        sql_select = "SELECT {}".format(
+            ROLLUP_PARTIALS['samples' if table == 'samples' else 'rollup'])
+        select_values = []
+        if period:
+            sql_select += (", floor(extract(epoch from samples.timestamp - %s)"
+                           " / %s)::bigint as bucket")
+            select_values.extend([start, period])
+        if groupby:
+            sql_select += ''.join([', {} as {}'.format(
+                ID_UUID_NAME_CONFORMITY[g], g) for g in groupby])
+        sql_select += (" FROM {} as samples".format(table) +
+                       Connection._stats_joins(groupby))
+        sql_select, values = psql_utils.make_sql_query_from_filter(
+            sql_select, sample_filter, conditions=conditions,
+            resolver=resolver)
+        sql_select += " GROUP BY meters.unit"
+        if groupby:
+            sql_select += ''.join([', {}'.format(ID_UUID_NAME_CONFORMITY[g])
+                                   for g in groupby])
+        if period:
+            sql_select += ", bucket"
+        return sql_select, select_values + values
+
+    @staticmethod
+    def _make_rollup_stats_query(sample_filter, groupby, aggregate,
+                                 period=None, start=None, end=None,
+                                 resolver=None):
+        """Return the statistics query answered from rollups, or None.
+
+        Rollup buckets inside the time window are merged with the samples
+        of the unaligned edges of the window and with the samples past the
+        rollup watermark, late ones included. Arguments are those of
+        _make_stats_query.
+        """
+        if period:
+            sample_filter = copy.copy(sample_filter)
+            sample_filter.start = start
+            sample_filter.start_timestamp_op = 'ge'
+            sample_filter.end = end
+            sample_filter.end_timestamp_op = 'lt'
+        start, end = sample_filter.start, sample_filter.end
+        size = Connection._rollup_size(sample_filter, aggregate, period,
+                                       start, end)
+        if not size:
+            return None
+        epoch = datetime.datetime(1970, 1, 1)
+        first = last = None
+        if start:
+            start = timeutils.normalize_time(start)
+            first = epoch + datetime.timedelta(seconds=size * math.ceil(
+                timeutils.delta_seconds(epoch, start) / size))
+        if end:
+            end = timeutils.normalize_time(end)
+            last = epoch + datetime.timedelta(seconds=size * math.floor(
+                timeutils.delta_seconds(epoch, end) / size))
+        if first and last and first >= last:
+            return None
+
+        rollup_filter = copy.copy(sample_filter)
+        rollup_filter.start = first
+        rollup_filter.start_timestamp_op = 'ge'
+        rollup_filter.end = last
+        rollup_filter.end_timestamp_op = 'lt'
+        rollup, rollup_values = Connection._make_stats_part(
+            'rollup_{}'.format(size), rollup_filter, groupby, period, start,
+            resolver=resolver)
+
+        edges = ["samples.id > (SELECT last_sample_id"
+                 " FROM aggregation_watermarks WHERE name = 'rollup')"]
+        edge_values = []
+        if first:
+            edges.append("samples.timestamp < %s")
+            edge_values.append(first)
+        if last:
+            edges.append("samples.timestamp >= %s")
+            edge_values.append(last)
+        raw, raw_values = Connection._make_stats_part(
+            'samples', sample_filter, groupby, period, start,
+            [("({})".format(" OR ".join(edges)), edge_values)], resolver)
+
+        sql_select = "SELECT min(tsmin) as tsmin, max(tsmax) as tsmax, unit"
+        for a in aggregate or ():
+            sql_select += ", {}".format(ROLLUP_AGGREGATES[a.func])
+        if not aggregate:
+            sql_select += ''.join([", {}".format(a)
+                                   for a in ROLLUP_AGGREGATES.values()])
+        if groupby:
+            sql_select += ''.join([', {}'.format(g) for g in groupby])
+        if period:
+            sql_select += ", bucket"
+        sql_select += " FROM ({} UNION ALL {}) as partials".format(rollup, raw)
+        sql_select += " GROUP BY unit"
+        if groupby:
+            sql_select += ''.join([', {}'.format(g) for g in groupby])
+        if period:
+            sql_select += ", bucket ORDER BY bucket"
+        sql_select += ";"
+        return sql_select, rollup_values + raw_values
+
+    @staticmethod
+    def _stats_query(sample_filter, groupby, aggregate, period=None,
+                     start=None, end=None, resolver=None):
+        """Return the statistics query, answered from rollups if possible."""
+        return (Connection._make_rollup_stats_query(
+            sample_filter, groupby, aggregate, period, start, end,
+            resolver) or
+            Connection._make_stats_query(
+                sample_filter, groupby, aggregate, period, start, end,
+                resolver))
 
     @staticmethod
     def _stats_result_aggregates(result, aggregate):
@@ -242,6 +1924,137 @@ class Connection(base.Connection):
             (g, getattr(result, g)) for g in groupby) if groupby else None)
         return api_models.Statistics(**stats_args)
 
+    @staticmethod
+    def _shift_timestamp(data):
+        """Shift the naive utc sample timestamp to local time."""
+        if isinstance(data['timestamp'], datetime.datetime):
+            data['timestamp'] += datetime.timedelta(
+                seconds=(datetime.datetime.now() -
+                         datetime.datetime.utcnow()).seconds)
+
+    @staticmethod
+    def _dump_sample(data):
+        """Shift the sample timestamp to local time and dump it to JSON."""
+        Connection._shift_timestamp(data)
+        return json.dumps(data, ensure_ascii=False, default=dthandler)
+
+    def _resolve_dimensions(self, db, data, resolved):
+        """Return ids of the sample dimensions, cached ones where possible.
+
+        Ids looked up in the database are put into `resolved` and have to be
+        cached only after the transaction which may have created them is
+        committed. Without `db` only cached ids are returned, dimensions
+        depending on a missing one are left out too.
+        """
+        def get_id(name, key, values, cache=self._dimension_cache):
+            dim_id = resolved.get(key) or cache.get(key)
+            if dim_id is None and db is not None:
+                select, insert = DIMENSION_UPSERTS[name]
+                dim_id = psql_utils.upsert(db, select, insert, values)
+                resolved[key] = dim_id
+            return dim_id
+
+        ids = {}
+        source_id = ids['source_id'] = get_id(
+            'source_id', ('source', data['source']), [data['source']])
+        user_id = project_id = None
+        if data['user_id'] and source_id:
+            user_id = ids['user_id'] = get_id(
+                'user_id', ('user', data['user_id'], source_id),
+                [data['user_id'], source_id])
+        if source_id:
+            project_id = ids['project_id'] = get_id(
+                'project_id', ('project', data['project_id'], source_id),
+                [data['project_id'], source_id])
+        if project_id and user_id:
+            ids['resource_id'] = get_id(
+                'resource_id',
+                ('resource', data['resource_id'], user_id, project_id,
+                 source_id),
+                [data['resource_id'], user_id, project_id, source_id])
+        elif project_id and not data['user_id']:
+            ids['resource_id'] = get_id(
+                'resource_id_without_user',
+                ('resource', data['resource_id'], None, project_id,
+                 source_id),
+                [data['resource_id'], project_id, source_id])
+        ids['meter_id'] = get_id(
+            'meter_id',
+            ('meter', data['counter_name'], data['counter_type'],
+             data['counter_unit']),
+            [data['counter_name'], data['counter_type'],
+             data['counter_unit']])
+        metadata = json.dumps(data['resource_metadata'], sort_keys=True,
+                              separators=(',', ':'), default=dthandler)
+        ids['metadata_id'] = get_id(
+            'metadata_id',
+            ('metadata', hashlib.md5(metadata.encode('utf-8')).hexdigest()),
+            [metadata], self._metadata_cache)
+        return dict((name, dim_id) for name, dim_id in six.iteritems(ids)
+                    if dim_id is not None)
+
+    def _cache_resolved(self, resolved):
+        """Cache ids resolved by a committed transaction."""
+        for key, dim_id in six.iteritems(resolved):
+            if key[0] == 'metadata':
+                self._metadata_cache.put(key, dim_id)
+            else:
+                self._dimension_cache.put(key, dim_id)
+
+    def _with_dimension_ids(self, db, data, resolved):
+        """Return the sample with ids of its dimensions resolved.
+
+        write_sample skips the upserts of dimensions passed this way.
+        """
+        if not self._dimension_cache.maxsize:
+            return data
+        return dict(data, dimension_ids=self._resolve_dimensions(
+            db, data, resolved))
+
+    def _with_batch_dimension_ids(self, db, data, resolved):
+        """Return the sample of a batch with ids of its dimensions resolved.
+
+        Dimensions missed by the cache are upserted under a savepoint, so
+        a sample with an invalid dimension, e.g. a malformed uuid, raises
+        psycopg2.Error without aborting the transaction of the batch.
+        """
+        if not self._dimension_cache.maxsize:
+            return data
+        ids = self._resolve_dimensions(None, data, resolved)
+        required = (SAMPLE_DIMENSION_IDS | set(['user_id'])
+                    if data['user_id'] else SAMPLE_DIMENSION_IDS)
+        if required - set(ids):
+            sample_resolved = {}
+            db.execute('SAVEPOINT resolve_dimensions')
+            try:
+                ids = self._resolve_dimensions(db, data, sample_resolved)
+            except psycopg2.Error:
+                db.execute('ROLLBACK TO SAVEPOINT resolve_dimensions')
+                raise
+            db.execute('RELEASE SAVEPOINT resolve_dimensions')
+            resolved.update(sample_resolved)
+        return dict(data, dimension_ids=ids)
+
+    def _drop_duplicates(self, samples):
+        """Return the samples not written recently nor repeated."""
+        unique = []
+        seen = set()
+        for data in samples:
+            message_id = data.get('message_id')
+            if message_id is not None and (
+                    message_id in seen or
+                    self._recent_messages.get(message_id)):
+                self._duplicates['in_process'] += 1
+                continue
+            seen.add(message_id)
+            unique.append(data)
+        return unique
+
+    def _remember_messages(self, samples):
+        for data in samples:
+            if data.get('message_id') is not None:
+                self._recent_messages.put(data['message_id'], True)
+
     def record_metering_data(self, data):
         """Write the data to the backend storage system.
 
@@ -249,35 +2062,489 @@ class Connection(base.Connection):
                     ceilometer.meter.meter_message_from_counter
 
         All timestamps must be naive utc datetime object.
+        In write-behind mode the sample is only queued for writing.
+        A sample with a recently written message_id is dropped.
         """
+        if not self._drop_duplicates([data]):
+            return
+        if self._write_buffer:
+            self._write_buffer.put(data)
+            return
+        record = (self._record_typed
+                  if cfg.CONF.database.ingest_mode == 'typed'
+                  else self._record_json)
+        try:
+            record(dict(data))
+        except psycopg2.IntegrityError as e:
+            # NOTE: a cached dimension id may have been garbage collected
+            # after expiry, the sample is written again with fresh ids.
+            if e.pgcode != FOREIGN_KEY_VIOLATION:
+                raise
+            LOG.info(_("Cached dimension ids are stale, dropping them"))
+            self._dimension_cache.clear()
+            record(dict(data))
+
+    def _record_json(self, data):
+        """Write the sample through the write_sample server function."""
         time_before_method_start=datetime.datetime.utcnow()
-        dthandler = lambda obj: obj.isoformat() if isinstance(
-            obj, datetime.datetime) else None
-        recieved_datetime = data['timestamp']
-        data['timestamp'] = recieved_datetime + datetime.timedelta(
-            seconds=(datetime.datetime.now() - datetime.datetime.utcnow()).seconds)
-        d = json.dumps(data, ensure_ascii=False, default=dthandler)
-        LOG.debug(_("String from JSON: {}".format(d)))
-        time_before_sample_writing=datetime.datetime.utcnow()
+        resolved = {}
         with PoolConnection(self.conn_pool) as db:
-            db.execute('SELECT \"write_sample_debug\"(%s);', (d,))
+            data = self._with_dimension_ids(db, data, resolved)
+            d = self._dump_sample(data)
+            LOG.debug(_("String from JSON: {}".format(d)))
+            time_before_sample_writing=datetime.datetime.utcnow()
+            db.execute('SELECT write_sample(%s);', (d,))
+            written = db.fetchone()[0]
+            backfilled = (self._invalidate_backfilled(db, [data])
+                          if written else [])
+        self._drop_cached_stats(backfilled)
+        self._cache_resolved(resolved)
+        self._remember_messages([data])
+        if not written:
+            self._duplicates['database'] += 1
         time_after_sample_writing=datetime.datetime.utcnow()
         writing_time=time_after_sample_writing-time_before_sample_writing
         method_time=time_after_sample_writing-time_before_method_start
         LOG.debug(_("\n\nRecord_metering_data() with Sample with timestamp {0} was working for {1} seconds and {2} microseconds".format(data['timestamp'], method_time.seconds, method_time.microseconds)))
         LOG.debug(_("\n\nSample with timestamp {0} was writing for {1} seconds and {2} microseconds".format(data['timestamp'], writing_time.seconds, writing_time.microseconds)))
 
-    def clear_expired_metering_data(self, ttl):
+    def _record_typed(self, data):
+        """Write the sample with a prepared INSERT of typed parameters.
+
+        Only the resource metadata is dumped to JSON, to be hashed and
+        sent once per distinct content. The write_sample server function
+        is not involved.
+        """
+        self._shift_timestamp(data)
+        resolved = {}
+        with PoolConnection(self.conn_pool) as db:
+            ids = self._resolve_dimensions(db, data, resolved)
+            name, types, statement = SAMPLE_INSERT
+            psql_utils.execute_prepared(
+                db, name, types, statement,
+                (ids.get('user_id'), ids['project_id'], ids['resource_id'],
+                 ids['meter_id'], ids['source_id'], data['timestamp'],
+                 data['message_id'], data['message_signature'],
+                 data['counter_volume'], ids['metadata_id']))
+            written = db.rowcount
+            backfilled = (self._invalidate_backfilled(db, [data])
+                          if written else [])
+        self._drop_cached_stats(backfilled)
+        self._cache_resolved(resolved)
+        self._remember_messages([data])
+        if not written:
+            self._duplicates['database'] += 1
+
+    def record_metering_data_batch(self, samples):
+        """Write a batch of samples to the backend storage system.
+
+        The whole batch is sent in one round trip to the write_samples
+        server function, which writes every sample in the same transaction.
+        A sample that fails to be written does not abort the batch, nor
+        does one whose dimensions fail to be upserted. Samples with an
+        already written message_id are dropped. Samples failing on a
+        foreign key, e.g. a cached dimension id garbage collected since, are
+        written again once with fresh ids.
+
+        :param samples: a list of dictionaries such as returned by
+                        ceilometer.meter.meter_message_from_counter
+        :returns: a list of (sample, error) tuples for the samples that
+                  were not written
+        """
+        samples = self._drop_duplicates(samples)
+        if not samples:
+            return []
+        failures, stale = self._write_batch(samples)
+        if stale:
+            LOG.info(_("Cached dimension ids of {0} samples of the batch are"
+                       " stale, dropping them".format(len(stale))))
+            self._dimension_cache.clear()
+            retry_failures, stale = self._write_batch(
+                [data for data, error in stale])
+            failures.extend(retry_failures + stale)
+        LOG.debug(_("Batch of {0} samples written, {1} failed".format(
+            len(samples), len(failures))))
+        return failures
+
+    def _write_batch(self, samples):
+        """Write samples through write_samples in one transaction.
+
+        :returns: a list of (sample, error) tuples for the samples that
+                  were not written, and one for those failing on a foreign
+                  key
+        """
+        resolved = {}
+        stale = []
+        failures = []
+        batch = []
+        dumped = []
+        resp = []
+        with PoolConnection(self.conn_pool) as db:
+            for data in samples:
+                try:
+                    sample = self._with_batch_dimension_ids(db, data,
+                                                            resolved)
+                except psycopg2.Error as e:
+                    LOG.warning(_("Dimensions of a sample of the batch could"
+                                  " not be written: {0}".format(e)))
+                    if e.pgcode == FOREIGN_KEY_VIOLATION:
+                        stale.append((data, str(e)))
+                    else:
+                        failures.append((data, str(e)))
+                    continue
+                batch.append(data)
+                dumped.append(self._dump_sample(sample))
+            if batch:
+                db.execute('SELECT idx, error FROM write_samples(%s);',
+                           ('[{}]'.format(', '.join(dumped)),))
+                resp = db.fetchall()
+            skipped = set(res.idx for res in resp)
+            backfilled = self._invalidate_backfilled(
+                db, [s for i, s in enumerate(batch) if i not in skipped])
+        self._drop_cached_stats(backfilled)
+        self._cache_resolved(resolved)
+        failed = set()
+        for res in resp:
+            if res.error is None:
+                self._duplicates['database'] += 1
+                continue
+            LOG.warning(_("Sample {0} of the batch was not written: {1}"
+                          .format(res.idx, res.error)))
+            if 'foreign key' in res.error:
+                stale.append((batch[res.idx], res.error))
+            else:
+                failures.append((batch[res.idx], res.error))
+            failed.add(res.idx)
+        self._remember_messages(s for i, s in enumerate(batch)
+                                if i not in failed)
+        return failures, stale
+
+    def record_metering_data_bulk(self, samples):
+        """Load samples through the COPY protocol.
+
+        Samples are streamed into the unlogged samples_staging table and
+        merged into the dimension tables and samples with a few set-based
+        statements in one transaction. The per-sample write_sample path is
+        skipped entirely, loaded samples are accumulated into prebill by
+        aggregate_prebill like any others. Samples with an already written
+        message_id are skipped.
+
+        :param samples: an iterable of dictionaries such as returned by
+                        ceilometer.meter.meter_message_from_counter
+        :returns: the number of samples loaded
+        """
+        samples = self._drop_duplicates(samples)
+        buf = six.StringIO()
+        for data in samples:
+            self._shift_timestamp(data)
+            buf.write(psql_utils.make_copy_row((
+                data['source'],
+                data['user_id'] or None,
+                data['project_id'],
+                data['resource_id'],
+                data['counter_name'],
+                data['counter_type'],
+                data['counter_unit'],
+                data['counter_volume'],
+                data['timestamp'],
+                data['message_id'],
+                data['message_signature'],
+                json.dumps(data['resource_metadata'], ensure_ascii=False,
+                           default=dthandler))))
+        buf.seek(0)
+        started = time.time()
+        with PoolConnection(self.conn_pool) as db:
+            db.copy_expert(BULK_COPY, buf)
+            for statement in BULK_MERGE:
+                db.execute(statement)
+            db.execute(BULK_INSERT)
+            staged, loaded = db.fetchone()
+            db.execute(BULK_CLEANUP)
+            backfilled = self._invalidate_backfilled(db, samples)
+        self._drop_cached_stats(backfilled)
+        self._duplicates['database'] += staged - loaded
+        if staged < len(samples):
+            LOG.warning(_("{0} samples of the bulk load were not loaded,"
+                          " their dimensions were not found".format(
+                              len(samples) - staged)))
+        self._remember_messages(samples)
+        elapsed = time.time() - started
+        LOG.info(_("Bulk loaded {0} samples in {1:.3f} seconds"
+                   " ({2:.0f} rows/sec)".format(
+                       loaded, elapsed, loaded / elapsed if elapsed else 0)))
+        return loaded
+
+    def aggregate_prebill(self):
+        """Accumulate samples written since the last run into prebill.
+
+        Samples are processed by the aggregate_prebill server function in
+        batches of prebill_batch_size, one transaction per batch, until
+        the samples newer than prebill_settle_time are reached.
+
+        :returns: the number of samples processed
+        """
+        batch_size = cfg.CONF.database.prebill_batch_size
+        settle_time = datetime.timedelta(
+            seconds=cfg.CONF.database.prebill_settle_time)
+        total = 0
+        while True:
+            with PoolConnection(self.conn_pool) as db:
+                db.execute('SELECT processed, refdata_lookups'
+                           ' FROM aggregate_prebill(%s, %s);',
+                           (batch_size, settle_time))
+                processed, lookups = db.fetchone()
+            total += processed
+            self._prebill_stats['runs'] += 1
+            self._prebill_stats['samples'] += processed
+            self._prebill_stats['refdata_lookups'] += lookups
+            if processed < batch_size:
+                break
+        LOG.debug(_("{0} samples accumulated into prebill".format(total)))
+        return total
+
+    def refresh_rollups(self):
+        """Merge samples written since the last run into the rollups.
+
+        Samples are merged by the refresh_rollups server function in
+        batches of rollup_batch_size, one transaction per batch, until the
+        samples newer than rollup_settle_time are reached. Samples which
+        arrive late are merged into the buckets of their timestamps.
+
+        :returns: the number of samples merged
+        """
+        batch_size = cfg.CONF.database.rollup_batch_size
+        settle_time = datetime.timedelta(
+            seconds=cfg.CONF.database.rollup_settle_time)
+        total = 0
+        while True:
+            with PoolConnection(self.conn_pool) as db:
+                db.execute('SELECT refresh_rollups(%s, %s);',
+                           (batch_size, settle_time))
+                merged = db.fetchone()[0]
+            total += merged
+            if merged < batch_size:
+                break
+        LOG.debug(_("{0} samples merged into rollups".format(total)))
+        return total
+
+    def refresh_image_roots(self):
+        """Rebuild the table of root base images of Glance images.
+
+        The table is kept up to date by triggers on the Glance image
+        tables, this is only needed after they were changed with the
+        triggers disabled.
+
+        :returns: the number of images in the table
+        """
+        with PoolConnection(self.conn_pool) as db:
+            db.execute('SELECT refresh_glance_image_roots();')
+            return db.fetchone()[0]
+
+    def rebuild_resource_summary(self):
+        """Rebuild the table of resource summaries.
+
+        Samples are merged into the table by chunks of ids without locking
+        them against writes, the trigger on samples merges the ones written
+        meanwhile. Summaries of resources without samples are deleted last.
+
+        :returns: the number of resources in the table
+        """
+        self._samples_in_chunks(RESOURCE_SUMMARY_REBUILD)
+        self._key_ranges_in_chunks('resource_summary', 'resource_id',
+                                   RESOURCE_SUMMARY_REPAIR)
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("SELECT count(*) FROM resource_summary")
+            rebuilt = db.fetchone()[0]
+        LOG.info(_("Rebuilt summaries of {0} resources".format(rebuilt)))
+        return rebuilt
+
+    def clear_expired_metering_data(self, ttl, progress=None):
         """Clear expired data from the backend storage system according to the
         time-to-live.
 
+        Samples are deleted in throttled chunks, dimension rows left
+        without references are deleted afterwards.
+
         :param ttl: Number of seconds to keep records for.
+        :param progress: optional callable getting the number of samples
+                         deleted so far and the fraction done
+        :returns: the number of samples deleted
 
         """
         date = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
-        query = "DELETE FROM samples WHERE samples.timestamp < %s;"
+        self.create_samples_partitions()
+        # NOTE: with partitioned samples only the partition holding the
+        # expiry date is left to be deleted from.
+        self._drop_expired_partitions(date)
+        deleted = self._delete_expired_samples(date, progress)
+        # NOTE: rows of the tables maintained by the triggers on samples
+        # are locked by chunks only, so writers are not held up.
+        self._key_ranges_in_chunks('meter_resource_latest', 'meter_id',
+                                   LATEST_REPAIR)
+        self._key_ranges_in_chunks('resource_summary', 'resource_id',
+                                   RESOURCE_SUMMARY_EXPIRE, {'date': date})
+        self._key_ranges_in_chunks('meters', 'id', ROLLUPS_EXPIRE,
+                                   {'date': date})
+        collected = self.collect_orphan_dimensions()
+        self.invalidate_statistics_cache()
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("DELETE FROM statistics_invalidations"
+                       " WHERE created_at < now() - interval '1 day'")
+        LOG.info(_("Expired {0} samples older than {1}, collected {2}"
+                   " unreferenced dimension rows".format(
+                       deleted, date, sum(collected.values()))))
+        return deleted
+
+    def _delete_expired_samples(self, date, progress=None):
+        """Delete samples older than `date` in chunks of id ranges.
+
+        Every chunk is a transaction of its own, followed by a pause of
+        expiry_chunk_sleep seconds. The id range of a chunk is halved when
+        the chunk takes longer than expiry_chunk_time or deletes more than
+        expiry_chunk_size samples, and doubled when it is well within both.
+
+        :param progress: optional callable getting the number of samples
+                         deleted so far and the fraction of the ids done
+        :returns: the number of samples deleted
+        """
+        conf = cfg.CONF.database
         with PoolConnection(self.conn_pool) as db:
-            db.execute(query, [date])
+            db.execute("SELECT min(id), max(id) FROM samples"
+                       " WHERE timestamp < %s", (date,))
+            first, last = db.fetchone()
+        if first is None:
+            return 0
+        deleted = 0
+        span = conf.expiry_chunk_size
+        start = first
+        reported = time.time()
+        while start <= last:
+            end = min(start + span, last + 1)
+            started = time.time()
+            with PoolConnection(self.conn_pool) as db:
+                db.execute("DELETE FROM samples"
+                           " WHERE id >= %s AND id < %s AND timestamp < %s",
+                           (start, end, date))
+                chunk = db.rowcount
+            elapsed = time.time() - started
+            deleted += chunk
+            start = end
+            if (elapsed > conf.expiry_chunk_time or
+                    chunk > conf.expiry_chunk_size):
+                span = max(span // 2, 1)
+            elif (elapsed < conf.expiry_chunk_time / 2 and
+                    chunk < conf.expiry_chunk_size // 2):
+                span *= 2
+            done = float(start - first) / (last + 1 - first)
+            if progress:
+                progress(deleted, done)
+            if time.time() - reported >= 10:
+                LOG.info(_("Deleted {0} expired samples, {1:.0%} done"
+                           .format(deleted, done)))
+                reported = time.time()
+            if start <= last and conf.expiry_chunk_sleep:
+                time.sleep(conf.expiry_chunk_sleep)
+        return deleted
+
+    def _key_ranges_in_chunks(self, table, column, statements, params=None):
+        """Run statements over chunks of ranges of a key column of a table.
+
+        Statements take the range as the `start` and `end` parameters,
+        besides `params`. Like the deletion of expired samples every chunk
+        is a transaction of its own followed by a pause of
+        expiry_chunk_sleep seconds, its range is halved when the chunk
+        takes longer than expiry_chunk_time and doubled when it takes less
+        than half of it.
+        """
+        conf = cfg.CONF.database
+        with PoolConnection(self.conn_pool) as db:
+            db.execute("SELECT min({0}), max({0}) FROM {1}".format(column,
+                                                                    table))
+            first, last = db.fetchone()
+        if first is None:
+            return
+        span = conf.expiry_chunk_size
+        start = first
+        while start <= last:
+            end = min(start + span, last + 1)
+            started = time.time()
+            with PoolConnection(self.conn_pool) as db:
+                for statement in statements:
+                    db.execute(statement, dict(params or {}, start=start,
+                                               end=end))
+            elapsed = time.time() - started
+            start = end
+            if elapsed > conf.expiry_chunk_time:
+                span = max(span // 2, 1)
+            elif elapsed < conf.expiry_chunk_time / 2:
+                span *= 2
+            if start <= last and conf.expiry_chunk_sleep:
+                time.sleep(conf.expiry_chunk_sleep)
+
+    def collect_orphan_dimensions(self):
+        """Delete resources, meters, users and projects without references.
+
+        Resources and meters are referenced by samples through
+        resource_summary and meter_resource_latest, users and projects
+        through resources, alarms and alarm changes. The foreign key
+        checks of deleted rows are served by indexes of samples leading with
+        the dimension id. Every table is collected in a transaction of its
+        own. A row referenced by a
+        concurrently written sample makes the collection of its table fail
+        and be retried by the next run. Writers holding its id in their
+        cache get a foreign key violation and resolve the ids again.
+
+        :returns: the number of rows deleted per table
+        """
+        collected = {}
+        references = dict((table, refs) for table, key, refs
+                          in DIMENSION_REFERENCES)
+        for table in COLLECTED_DIMENSIONS:
+            refs = [r for r in references[table] if r[0] != 'samples']
+            if table in SAMPLE_REFERENCES:
+                refs.append(SAMPLE_REFERENCES[table])
+            try:
+                with PoolConnection(self.conn_pool) as db:
+                    conditions = []
+                    for ref_table, ref_column in refs:
+                        db.execute("SELECT to_regclass(%s)", (ref_table,))
+                        if db.fetchone()[0] is None:
+                            continue
+                        conditions.append(
+                            "NOT EXISTS (SELECT 1 FROM {0}"
+                            " WHERE {0}.{1} = {2}.id)".format(
+                                ref_table, ref_column, table))
+                    if not conditions:
+                        continue
+                    db.execute("DELETE FROM {0} WHERE {1}".format(
+                        table, " AND ".join(conditions)))
+                    collected[table] = db.rowcount
+            except psycopg2.IntegrityError as e:
+                if e.pgcode != FOREIGN_KEY_VIOLATION:
+                    raise
+                LOG.warning(_("Unreferenced rows of {0} are not collected:"
+                              " {1}".format(table, e)))
+                collected[table] = 0
+        LOG.debug(_("Collected unreferenced dimension rows: {0}"
+                    .format(collected)))
+        return collected
+
+    def _query(self, query, values):
+        """Return rows of a read query.
+
+        With stream_results the rows are streamed through a server-side
+        cursor, a connection stays checked out until they are consumed.
+        Otherwise the query runs as its prepared template, a cursor cannot
+        be declared for EXECUTE.
+        """
+        if cfg.CONF.database.stream_results:
+            return psql_utils.stream_query(self.conn_pool, query, values,
+                                           cfg.CONF.database.stream_itersize)
+        with PoolConnection(self.conn_pool) as cur:
+            self._query_templates.execute(cur, query, values)
+            rows = cur.fetchall()
+            self._resolver.resolve_pending(cur)
+        return rows
 
     def get_users(self, source=None):
         """Return an iterable of user id strings.
@@ -323,11 +2590,43 @@ class Connection(base.Connection):
        :param end_timestamp_op: Optional timestamp end range operation.
        :param metaquery: Optional dict with metadata to match on.
        :param resource: Optional resource filter.
-       :param pagination: Optional pagination query.
+       :param pagination: Optional pagination query, its limit and its
+                          marker_value, a marker of get_resources_page,
+                          are applied.
        """
+        s_filter = storage.SampleFilter(user=user,
+                                        project=project,
+                                        source=source,
+                                        start=start_timestamp,
+                                        start_timestamp_op=start_timestamp_op,
+                                        end=end_timestamp,
+                                        end_timestamp_op=end_timestamp_op,
+                                        metaquery=metaquery,
+                                        resource=resource)
+        limit = after = None
         if pagination:
-            raise ceilometer.NotImplementedError('Pagination not implemented')
-
+            limit = getattr(pagination, 'limit', None)
+            marker = getattr(pagination, 'marker_value', None)
+            after = psql_utils.decode_marker(marker, 1) if marker else None
+        q = self._resources_query(s_filter, limit, after)
+        return (self._retrieve_resource(res) for res in self._query(*q))
+
+    def get_resources_page(self, limit, marker=None, user=None, project=None,
+                           source=None, start_timestamp=None,
+                           start_timestamp_op=None, end_timestamp=None,
+                           end_timestamp_op=None, metaquery={},
+                           resource=None):
+        """Return a page of resources and the marker of the next page.
+
+        Resources are ordered by their internal ids and every page seeks
+        past the last resource of the previous one on the resource index,
+        so all pages cost the same. Filters are the ones of get_resources.
+
+        :param limit: Number of resources in the page.
+        :param marker: Marker returned with the previous page.
+        :returns: a list of models.Resource instances and the marker of the
+                  next page, None after the last page
+        """
         s_filter = storage.SampleFilter(user=user,
                                         project=project,
                                         source=source,
@@ -337,74 +2636,64 @@ class Connection(base.Connection):
                                         end_timestamp_op=end_timestamp_op,
                                         metaquery=metaquery,
                                         resource=resource)
+        after = psql_utils.decode_marker(marker, 1) if marker else None
+        q = self._resources_query(s_filter, limit, after)
+        rows = list(self._query(*q))
+        next_marker = None
+        if len(rows) == limit:
+            next_marker = psql_utils.encode_marker(
+                [rows[-1].key_resource_id])
+        return [self._retrieve_resource(res) for res in rows], next_marker
 
-        resource_id = None
-        user_id = None
-        project_id = None
-        source_id = None
-
+    @staticmethod
+    def _retrieve_resource(res):
+        return api_models.Resource(
+            resource_id=res[0],
+            user_id=res[2],
+            project_id=res[3],
+            first_sample_timestamp=res[4],
+            last_sample_timestamp=res[5],
+            source=res[1],
+            metadata=res[6])
+
+    def _resources_query(self, s_filter, limit=None, after=None):
+        """Return the resources query and its values.
+
+        Resource, user, project and source filters are compared as the
+        ids of the dimension resolver, an unknown one matches no resources.
+        Without a time window
+        or a metaquery resources are read from resource_summary, otherwise
+        samples are aggregated per resource with the owners of its latest
+        sample. `after` is a one element list of the internal resource id
+        to seek past, the seek and the limit are applied before the
+        dimensions are joined so a page reads `limit` resources only.
+        """
+        summary = not (s_filter.start or s_filter.end or s_filter.metaquery)
         subq_values = []
-        samples_subq = ("SELECT resource_id, source_id, user_id, project_id,"
-                        " max(timestamp) as max_ts, min(timestamp) as min_ts,"
-                        " LAST(metadata) as metadata"
-                        " FROM samples")
-
-        if s_filter.resource:
-            resource_id_q = ("SELECT id FROM resources"
-                             " WHERE resource_id = %s")
-            with PoolConnection(self.conn_pool) as cur:
-                cur.execute(resource_id_q, (s_filter.resource,))
-                resource_resp = cur.fetchone()
-            if resource_resp:
-                resource_id = resource_resp[0]
-                samples_subq += " AND resource_id = %s"
-                subq_values.append(resource_id)
-            else:
-                LOG.debug(
-                    _("Resource from sample filter does not exist in DB"))
-                return tuple()
-
-        if s_filter.user:
-            user_id_q = ("SELECT id FROM users"
-                         " WHERE uuid = %s")
-            with PoolConnection(self.conn_pool) as cur:
-                cur.execute(user_id_q, (s_filter.user,))
-                user_resp = cur.fetchone()
-            if user_resp:
-                user_id = user_resp[0]
-                samples_subq += " AND user_id = %s"
-                subq_values.append(user_id)
-            else:
-                LOG.debug(_("User from sample filter does not exist in DB"))
-                return tuple()
-
-        if s_filter.project:
-            project_id_q = ("SELECT id FROM projects"
-                            " WHERE uuid = %s")
-            with PoolConnection(self.conn_pool) as cur:
-                cur.execute(project_id_q, (s_filter.project,))
-                project_resp = cur.fetchone()
-            if project_resp:
-                project_id = project_resp[0]
-                samples_subq += " AND project_id = %s"
-                subq_values.append(project_id)
-            else:
-                LOG.debug(_("Project from sample filter does not exist in DB"))
-                return tuple()
-
-        if s_filter.source:
-            source_name_q = ("SELECT id FROM sources"
-                             " WHERE name = %s")
-            with PoolConnection(self.conn_pool) as cur:
-                cur.execute(source_name_q, (s_filter.source,))
-                source_resp = cur.fetchone()
-            if source_resp:
-                source_id = source_resp[0]
-                samples_subq += " AND source_id = %s"
-                subq_values.append(source_id)
-            else:
-                LOG.debug(_("Source from sample filter does not exist in DB"))
-                return tuple()
+        if summary:
+            samples_subq = ("SELECT resource_id, source_id, user_id,"
+                            " project_id, last_timestamp as max_ts,"
+                            " first_timestamp as min_ts, metadata_id"
+                            " FROM resource_summary")
+        else:
+            samples_subq = ("SELECT resource_id,"
+                            " LAST(source_id ORDER BY timestamp)"
+                            " as source_id,"
+                            " LAST(user_id ORDER BY timestamp) as user_id,"
+                            " LAST(project_id ORDER BY timestamp)"
+                            " as project_id,"
+                            " max(timestamp) as max_ts,"
+                            " min(timestamp) as min_ts,"
+                            " LAST(metadata_id ORDER BY timestamp)"
+                            " as metadata_id"
+                            " FROM samples")
+
+        for attr, field in RESOURCE_FILTER_FIELDS:
+            value = getattr(s_filter, attr)
+            if value:
+                condition, values = self._resolver.condition(field, value)
+                samples_subq += " AND " + condition
+                subq_values.extend(values)
 
         if s_filter.start:
             ts_start = s_filter.start
@@ -427,34 +2716,36 @@ class Connection(base.Connection):
             samples_subq += " AND {}".format(q)
             subq_values.append(v)
 
-        samples_subq += (" GROUP BY resource_id, source_id,"
-                         " user_id, project_id")
+        if after:
+            samples_subq += " AND resource_id > %s"
+            subq_values.extend(after)
 
         samples_subq = samples_subq.replace(" AND", " WHERE", 1)
 
+        if not summary:
+            samples_subq += " GROUP BY resource_id"
+
+        if limit:
+            samples_subq += " ORDER BY resource_id LIMIT %s"
+            subq_values.append(limit)
+
         query = ("SELECT resources.resource_id as id, sources.name as source_name,"
                  " users.uuid as user_id, projects.uuid as project_id,"
-                 " max_ts, min_ts, metadata"
+                 " max_ts, min_ts, sample_metadata.metadata,"
+                 " samples.resource_id as key_resource_id"
                  " FROM ({}) as samples"
                  " JOIN resources ON samples.resource_id = resources.id"
-                 " JOIN users ON samples.user_id = users.id"
+                 " LEFT JOIN users ON samples.user_id = users.id"
                  " JOIN projects ON samples.project_id = projects.id"
-                 " JOIN sources ON samples.source_id = sources.id")
+                 " JOIN sources ON samples.source_id = sources.id"
+                 " LEFT JOIN sample_metadata"
+                 " ON samples.metadata_id = sample_metadata.id")
 
         query = query.format(samples_subq)
 
-        with PoolConnection(self.conn_pool) as cur:
-            cur.execute(query, subq_values)
-            resp = cur.fetchall()
-
-        return (api_models.Resource(
-            resource_id=res[0],
-            user_id=res[2],
-            project_id=res[3],
-            first_sample_timestamp=res[4],
-            last_sample_timestamp=res[5],
-            source=res[1],
-            metadata=res[6]) for res in resp)
+        if limit:
+            query += " ORDER BY key_resource_id"
+        return query, subq_values
 
     def get_meters(self, user=None, project=None, resource=None, source=None,
                    metaquery={}, pagination=None):
@@ -473,42 +2764,96 @@ class Connection(base.Connection):
                                         source=source,
                                         metaquery=metaquery,
                                         resource=resource)
-        subq = ("SELECT max(samples.id) as id"
-                " FROM samples"
-                " JOIN resources ON samples.resource_id = resources.id")
-        if resource:
-            subq += " WHERE resources.resource_id = %s"
-        subq += " GROUP BY samples.meter_id, resources.resource_id"
-
-        query = ("SELECT samples.meter_id, meters.name, meters.type, meters.unit,"
-                 " resources.resource_id, projects.uuid as project_id,"
-                 " sources.name as source_id, users.uuid as user_id"
-                 " FROM meters"
-                 " JOIN samples ON meters.id = samples.meter_id"
-                 " JOIN ({0}) as a ON samples.id = a.id"
-                 " JOIN resources ON samples.resource_id = resources.id"
-                 " LEFT JOIN users ON samples.user_id = users.id"
-                 " JOIN sources ON samples.source_id = sources.id"
-                 " JOIN projects ON samples.project_id = projects.id")
-        query, values = psql_utils.make_sql_query_from_filter(query,
-                                                              s_filter,
-                                                              require_meter=False)
-        if resource:
-            values = [resource] + values
-        query = query.format(subq)
-        query += " ORDER BY meter_id;"
-        with PoolConnection(self.conn_pool) as cur:
-            cur.execute(query, values)
-            res = cur.fetchall()
-        for row in res:
-            yield api_models.Meter(
-                name=row.name,
-                type=row.type,
-                unit=row.unit,
-                resource_id=row.resource_id,
-                project_id=row.project_id,
-                source=row.source_id,
-                user_id=row.user_id)
+        query, values = self._meters_query(s_filter)
+        for row in self._query(query, values):
+            yield self._retrieve_meter(row)
+
+    def get_meters_page(self, limit, marker=None, user=None, project=None,
+                        resource=None, source=None, metaquery={}):
+        """Return a page of meters and the marker of the next page.
+
+        Meters are ordered by meter and resource and every page seeks past
+        the last meter of the previous one, so all pages cost the same.
+        Filters are the ones of get_meters.
+
+        :param limit: Number of meters in the page.
+        :param marker: Marker returned with the previous page.
+        :returns: a list of model.Meter instances and the marker of the
+                  next page, None after the last page
+        """
+        s_filter = storage.SampleFilter(user=user,
+                                        project=project,
+                                        source=source,
+                                        metaquery=metaquery,
+                                        resource=resource)
+        after = psql_utils.decode_marker(marker, 2) if marker else None
+        query, values = self._meters_query(s_filter, limit, after)
+        rows = list(self._query(query, values))
+        next_marker = None
+        if len(rows) == limit:
+            next_marker = psql_utils.encode_marker(
+                [rows[-1].meter_id, rows[-1].resource_id])
+        return [self._retrieve_meter(row) for row in rows], next_marker
+
+    @staticmethod
+    def _retrieve_meter(row):
+        return api_models.Meter(
+            name=row.name,
+            type=row.type,
+            unit=row.unit,
+            resource_id=row.resource_id,
+            project_id=row.project_id,
+            source=row.source_id,
+            user_id=row.user_id)
+
+    @staticmethod
+    def _meters_query(s_filter, limit=None, after=None):
+        """Return the meters query and its values.
+
+        A meter is reported per meter and resource id with the owners of
+        its latest sample, read from meter_resource_latest. `after` is a
+        (meter id, resource id) pair to seek past.
+        """
+        conditions = []
+        values = []
+        if s_filter.user:
+            conditions.append('users.uuid = %s')
+            values.append(s_filter.user)
+        if s_filter.project:
+            conditions.append('projects.uuid = %s')
+            values.append(s_filter.project)
+        if s_filter.resource:
+            conditions.append('latest.resource_id = %s')
+            values.append(s_filter.resource)
+        if s_filter.source:
+            conditions.append('sources.name = %s')
+            values.append(s_filter.source)
+        if s_filter.metaquery:
+            q, v = psql_utils.apply_metaquery_filter(s_filter.metaquery,
+                                                     'latest.metadata_id')
+            conditions.append(q)
+            values.append(v)
+        if after:
+            conditions.append('(latest.meter_id, latest.resource_id)'
+                              ' > (%s, %s)')
+            values.extend(after)
+
+        query = ("SELECT latest.meter_id, meters.name, meters.type,"
+                 " meters.unit, latest.resource_id,"
+                 " projects.uuid as project_id, sources.name as source_id,"
+                 " users.uuid as user_id"
+                 " FROM meter_resource_latest as latest"
+                 " JOIN meters ON latest.meter_id = meters.id"
+                 " LEFT JOIN users ON latest.user_id = users.id"
+                 " JOIN sources ON latest.source_id = sources.id"
+                 " JOIN projects ON latest.project_id = projects.id")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY latest.meter_id, latest.resource_id"
+        if limit:
+            query += " LIMIT %s"
+            values.append(limit)
+        return query, values
 
     def get_samples(self, sample_filter, limit=None):
         """Return an iterable of model.Sample instances.
@@ -516,28 +2861,66 @@ class Connection(base.Connection):
         :param sample_filter: Filter.
         :param limit: Maximum number of results to return.
         """
-        query = ("SELECT sources.name as source_id,"
+        query, values = self._samples_query(sample_filter, limit,
+                                            resolver=self._resolver)
+        return (self._retrieve_sample(x) for x in self._query(query, values))
+
+    def get_samples_page(self, sample_filter, limit, marker=None):
+        """Return a page of samples and the marker of the next page.
+
+        Samples are ordered by timestamp and id and every page seeks past
+        the last sample of the previous one, so all pages cost the same
+        index range scan.
+
+        :param sample_filter: Filter.
+        :param limit: Number of samples in the page.
+        :param marker: Marker returned with the previous page.
+        :returns: a list of model.Sample instances and the marker of the
+                  next page, None after the last page
+        """
+        after = psql_utils.decode_marker(marker, 2) if marker else None
+        query, values = self._samples_query(sample_filter, limit, after,
+                                            self._resolver)
+        rows = list(self._query(query, values))
+        next_marker = None
+        if len(rows) == limit:
+            next_marker = psql_utils.encode_marker(
+                [rows[-1].timestamp.isoformat(), rows[-1].id])
+        return [self._retrieve_sample(x) for x in rows], next_marker
+
+    @staticmethod
+    def _samples_query(sample_filter, limit=None, after=None,
+                       resolver=None):
+        """Return the samples query and its values.
+
+        Samples are filtered, ordered and limited before the dimensions are
+        joined to the rows returned. `after` is a (timestamp, id) pair of a
+        sample to seek past. Dimensions filtered on are resolved into ids by
+        the DimensionResolver, if any.
+        """
+        conditions = []
+        if after:
+            conditions.append(
+                ('(samples.timestamp, samples.id) > (%s::timestamp, %s)',
+                 after))
+        query = ("SELECT " + SAMPLE_COLUMNS + " FROM samples")
+        query, values = psql_utils.make_sql_query_from_filter(
+            query, sample_filter, conditions=conditions, resolver=resolver)
+        query += " ORDER BY samples.timestamp, samples.id"
+        if limit:
+            query += " LIMIT %s"
+            values.append(limit)
+        query = ("SELECT samples.id, sources.name as source_id,"
                  " meters.name as counter_name,"
                  " meters.type as counter_type, meters.unit as counter_unit,"
                  " samples.volume as counter_volume,"
                  " users.uuid as user_id, projects.uuid as project_id,"
                  " resources.resource_id, samples.message_id,"
                  " samples.message_signature, samples.recorded_at,"
-                 " samples.metadata, samples.timestamp"
-                 " FROM samples"
-                 " JOIN meters ON samples.meter_id = meters.id"
-                 " LEFT JOIN users ON samples.user_id = users.id"
-                 " JOIN projects ON samples.project_id = projects.id"
-                 " JOIN resources ON samples.resource_id = resources.id"
-                 " JOIN sources ON samples.source_id = sources.id")
-        query, values = psql_utils.make_sql_query_from_filter(query,
-                                                              sample_filter,
-                                                              limit)
-        query += " ORDER BY samples.timestamp ASC;"
-        with PoolConnection(self.conn_pool) as cur:
-            cur.execute(query, values)
-            res = cur.fetchall()
-        return (self._retrieve_sample(x) for x in res)
+                 " sample_metadata.metadata, samples.timestamp"
+                 " FROM ({0}) as samples".format(query) + SAMPLE_JOINS +
+                 " ORDER BY samples.timestamp, samples.id")
+        return query, values
 
     def get_meter_statistics(self, sample_filter, period=None, groupby=None,
                              aggregate=None):
@@ -550,12 +2933,9 @@ class Connection(base.Connection):
                 if group not in ['user_id', 'project_id', 'resource_id']:
                     raise ceilometer.NotImplementedError('Unable to group by '
                                                          'these fields')
+        self._poll_stats_invalidations()
         if not period:
-            q, v = Connection._make_stats_query(
-                sample_filter, groupby, aggregate)
-            with PoolConnection(self.conn_pool) as db:
-                db.execute(q, v)
-                result = db.fetchall()
+            result = self._cached_stats(sample_filter, groupby, aggregate)
             if result:
                 for res in result:
                     yield Connection._stats_result_to_model(res, 0,
@@ -565,74 +2945,251 @@ class Connection(base.Connection):
                                                             aggregate)
             return
 
+        res = None
         if not sample_filter.start or not sample_filter.end:
-            q, v = Connection._make_stats_query(sample_filter, None, aggregate)
+            q, v = Connection._stats_query(sample_filter, None, aggregate,
+                                           resolver=self._resolver)
             with PoolConnection(self.conn_pool) as db:
-                db.execute(q, v)
+                self._query_templates.execute(db, q, v)
                 res = db.fetchone()
+                self._resolver.resolve_pending(db)
             if not res:
                     # NOTE(liusheng):The 'res' may be NoneType, because no
                     # sample has found with sample filter(s).
                 return
-        query, values = Connection._make_stats_query(
-            sample_filter, groupby, aggregate)
-            # HACK(jd) This is an awful method to compute stats by period, but
-            # since we're trying to be SQL agnostic we have to write portable
-            # code, so here it is, admire! We're going to do one request to get
-            # stats by period. We would like to use GROUP BY, but there's no
-            # portable way to manipulate timestamp in SQL, so we can't.
-        for period_start, period_end in base.iter_period(
-                sample_filter.start or res.tsmin,
-                sample_filter.end or res.tsmax,
-                period):
-            values_to_add = []
-            values_to_delete = []
-            if query.find(" samples.timestamp > %s") > -1:
-                query = query.replace(
-                    " samples.timestamp > %s", " samples.timestamp >= %s")
-            if query.find(" samples.timestamp <= %s"):
-                query = query.replace(
-                    " samples.timestamp <= %s", " samples.timestamp < %s")
-            if query.find(" samples.timestamp >= %s") == -1:
-                seq = [query[:query.index('GROUP BY') - 1],
-                       query[query.index('GROUP BY'):]]
-                query = ' AND samples.timestamp >= %s '.join(seq)
-            if query.find(" samples.timestamp < %s") == -1:
-                seq = [query[:query.index('GROUP BY') - 1],
-                       query[query.index('GROUP BY'):]]
-                query = ' AND samples.timestamp < %s '.join(seq)
-
-            if sample_filter.end and not sample_filter.start:
-                query = query.replace('AND samples.timestamp >= %s',
-                                      'AND samples.timestamp < %s')
-                query = query.replace('AND samples.timestamp < %s',
-                                      'AND samples.timestamp >= %s', 1)
-
+        # NOTE: samples are bucketed into periods by the database in a
+        # single query. Periods cover [start, end), end being the filter end
+        # or the end of the period of the last sample, as with iter_period.
+        start = sample_filter.start or res.tsmin
+        end = sample_filter.end
+        if not end:
+            periods = math.ceil(
+                timeutils.delta_seconds(start, res.tsmax) / float(period))
+            end = start + datetime.timedelta(seconds=periods * period)
+        results = self._period_stats(sample_filter, groupby, aggregate,
+                                     period, start, end)
+        for result in results:
+            period_start = start + datetime.timedelta(
+                seconds=result.bucket * period)
+            period_end = period_start + datetime.timedelta(seconds=period)
             if sample_filter.end and sample_filter.end < period_end:
                 period_end = sample_filter.end
-            for d in values:
-                if isinstance(d, datetime.datetime):
-                    values_to_delete.append(d)
-            for i in values_to_delete:
-                values.remove(i)
-            values_to_add.extend([period_start, period_end])
+            yield Connection._stats_result_to_model(
+                result=result,
+                period=int(timeutils.delta_seconds(period_start,
+                                                   period_end)),
+                period_start=period_start,
+                period_end=period_end,
+                groupby=groupby,
+                aggregate=aggregate
+            )
+
+    @staticmethod
+    def _naive_timestamp(timestamp):
+        if isinstance(timestamp, six.string_types):
+            timestamp = timeutils.parse_isotime(timestamp)
+        return timeutils.normalize_time(timestamp)
+
+    @staticmethod
+    def _stats_watermark():
+        """Return the end of the latest period whose statistics are cached."""
+        return datetime.datetime.now() - datetime.timedelta(
+            seconds=cfg.CONF.database.stats_cache_settle_time)
+
+    @staticmethod
+    def _stats_cache_key(sample_filter, period, start, groupby, aggregate):
+        """Return the statistics cache key of a normalized query.
+
+        Statistics of periods are keyed by the start the periods are
+        counted from, other ones by the whole time window.
+        """
+        metaquery = (json.dumps(sample_filter.metaquery, sort_keys=True,
+                                default=dthandler)
+                     if sample_filter.metaquery else None)
+        key = (sample_filter.meter, sample_filter.source, sample_filter.user,
+               sample_filter.project, sample_filter.resource,
+               sample_filter.message_id, metaquery,
+               tuple(sorted(groupby or ())),
+               tuple(sorted((a.func, a.param) for a in aggregate or ())),
+               period)
+        if period:
+            return key + (start,)
+        return key + (
+            sample_filter.start,
+            'gt' if sample_filter.start_timestamp_op == 'gt' else 'ge',
+            sample_filter.end,
+            'le' if sample_filter.end_timestamp_op == 'le' else 'lt')
+
+    def _invalidate_backfilled(self, db, samples):
+        """Record invalidations of the statistics changed by samples.
+
+        Samples older than the statistics watermark belong to periods
+        whose statistics may be cached by any driver already.
+
+        :returns: the names of the meters invalidated
+        """
+        watermark = self._stats_watermark()
+        backfilled = sorted(set(
+            data['counter_name'] for data in samples
+            if self._naive_timestamp(data['timestamp']) < watermark))
+        if backfilled:
+            db.execute(STATS_INVALIDATE, (backfilled,))
+        return backfilled
+
+    def _drop_cached_stats(self, meters=None):
+        """Drop cached statistics of the meters, or all of them."""
+        if meters is None:
+            self._stats_cache.clear()
+            return
+        if not meters:
+            return
+        meters = set(meters)
+        for key in self._stats_cache.keys():
+            if key[0] in meters:
+                self._stats_cache.pop(key)
+
+    def _poll_stats_invalidations(self):
+        """Apply invalidations of cached statistics made by any driver.
+
+        An invalidation may be committed after invalidations with greater
+        ids were polled, so the ones created since the previous poll, less
+        STATS_INVALIDATIONS_MARGIN, are read every time and the ones
+        already applied are skipped.
+        """
+        if self._stats_polled_at is not None and not len(self._stats_cache):
+            return
+        since = (self._stats_polled_at - STATS_INVALIDATIONS_MARGIN
+                 if self._stats_polled_at is not None else None)
+        with PoolConnection(self.conn_pool) as db:
+            db.execute(STATS_INVALIDATIONS, (since,))
+            invalidations = db.fetchall()
+        first_poll = since is None
+        self._stats_polled_at = invalidations[0].polled_at
+        for invalidation in invalidations:
+            if (invalidation.id is None or
+                    invalidation.id in self._stats_invalidations):
+                continue
+            self._stats_invalidations[invalidation.id] = (
+                invalidation.created_at)
+            if not first_poll:
+                self._drop_cached_stats(
+                    None if invalidation.meter is None
+                    else [invalidation.meter])
+        since = self._stats_polled_at - STATS_INVALIDATIONS_MARGIN
+        for invalidation_id, created_at in list(
+                self._stats_invalidations.items()):
+            if created_at <= since:
+                del self._stats_invalidations[invalidation_id]
+
+    def invalidate_statistics_cache(self, meters=None):
+        """Drop cached statistics of the meters, or all of them.
+
+        The invalidation is recorded in the database, so that the caches of
+        every driver using it are invalidated, e.g. after a backfill.
+
+        :param meters: optional list of meter names
+        """
+        with PoolConnection(self.conn_pool) as db:
+            db.execute(STATS_INVALIDATE, (meters or [None],))
+        self._drop_cached_stats(meters)
+
+    def _cached_stats(self, sample_filter, groupby, aggregate):
+        """Return statistics rows of a query without period.
 
+        Statistics of a time window ended stats_cache_settle_time ago are
+        cached.
+        """
+        key = None
+        if (self._stats_cache.maxsize > 0 and sample_filter.end and
+                sample_filter.end <= self._stats_watermark()):
+            key = self._stats_cache_key(sample_filter, None, None, groupby,
+                                        aggregate)
+            rows = self._stats_cache.get(key)
+            if rows is not None:
+                return rows
+        q, v = Connection._stats_query(sample_filter, groupby, aggregate,
+                                       resolver=self._resolver)
+        with PoolConnection(self.conn_pool) as db:
+            self._query_templates.execute(db, q, v)
+            rows = db.fetchall()
+            self._resolver.resolve_pending(db)
+        if key:
+            self._stats_cache.put(key, rows)
+        return rows
+
+    def _period_stats(self, sample_filter, groupby, aggregate, period, start,
+                      end):
+        """Return statistics rows of the periods in [start, end).
+
+        Statistics of the periods ended stats_cache_settle_time ago are
+        cached, only the periods after the cached ones are queried.
+        """
+        key = None
+        closed = skip = 0
+        cached_rows = []
+        if self._stats_cache.maxsize > 0:
+            closed = max(0, int(timeutils.delta_seconds(
+                start, min(end, self._stats_watermark())) // period))
+            key = self._stats_cache_key(sample_filter, period, start,
+                                        groupby, aggregate)
+            entry = self._stats_cache.get(key)
+            if entry:
+                cached_upto, cached_rows = entry
+                skip = min(cached_upto, closed)
+                cached_rows = [r for r in cached_rows if r.bucket < skip]
+                if cached_upto >= closed:
+                    key = None
+        rows = []
+        queried_start = start + datetime.timedelta(seconds=skip * period)
+        if queried_start < end:
+            query, values = Connection._stats_query(
+                sample_filter, groupby, aggregate, period, queried_start, end,
+                self._resolver)
             with PoolConnection(self.conn_pool) as db:
-                db.execute(query, values + values_to_add)
-                results = db.fetchall()
-            if results:
-                for result in results:
-                    yield Connection._stats_result_to_model(
-                        result=result,
-                        period=int(timeutils.delta_seconds(period_start,
-                                                           period_end)),
-                        period_start=period_start,
-                        period_end=period_end,
-                        groupby=groupby,
-                        aggregate=aggregate
-                    )
+                self._query_templates.execute(db, query, values)
+                rows = [r._replace(bucket=r.bucket + skip)
+                        for r in db.fetchall()]
+                self._resolver.resolve_pending(db)
+        rows = cached_rows + rows
+        if key and closed:
+            self._stats_cache.put(
+                key, (closed, [r for r in rows if r.bucket < closed]))
+        return rows
 
     def query_samples(self, filter_expr=None, orderby=None, limit=None):
+        """Return samples matching a complex query filter.
+
+        The filter, and the ordering and limit when they name samples
+        columns only, apply to samples before the dimensions are joined.
+        A filter on other fields is applied to the joined rows.
+        """
+        sample_query = "SELECT " + SAMPLE_COLUMNS + " FROM samples"
+        sample_values = []
+        values = []
+        sql_query = ''
+        if filter_expr:
+            try:
+                where, sample_values = psql_utils.transform_filter(
+                    filter_expr, pushdown=True, resolver=self._resolver)
+                sample_query += where
+            except KeyError:
+                sql_query, values = psql_utils.transform_filter(filter_expr)
+        sorted_samples = not sql_query and all(
+            isinstance(psql_utils.SAMPLE_FIELDS.get(x.keys()[0]),
+                       six.string_types) for x in orderby or ())
+        if orderby:
+            if sorted_samples:
+                sample_query += psql_utils.transform_orderby(
+                    [{'samples.' + psql_utils.SAMPLE_FIELDS[x.keys()[0]]:
+                      x.values()[0]} for x in orderby])
+            sql_query += psql_utils.transform_orderby(orderby)
+        if limit:
+            if sorted_samples:
+                sample_query += ' LIMIT %s'
+                sample_values.append(limit)
+            else:
+                sql_query += ' LIMIT %s'
+                values.append(limit)
         sql_query = ('SELECT * FROM ('
                      'SELECT samples.id as sam_id,'
                      ' meters.name as counter_name,'
@@ -642,28 +3199,33 @@ class Connection(base.Connection):
                      ' resources.resource_id,'
                      ' sources.name as source_id, users.uuid as user_id,'
                      ' projects.uuid as project_id,'
-                     ' samples.metadata as metadata,'
+                     ' sample_metadata.metadata as metadata,'
+                     ' samples.metadata_id,'
                      ' resources.id, samples.timestamp, samples.message_id,'
                      ' samples.message_signature, samples.recorded_at'
-                     ' FROM samples'
-                     ' JOIN meters ON samples.meter_id = meters.id'
-                     ' JOIN resources ON samples.resource_id = resources.id'
-                     ' LEFT JOIN users ON samples.user_id = users.id'
-                     ' JOIN projects ON samples.project_id = projects.id'
-                     ' JOIN sources ON samples.source_id = sources.id) as c')
-        values = []
-        if filter_expr:
-            sql_where_body, values = psql_utils.transform_filter(filter_expr)
-            sql_query += sql_where_body
-        if orderby:
-            sql_query += psql_utils.transform_orderby(orderby)
-        if limit:
-            sql_query += ' LIMIT %s'
-            values.append(limit)
-        with PoolConnection(self.conn_pool) as db:
-            db.execute(sql_query, values)
-            res = db.fetchall()
-        return (self._retrieve_sample(x) for x in res)
+                     ' FROM ({0}) as samples'.format(sample_query) +
+                     SAMPLE_JOINS + ') as c' + sql_query)
+        return (self._retrieve_sample(x)
+                for x in self._query(sql_query, sample_values + values))
+
+    def flush(self):
+        """Write the samples queued in write-behind mode."""
+        if self._write_buffer:
+            self._write_buffer.flush()
+
+    def get_driver_stats(self):
+        """Return counters of the driver caches, write buffer and prebill."""
+        stats = {'dimension_cache': self._dimension_cache.stats(),
+                 'metadata_cache': self._metadata_cache.stats(),
+                 'prebill': dict(self._prebill_stats),
+                 'recent_messages': self._recent_messages.stats(),
+                 'duplicates_dropped': dict(self._duplicates),
+                 'statistics_cache': self._stats_cache.stats(),
+                 'query_templates': self._query_templates.stats(),
+                 'dimension_resolver': self._resolver.stats()}
+        if self._write_buffer:
+            stats['write_buffer'] = self._write_buffer.stats()
+        return stats
 
     @staticmethod
     def clear():
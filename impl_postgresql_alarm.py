@@ -36,6 +36,7 @@ from urlparse import urlparse
 import ceilometer
 from ceilometer.alarm.storage import base
 from ceilometer.alarm.storage import models as alarm_api_models
+from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log
 from ceilometer import utils
 
@@ -43,6 +44,11 @@ import ceilometer.storage.postgresql.utils as psql_utils
 from ceilometer.storage.postgresql.utils import PoolConnection
 LOG = log.getLogger(__name__)
 
+cfg.CONF.import_opt('dimension_resolver_size',
+                    'ceilometer.storage.impl_postgresql', group='database')
+cfg.CONF.import_opt('dimension_resolver_ttl',
+                    'ceilometer.storage.impl_postgresql', group='database')
+
 AVAILABLE_CAPABILITIES = {
     'alarms': {'query': {'simple': False,
                          'complex': False},
@@ -93,6 +99,9 @@ class Connection(base.Connection):
 
     def __init__(self, url):
         self.conn_pool = self._get_connection_pool()
+        self._resolver = psql_utils.DimensionResolver(
+            cfg.CONF.database.dimension_resolver_size,
+            cfg.CONF.database.dimension_resolver_ttl)
 
     @staticmethod
     def _get_connection_pool():
@@ -157,11 +166,15 @@ class Connection(base.Connection):
             sql_query += ' AND enabled = %s'
             values.append(enabled)
         if user:
-            sql_query += ' AND users.uuid = %s'
-            values.append(user)
+            condition, condition_values = self._resolver.condition(
+                'user_id', user, 'alarm.user_id')
+            sql_query += ' AND ' + condition
+            values.extend(condition_values)
         if project:
-            sql_query += ' AND projects.uuid = %s'
-            values.append(project)
+            condition, condition_values = self._resolver.condition(
+                'project_id', project, 'alarm.project_id')
+            sql_query += ' AND ' + condition
+            values.extend(condition_values)
         if alarm_id:
             sql_query += ' AND alarm_id = %s'
             values.append(alarm_id)
@@ -172,6 +185,7 @@ class Connection(base.Connection):
         with PoolConnection(self.conn_pool, cursor_factory=DictCursor) as db:
             db.execute(sql_query, values)
             res = db.fetchall()
+            self._resolver.resolve_pending(db)
         return (self._row_to_alarm_model(alarm) for alarm in res)
 
     def delete_alarm(self, alarm_id):
@@ -256,11 +270,15 @@ class Connection(base.Connection):
         sql_query += ' WHERE alarm.alarm_id = %s'
         values.append(alarm_id)
         if on_behalf_of is not None:
-            sql_query += ' AND p2.uuid = %s'
-            values.append(on_behalf_of)
+            condition, condition_values = self._resolver.condition(
+                'project_id', on_behalf_of, 'alarm_change.on_behalf_of')
+            sql_query += ' AND ' + condition
+            values.extend(condition_values)
         if project is not None:
-            sql_query += ' AND p1.uuid = %s'
-            values.append(project)
+            condition, condition_values = self._resolver.condition(
+                'project_id', project, 'alarm_change.project_id')
+            sql_query += ' AND ' + condition
+            values.extend(condition_values)
         if type is not None:
             sql_query += ' AND alarm_change.type = %s'
             values.append(type)
@@ -279,6 +297,7 @@ class Connection(base.Connection):
         with PoolConnection(self.conn_pool) as db:
             db.execute(sql_query, values)
             res = db.fetchall()
+            self._resolver.resolve_pending(db)
         return (self._row_to_alarm_change_model(x) for x in res)
 
     def record_alarm_change(self, alarm_change):
@@ -382,7 +401,7 @@ class Connection(base.Connection):
             if project_resp:
                 project_id = project_resp.id
                 sql_query += " project_id = %s,"
-                values.append(alarm['project_id'])
+                values.append(project_id)
             else:
                 LOG.debug(_("Project does not exist in DB"))
                 return
@@ -423,14 +442,13 @@ class Connection(base.Connection):
         sql_query += ' WHERE alarm_id = %s'
         values.append(alarm['alarm_id'])
 
-    with PoolConnection(self.conn_pool) as db:
-        db.execute(sql_query, values)
-    # returns first Alarm object from generator
-    stored_alarm = self.get_alarms(alarm_id=alarm['alarm_id']).next()
-    LOG.debug(
-        _("/nStored alarm camed from get_alarms():\n{}\n".format(str(stored_alarm.as_dict()))))
-    return stored_alarm
-
+        with PoolConnection(self.conn_pool) as db:
+            db.execute(sql_query, values)
+        # returns first Alarm object from generator
+        stored_alarm = self.get_alarms(alarm_id=alarm['alarm_id']).next()
+        LOG.debug(_("Stored alarm came from get_alarms():\n{}\n".format(
+            str(stored_alarm.as_dict()))))
+        return stored_alarm
 
     @classmethod
     def get_capabilities(cls):
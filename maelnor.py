@@ -1,127 +1,51 @@
 import plpy
 jdata = ''
 SD = {}
+GD = {}
 
 
-create or replace function write_sample(jdata text) returns void as $$
+drop function if exists write_sample(text);
+create or replace function write_sample(jdata text) returns boolean as $$
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
-from plpy import spiexceptions
 from plpy import prepare as prep
-from dateutil import parser
 data = json.loads(jdata)
+dimension_ids = data.get('dimension_ids') or {}
 
 
 def upsert(upd, ins, field, data):
-    """ Upsert capabale function. Can do select-insert or update-insert,
-   depends on upd parameter"""
+    """ Upsert capabale function. Selects the row and inserts it if it is
+   missing, ins has to be INSERT ... ON CONFLICT DO UPDATE ... RETURNING,
+   so concurrent inserts of the same row never fail or duplicate it"""
     result = plpy.execute(upd, data)
     if not result:
-        with plpy.subtransaction():
-            try:
-                result = plpy.execute(ins, data)
-            except spiexceptions.UniqueViolation:
-                result = plpy.execute(upd, data)
+        result = plpy.execute(ins, data)
 
     return result[0][field]
 
 
-def fillBaseRefs():
-    brefs_sel = SD.setdefault('brefs_sel',
-                              prep("SELECT i.id as id, ip.value as base_id"
-                                   " FROM glance_images as i"
-                                   " LEFT OUTER JOIN ("
-                                   "  SELECT image_id, value"
-                                   "  FROM glance_image_properties"
-                                   "  WHERE name = 'base_image_ref') as ip"
-                                   " ON i.id = ip.image_id"))
-
-    result = plpy.execute(brefs_sel)
-    brefs = {}
-    for record in result:
-        brefs[record['id']] = record['base_id']
-
-    SD['brefs'] = brefs
-
-
-def checkBaseRef(rid):
-    bref_sel = SD.setdefault('bref_sel',
-                             prep("SELECT i.id as id, ip.value as base_id"
-                                  " FROM glance_images as i"
-                                  " LEFT OUTER JOIN ("
-                                  "  SELECT image_id, value"
-                                  "  FROM glance_image_properties"
-                                  "  WHERE image_id = $1"
-                                  "  AND name = 'base_image_ref') as ip"
-                                  " ON i.id = ip.image_id"
-                                  " WHERE i.id = $1", ['text']))
-    result = plpy.execute(bref_sel, [rid])
-    if result:
-        SD['brefs'][rid] = result[0]['base_id']
-        if result[0]['base_id']:
-            return result[0]['base_id']
-
-    return rid
+def dimension(name, upd, ins, data):
+    """ Returns id of the dimension, resolved by the collector if it was
+   passed within the sample, upserted otherwise"""
+    if name in dimension_ids:
+        return dimension_ids[name]
+    return upsert(upd, ins, 'id', data)
 
 
-def imageSuffix(rid):
-    def getBRef(ref):
-        if ref in SD['brefs']:
-            bref = SD['brefs'][ref]
-            return bref if bref else ref
-        else:
-            return checkBaseRef(ref)
-
-    result = rid
-    if "brefs" not in SD:
-        fillBaseRefs()
-    tmp = getBRef(result)
-    while tmp != result:
-        result = tmp
-        tmp = getBRef(result)
-    return "+%s" % result
-
-
-def fillVolumeTypes():
-    volts_sel = SD.setdefault('volts_sel',
-                              prep("SELECT id, name FROM volume_types"))
-    result = plpy.execute(volts_sel)
-    voltsuf = {}
-    for record in result:
-        voltsuf[record['id']] = '-sata' if 'sata' in record['name'] else ''
-
-    SD['voltsuf'] = voltsuf
-
-
-def checkVolumeType(volt):
-    volt_sel = SD.setdefault('volt_sel',
-                             prep("SELECT name FROM volume_types"
-                                  " WHERE id = $1", ['text']))
-    result = plpy.execute(volt_sel, [volt])
-    if result:
-        SD['voltsuf'][volt] = '-sata' if 'sata' in result[0]['name'] else ''
-        return SD['voltsuf'][volt]
-    else:
-        return ''
-
-
-def volumeSuffix(volt):
-    if volt in SD.setdefault('voltsuf', fillVolumeTypes()):
-        return SD['voltsuf'][volt]
-    else:
-        return checkVolumeType(volt)
-
 source_sel = SD.setdefault('source_sel',
                            prep("SELECT id FROM sources WHERE name = $1",
                                 ['text']))
 source_ins = SD.setdefault('source_ins',
                            prep("INSERT INTO sources (name) VALUES ($1)"
+                                " ON CONFLICT (name) DO UPDATE"
+                                " SET name = EXCLUDED.name"
                                 " RETURNING id", ['text']))
-source_id = upsert(source_sel, source_ins, 'id', [data['source']])
+source_id = dimension('source_id', source_sel, source_ins,
+                      [data['source']])
 if data['user_id']:
     user_sel = SD.setdefault('user_sel',
                              prep("SELECT id FROM users WHERE"
@@ -129,9 +53,13 @@ if data['user_id']:
                                   ['uuid', 'bigint']))
     user_ins = SD.setdefault('user_ins',
                              prep("INSERT INTO users (uuid, source_id)"
-                                  " VALUES ($1, $2) RETURNING id",
+                                  " VALUES ($1, $2)"
+                                  " ON CONFLICT (uuid, source_id) DO UPDATE"
+                                  " SET uuid = EXCLUDED.uuid"
+                                  " RETURNING id",
                                   ['uuid', 'bigint']))
-    user_id = upsert(user_sel, user_ins, 'id', [data['user_id'], source_id])
+    user_id = dimension('user_id', user_sel, user_ins,
+                        [data['user_id'], source_id])
 else:
     user_id = None
 
@@ -141,10 +69,13 @@ project_sel = SD.setdefault('project_sel',
                                  ['uuid', 'bigint']))
 project_ins = SD.setdefault('project_ins',
                             prep("INSERT INTO projects (uuid, source_id)"
-                                 " VALUES ($1, $2) RETURNING id",
+                                 " VALUES ($1, $2)"
+                                 " ON CONFLICT (uuid, source_id) DO UPDATE"
+                                 " SET uuid = EXCLUDED.uuid"
+                                 " RETURNING id",
                                  ['uuid', 'bigint']))
-project_id = upsert(project_sel, project_ins, 'id',
-                    [data['project_id'], source_id])
+project_id = dimension('project_id', project_sel, project_ins,
+                       [data['project_id'], source_id])
 
 resource_sel = SD.setdefault('resource_sel',
                              prep("SELECT id FROM resources WHERE "
@@ -155,10 +86,15 @@ resource_ins = SD.setdefault('resource_ins',
                              prep("INSERT INTO resources"
                                   " (resource_id, user_id, project_id,"
                                   " source_id)"
-                                  " VALUES ($1, $2, $3, $4) RETURNING id",
+                                  " VALUES ($1, $2, $3, $4)"
+                                  " ON CONFLICT (resource_id,"
+                                  " (COALESCE(user_id, 0)), project_id,"
+                                  " source_id) DO UPDATE"
+                                  " SET resource_id = EXCLUDED.resource_id"
+                                  " RETURNING id",
                                   ['text', 'bigint', 'bigint', 'bigint']))
-resource_id = upsert(resource_sel, resource_ins, 'id',
-                     [data['resource_id'], user_id, project_id, source_id])
+resource_id = dimension('resource_id', resource_sel, resource_ins,
+                        [data['resource_id'], user_id, project_id, source_id])
 
 meter_sel = SD.setdefault('meter_sel',
                           prep("SELECT id FROM meters WHERE "
@@ -166,71 +102,327 @@ meter_sel = SD.setdefault('meter_sel',
                                ['text', 'text', 'text']))
 meter_ins = SD.setdefault('meter_ins',
                           prep("INSERT INTO meters (name, type, unit)"
-                               " VALUES ($1, $2, $3) RETURNING id",
+                               " VALUES ($1, $2, $3)"
+                               " ON CONFLICT (name, type, unit) DO UPDATE"
+                               " SET name = EXCLUDED.name"
+                               " RETURNING id",
                                ['text', 'text', 'text']))
-meter_id = upsert(meter_sel, meter_ins, 'id', [data['counter_name'],
-                                               data['counter_type'],
-                                               data['counter_unit']])
+meter_id = dimension('meter_id', meter_sel, meter_ins,
+                     [data['counter_name'], data['counter_type'],
+                      data['counter_unit']])
+
+# Note: metadata is stored once per distinct content, keyed by the md5 of
+# its canonical jsonb text.
+metadata_sel = SD.setdefault('metadata_sel',
+                             prep("SELECT id FROM sample_metadata"
+                                  " WHERE hash = md5($1::jsonb::text)::uuid",
+                                  ['text']))
+metadata_ins = SD.setdefault('metadata_ins',
+                             prep("INSERT INTO sample_metadata"
+                                  " (hash, metadata) VALUES"
+                                  " (md5($1::jsonb::text)::uuid, $1::jsonb)"
+                                  " ON CONFLICT (hash) DO UPDATE"
+                                  " SET hash = EXCLUDED.hash"
+                                  " RETURNING id", ['text']))
+metadata_id = dimension('metadata_id', metadata_sel, metadata_ins,
+                        [json.dumps(data['resource_metadata'])])
 
 sample_ins = SD.setdefault('sample_ins',
                            prep("INSERT INTO samples (user_id, project_id,"
                                 " resource_id, meter_id, source_id, timestamp,"
                                 " message_id, message_signature, recorded_at,"
-                                " volume, metadata) VALUES ($1, $2, $3, $4,"
-                                " $5, $6, $7, $8, now(), $9, $10)",
+                                " volume, metadata_id) VALUES ($1, $2, $3, $4,"
+                                " $5, $6, $7, $8, now(), $9, $10)"
+                                " ON CONFLICT DO NOTHING",
                                 ['bigint', 'bigint', 'bigint', 'bigint',
                                  'bigint', 'timestamp', 'text', 'text',
-                                 'double precision', 'jsonb']))
-plpy.execute(sample_ins,
-             [user_id, project_id, resource_id, meter_id, source_id,
-              data['timestamp'], data['message_id'], data['message_signature'],
-              data['counter_volume'], json.dumps(data['resource_metadata'])])
-
-# aggregation \/ \/ \/ \/ \/
-counter_type = data['counter_type']
-if counter_type not in ['gauge', 'cumulative']:
-    return
-
-if data['counter_name'] == 'memory' and \
-   'state' in data['resource_metadata'] and \
-   data['resource_metadata']['state'] not in ['active', 'resized', 'paused']:
-    return
-
-if data['project_id'] is None or data['project_id'] == 'None':
-    return
-
-obj_id = data['resource_id']
-owner = ''
-volume = data['counter_volume']
-meter_name = data['counter_name'].replace('.', '-')
-# ASK: image_ref isn't always in sample metadata
-if meter_name.startswith('instance') and 'image_ref' in data['resource_metadata']:
-    meter_name += imageSuffix(data['resource_metadata']['image_ref'])
-elif meter_name.startswith('volume'):
-    meter_name += volumeSuffix(data['resource_metadata']['volume_type'])
-elif meter_name in ['cpu', 'memory']:  # subcounters
-    owner = obj_id
-    obj_id = obj_id + ':' + meter_name
-    if meter_name == 'cpu':
-        volume /= 1000000000.0  # nanoseconds
-elif meter_name == 'image-size' and \
-        'properties' in data['resource_metadata'] and \
-        'instance_uuid' in data['resource_metadata']['properties']:
-    owner = data['resource_metadata']['properties']['instance_uuid']
-    if '_backup_' in data['resource_metadata']['properties']['name']:
-        meter_name = 'backup-size'
-
-if 'event_type' in data['resource_metadata'] and \
-        'create' in data['resource_metadata']['event_type']:
-    event_type = 'start'
-elif 'event_type' in data['resource_metadata'] and \
-        'delete' in data['resource_metadata']['event_type']:
-    event_type = 'stop'
-else:
-    event_type = 'exists'
+                                 'double precision', 'bigint']))
+# Note: a sample with an already written message_id is a redelivery and is
+# silently skipped, false is returned for it.
+result = plpy.execute(sample_ins,
+                      [user_id, project_id, resource_id, meter_id, source_id,
+                       data['timestamp'], data['message_id'],
+                       data['message_signature'], data['counter_volume'],
+                       metadata_id])
+return result.nrows() == 1
+
+$$ language plpythonu;
+
+
+create or replace function write_samples(jdata text)
+returns table (idx integer, error text) as $$
+
+from plpy import prepare as prep
+
+# Note: samples with every dimension id resolved by the collector are
+# written with one INSERT ... SELECT over the batch, the others go through
+# write_sample to upsert their dimensions. Duplicated samples are reported
+# with a null error.
+resolved = ("(s.sample->'dimension_ids'->>'source_id' IS NOT NULL"
+            " AND s.sample->'dimension_ids'->>'project_id' IS NOT NULL"
+            " AND s.sample->'dimension_ids'->>'resource_id' IS NOT NULL"
+            " AND s.sample->'dimension_ids'->>'meter_id' IS NOT NULL"
+            " AND s.sample->'dimension_ids'->>'metadata_id' IS NOT NULL"
+            " AND (s.sample->>'user_id' IS NULL"
+            " OR s.sample->'dimension_ids'->>'user_id' IS NOT NULL))")
+batch_sel = SD.setdefault('batch_sel',
+                          prep("SELECT s.idx - 1 as idx, {0} as resolved,"
+                               " CASE WHEN NOT {0} THEN s.sample::text END"
+                               " as sample"
+                               " FROM jsonb_array_elements($1::jsonb)"
+                               " WITH ORDINALITY as s (sample, idx)"
+                               .format(resolved), ['text']))
+batch_ins = SD.setdefault('batch_ins',
+                          prep("WITH batch AS ("
+                               " SELECT s.idx - 1 as idx, s.sample,"
+                               " s.sample->'dimension_ids' as ids"
+                               " FROM jsonb_array_elements($1::jsonb)"
+                               " WITH ORDINALITY as s (sample, idx)"
+                               " WHERE s.idx - 1 = ANY($2)),"
+                               " written AS ("
+                               " INSERT INTO samples (user_id, project_id,"
+                               " resource_id, meter_id, source_id, timestamp,"
+                               " message_id, message_signature, recorded_at,"
+                               " volume, metadata_id)"
+                               " SELECT (ids->>'user_id')::bigint,"
+                               " (ids->>'project_id')::bigint,"
+                               " (ids->>'resource_id')::bigint,"
+                               " (ids->>'meter_id')::bigint,"
+                               " (ids->>'source_id')::bigint,"
+                               " (sample->>'timestamp')::timestamp,"
+                               " sample->>'message_id',"
+                               " sample->>'message_signature', now(),"
+                               " (sample->>'counter_volume')"
+                               "::double precision,"
+                               " (ids->>'metadata_id')::bigint"
+                               " FROM batch ORDER BY idx"
+                               " ON CONFLICT DO NOTHING"
+                               " RETURNING message_id)"
+                               " SELECT idx FROM batch"
+                               " WHERE sample->>'message_id' IS NOT NULL"
+                               " AND NOT EXISTS (SELECT 1 FROM written"
+                               " WHERE written.message_id ="
+                               " batch.sample->>'message_id')",
+                               ['text', 'integer[]']))
+write_one = SD.setdefault('write_one',
+                          prep("SELECT write_sample($1) as written",
+                               ['text']))
+failed = []
+
+
+def write_set(indexes):
+    """ Writes the samples in a subtransaction, a failing set is split in
+   halves until the failing samples are found and reported alone"""
+    try:
+        with plpy.subtransaction():
+            skipped = plpy.execute(batch_ins, [jdata, indexes])
+    except plpy.SPIError as e:
+        if len(indexes) == 1:
+            failed.append((indexes[0], str(e)))
+            return
+        half = len(indexes) // 2
+        write_set(indexes[:half])
+        write_set(indexes[half:])
+    else:
+        failed.extend((row['idx'], None) for row in skipped)
+
+
+unresolved = []
+indexes = []
+for row in plpy.execute(batch_sel, [jdata]):
+    if row['resolved']:
+        indexes.append(row['idx'])
+    else:
+        unresolved.append(row)
+if indexes:
+    write_set(indexes)
+
+# Note: every unresolved sample goes through write_sample in its own
+# subtransaction, so a bad sample is rolled back alone.
+for row in unresolved:
+    try:
+        with plpy.subtransaction():
+            result = plpy.execute(write_one, [row['sample']])
+    except plpy.SPIError as e:
+        failed.append((row['idx'], str(e)))
+    else:
+        if not result[0]['written']:
+            failed.append((row['idx'], None))
 
-timestamp = parser.parse(data['timestamp']).replace(microsecond=0)
-tenant_key = data['project_id']
+return failed
+
+$$ language plpythonu;
+
+
+drop function if exists aggregate_prebill(integer, interval);
+create or replace function aggregate_prebill(batch_size integer,
+                                             settle_time interval)
+returns table (processed integer, refdata_lookups integer) as $$
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import time
+from collections import OrderedDict
+from plpy import spiexceptions
+from plpy import prepare as prep
+from dateutil import parser
+
+# Note: samples are accumulated into prebill in the order of samples.id,
+# starting after the 'prebill' watermark. Samples recorded less than
+# settle_time ago are left for the next run, so that rows of still running
+# write transactions are not skipped.
+
+
+# Note: glance images and volume types are cached for the whole backend in
+# GD. The cache is reloaded when it is older than REFDATA_TTL seconds or when
+# the reference_data_version row, bumped by triggers on the reference tables,
+# has changed since it was loaded. Ids missing from the reference tables are
+# remembered for NEGATIVE_TTL seconds, so that samples of unknown images and
+# volume types do not query the tables one by one.
+REFDATA_TTL = 3600
+NEGATIVE_TTL = 300
+
+lookups = {'db': 0}
+
+
+def fillImageRoots():
+    roots_sel = SD.setdefault('roots_sel',
+                              prep("SELECT image_id, root_id"
+                                   " FROM glance_image_roots"))
+
+    lookups['db'] += 1
+    result = plpy.execute(roots_sel)
+    roots = {}
+    for record in result:
+        roots[record['image_id']] = record['root_id']
+    return roots
+
+
+def fillVolumeTypes():
+    volts_sel = SD.setdefault('volts_sel',
+                              prep("SELECT id, name FROM volume_types"))
+    lookups['db'] += 1
+    result = plpy.execute(volts_sel)
+    voltsuf = {}
+    for record in result:
+        voltsuf[record['id']] = '-sata' if 'sata' in record['name'] else ''
+    return voltsuf
+
+
+def refdata():
+    """ Returns the reference data cache of the backend, loading it when it
+   is missing, expired or outdated"""
+    version_sel = SD.setdefault('refdata_version_sel',
+                                prep("SELECT version"
+                                     " FROM reference_data_version"))
+    version = plpy.execute(version_sel)[0]['version']
+    cache = GD.get('refdata')
+    if cache is None or cache['version'] != version or \
+       time.time() - cache['loaded_at'] > REFDATA_TTL:
+        cache = {'version': version, 'loaded_at': time.time(),
+                 'roots': fillImageRoots(), 'voltsuf': fillVolumeTypes(),
+                 'missing': {}}
+        GD['refdata'] = cache
+    return cache
+
+
+def isMissing(kind, rid):
+    expires = cache['missing'].get((kind, rid))
+    if expires is None:
+        return False
+    if expires < time.time():
+        del cache['missing'][(kind, rid)]
+        return False
+    return True
+
+
+def setMissing(kind, rid):
+    cache['missing'][(kind, rid)] = time.time() + NEGATIVE_TTL
+
+
+def checkImageRoot(rid):
+    if isMissing('image', rid):
+        return rid
+    root_sel = SD.setdefault('root_sel',
+                             prep("SELECT root_id FROM glance_image_roots"
+                                  " WHERE image_id = $1", ['text']))
+    lookups['db'] += 1
+    result = plpy.execute(root_sel, [rid])
+    if result:
+        cache['roots'][rid] = result[0]['root_id']
+        return result[0]['root_id']
+    else:
+        setMissing('image', rid)
+
+    return rid
+
+
+def imageSuffix(rid):
+    # Note: glance_image_roots maps every image to the end of its
+    # base_image_ref chain, so no chain is walked here.
+    if rid in cache['roots']:
+        return "+%s" % cache['roots'][rid]
+    return "+%s" % checkImageRoot(rid)
+
+
+def checkVolumeType(volt):
+    if isMissing('volume_type', volt):
+        return ''
+    volt_sel = SD.setdefault('volt_sel',
+                             prep("SELECT name FROM volume_types"
+                                  " WHERE id = $1", ['text']))
+    lookups['db'] += 1
+    result = plpy.execute(volt_sel, [volt])
+    if result:
+        cache['voltsuf'][volt] = '-sata' if 'sata' in result[0]['name'] else ''
+        return cache['voltsuf'][volt]
+    else:
+        setMissing('volume_type', volt)
+        return ''
+
+
+def volumeSuffix(volt):
+    if volt in cache['voltsuf']:
+        return cache['voltsuf'][volt]
+    else:
+        return checkVolumeType(volt)
+
+
+watermark_sel = SD.setdefault('watermark_sel',
+                              prep("SELECT last_sample_id"
+                                   " FROM aggregation_watermarks"
+                                   " WHERE name = 'prebill' FOR UPDATE"))
+watermark_upd = SD.setdefault('watermark_upd',
+                              prep("UPDATE aggregation_watermarks"
+                                   " SET last_sample_id = $1"
+                                   " WHERE name = 'prebill'", ['bigint']))
+# Note: project ids are read back from projects.uuid, the tenant keys
+# written before from raw project ids are normalised to the same format by
+# upgrade.
+samples_sel = SD.setdefault('samples_sel',
+                            prep("SELECT samples.id, samples.timestamp,"
+                                 " samples.volume, sample_metadata.metadata,"
+                                 " samples.recorded_at < now() - $3"
+                                 " as settled,"
+                                 " meters.name as counter_name,"
+                                 " meters.type as counter_type,"
+                                 " resources.resource_id,"
+                                 " replace(projects.uuid::text, '-', '')"
+                                 " as project_id"
+                                 " FROM samples"
+                                 " JOIN meters ON samples.meter_id = meters.id"
+                                 " JOIN resources"
+                                 " ON samples.resource_id = resources.id"
+                                 " JOIN projects"
+                                 " ON samples.project_id = projects.id"
+                                 " LEFT JOIN sample_metadata"
+                                 " ON samples.metadata_id = sample_metadata.id"
+                                 " WHERE samples.id > $1"
+                                 " ORDER BY samples.id LIMIT $2",
+                                 ['bigint', 'integer', 'interval']))
 
 prebill_selfu = SD.setdefault('prebill_selfu',
                               prep("SELECT seq, volume, last_value,"
@@ -253,11 +445,11 @@ prebill_ins = SD.setdefault('prebill_ins',
                                  " event_type, stamp_start, stamp_end, volume,"
                                  " owner_key, tenant_key, counter_type,"
                                  " last_value, last_timestamp, updating) VALUES"
-                                 " ($1, $2, $3, $4, $4, $5, $6, $7, $8, $9,"
-                                 " $10, 0)",
-                                 ['text', 'text', 'event_type', 'timestamp', 'float',
-                                  'text', 'text', 'counter_type', 'float',
-                                  'timestamp']))
+                                 " ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10,"
+                                 " $11, 0)",
+                                 ['text', 'text', 'event_type', 'timestamp',
+                                  'timestamp', 'float', 'text', 'text',
+                                  'counter_type', 'float', 'timestamp']))
 prebill_get = SD.setdefault('prebill_get',
                             prep("SELECT last_value, last_timestamp"
                                  " FROM prebill"
@@ -270,9 +462,56 @@ prebill_get = SD.setdefault('prebill_get',
                                   'text']))
 
 
-def get_prev_val():
+def prebill_record(sample):
+    """ Returns prebill key, event type, owner, volume and timestamp of the
+   sample, or None if the sample is not billed"""
+    counter_type = sample['counter_type']
+    if counter_type not in ['gauge', 'cumulative']:
+        return None
+
+    metadata = json.loads(sample['metadata']) if sample['metadata'] else {}
+    if sample['counter_name'] == 'memory' and \
+       'state' in metadata and \
+       metadata['state'] not in ['active', 'resized', 'paused']:
+        return None
+
+    obj_id = sample['resource_id']
+    owner = ''
+    volume = sample['volume']
+    meter_name = sample['counter_name'].replace('.', '-')
+    # ASK: image_ref isn't always in sample metadata
+    if meter_name.startswith('instance') and 'image_ref' in metadata:
+        meter_name += imageSuffix(metadata['image_ref'])
+    elif meter_name.startswith('volume'):
+        meter_name += volumeSuffix(metadata['volume_type'])
+    elif meter_name in ['cpu', 'memory']:  # subcounters
+        owner = obj_id
+        obj_id = obj_id + ':' + meter_name
+        if meter_name == 'cpu':
+            volume /= 1000000000.0  # nanoseconds
+    elif meter_name == 'image-size' and \
+            'properties' in metadata and \
+            'instance_uuid' in metadata['properties']:
+        owner = metadata['properties']['instance_uuid']
+        if '_backup_' in metadata['properties']['name']:
+            meter_name = 'backup-size'
+
+    if 'event_type' in metadata and 'create' in metadata['event_type']:
+        event_type = 'start'
+    elif 'event_type' in metadata and 'delete' in metadata['event_type']:
+        event_type = 'stop'
+    else:
+        event_type = 'exists'
+
+    timestamp = parser.parse(sample['timestamp']).replace(microsecond=0)
+    key = (meter_name, obj_id, sample['project_id'], counter_type)
+    return key, event_type, owner, volume, timestamp
+
+
+def get_prev_val(key, event_type, owner, volume, timestamp):
     # Note (alexchadin): Get previous value and last timestamp
     # to calculate new value after previous row is collected (updating != 0).
+    meter_name, obj_id, tenant_key, counter_type = key
     result = plpy.execute(prebill_get, [meter_name, obj_id, tenant_key,
                                         counter_type, event_type, owner])
     if result:
@@ -284,41 +523,92 @@ def get_prev_val():
     return 0
 
 
-def calcValue(data):
-    last_value = data[0]['last_value']
-    cur_volume = data[0]['volume']
+def calcValue(row, counter_type, volume, timestamp):
+    last_value = row['last_value']
+    cur_volume = row['volume']
     if counter_type == 'cumulative':
         value = cur_volume + volume
         if last_value <= volume:
             value -= last_value
     else:
-        period = timestamp - parser.parse(data[0]['last_timestamp'])
-        #seconds = period.seconds + period.days * 24 * 3600
+        period = timestamp - row['last_timestamp']
         seconds = period.total_seconds()
         value = cur_volume + ((volume + last_value) / 2) * seconds
     return value
 
 
-with plpy.subtransaction():
+def accumulate(key, records):
+    """ Applies the samples of one prebill row in order, the same way they
+   would have been applied one by one, and writes the row once"""
+    meter_name, obj_id, tenant_key, counter_type = key
     result = plpy.execute(prebill_selfu,
                           [obj_id, meter_name, tenant_key, counter_type])
+    row = None
     if result:
-        value = calcValue(result)
-        plpy.execute(prebill_upd,
-                     [timestamp, value, volume, timestamp, result[0]['seq']])
-    else:
+        row = dict(result[0])
+        row['last_timestamp'] = parser.parse(row['last_timestamp'])
+
+    for event_type, owner, volume, timestamp in records:
+        if row:
+            row['volume'] = calcValue(row, counter_type, volume, timestamp)
+            row['last_value'] = volume
+            row['last_timestamp'] = timestamp
+            continue
+        value = volume if counter_type == 'cumulative' else \
+            get_prev_val(key, event_type, owner, volume, timestamp)
+        if event_type == 'exists':
+            row = {'seq': None, 'stamp_start': timestamp, 'owner': owner,
+                   'volume': value, 'last_value': volume,
+                   'last_timestamp': timestamp}
+            continue
         try:
-            value = volume if counter_type == 'cumulative' else get_prev_val()
-            plpy.execute(prebill_ins,
-                         [meter_name, obj_id, event_type, timestamp,
-                          value, owner, tenant_key, counter_type, volume,
-                          timestamp])
+            with plpy.subtransaction():
+                plpy.execute(prebill_ins,
+                             [meter_name, obj_id, event_type, timestamp,
+                              timestamp, value, owner, tenant_key,
+                              counter_type, volume, timestamp])
         except spiexceptions.UniqueViolation:
-            result = plpy.execute(prebill_selfu,
-                                  [obj_id, meter_name, tenant_key,
-                                   counter_type])
-            value = calcValue(result)
-            plpy.execute(prebill_upd,
-                         [timestamp, value, volume, timestamp, result[0]['seq']])
+            plpy.warning("Prebill row %s %s %s is already open"
+                         % (meter_name, obj_id, event_type))
+
+    if row is None:
+        return
+    if row['seq'] is None:
+        plpy.execute(prebill_ins,
+                     [meter_name, obj_id, 'exists', row['stamp_start'],
+                      row['last_timestamp'], row['volume'], row['owner'],
+                      tenant_key, counter_type, row['last_value'],
+                      row['last_timestamp']])
+    else:
+        plpy.execute(prebill_upd,
+                     [row['last_timestamp'], row['volume'],
+                      row['last_value'], row['last_timestamp'], row['seq']])
+
+
+cache = refdata()
+watermark = plpy.execute(watermark_sel)[0]['last_sample_id']
+last_id = None
+processed = 0
+groups = OrderedDict()
+for sample in plpy.execute(samples_sel, [watermark, batch_size, settle_time]):
+    if not sample['settled']:
+        break
+    last_id = sample['id']
+    processed += 1
+    try:
+        record = prebill_record(sample)
+    except Exception as e:
+        plpy.warning("Sample %s is not billed: %s" % (sample['id'], e))
+        continue
+    if record:
+        groups.setdefault(record[0], []).append(record[1:])
+
+for key, records in groups.items():
+    accumulate(key, records)
+
+if last_id is not None:
+    plpy.execute(watermark_upd, [last_id])
+
+return [(processed, lookups['db'])]
 
 $$ language plpythonu;
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+# Copyright © 2015 Servionica, LLC (I-Teco)
+#
+# Authors: Dmirty Kubatkin <kubatkin@servionica.ru>
+#          Alexander Chadin <joker946@gmail.com>
+#          Alexander Stavitsky <alexandr.stavitsky@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Maintenance commands for the PostgreSQL storage driver."""
+
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+from oslo.config import cfg
+
+from ceilometer.storage import impl_postgresql
+
+
+def _load_samples(paths):
+    """Yield samples from files holding a sample or a list of samples."""
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = [data]
+        for sample in data:
+            yield sample
+
+
+def bulk_load(conn, args):
+    loaded = 0
+    batch = []
+    started = time.time()
+    for sample in _load_samples(args.files):
+        batch.append(sample)
+        if len(batch) >= args.batch_size:
+            loaded += conn.record_metering_data_bulk(batch)
+            batch = []
+    if batch:
+        loaded += conn.record_metering_data_bulk(batch)
+    elapsed = time.time() - started
+    print('Loaded %d samples in %.3f seconds (%.0f rows/sec)'
+          % (loaded, elapsed, loaded / elapsed if elapsed else 0))
+
+
+def aggregate_prebill(conn, args):
+    while True:
+        started = time.time()
+        processed = conn.aggregate_prebill()
+        print('Accumulated %d samples into prebill in %.3f seconds'
+              % (processed, time.time() - started))
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+
+
+def refresh_rollups(conn, args):
+    while True:
+        started = time.time()
+        merged = conn.refresh_rollups()
+        print('Merged %d samples into rollups in %.3f seconds'
+              % (merged, time.time() - started))
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+
+
+def refresh_image_roots(conn, args):
+    print('Found root base images of %d images' % conn.refresh_image_roots())
+
+
+def rebuild_meter_latest(conn, args):
+    print('Rebuilt latest samples of %d meters and resources'
+          % conn.rebuild_meter_resource_latest())
+
+
+def rebuild_resource_summary(conn, args):
+    print('Rebuilt summaries of %d resources'
+          % conn.rebuild_resource_summary())
+
+
+def expire(conn, args):
+    def progress(deleted, done):
+        print('Deleted %d samples, %.0f%% done' % (deleted, done * 100))
+    started = time.time()
+    deleted = conn.clear_expired_metering_data(args.ttl, progress)
+    print('Expired %d samples in %.3f seconds'
+          % (deleted, time.time() - started))
+
+
+def invalidate_stats(conn, args):
+    conn.invalidate_statistics_cache(args.meter)
+    print('Invalidated cached statistics of %s'
+          % (', '.join(args.meter) if args.meter else 'all meters'))
+
+
+def create_partitions(conn, args):
+    print('Created %d samples partitions' % conn.create_samples_partitions())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--config-file',
+                        help='ceilometer configuration file')
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_bulk = subparsers.add_parser(
+        'bulk-load', help='load samples from JSON files with COPY')
+    parser_bulk.add_argument('files', nargs='+',
+                             help='JSON file with a sample or a list of them')
+    parser_bulk.add_argument('--batch-size', type=int, default=10000,
+                             help='samples loaded per transaction')
+    parser_bulk.set_defaults(func=bulk_load)
+
+    parser_prebill = subparsers.add_parser(
+        'aggregate-prebill', help='accumulate new samples into prebill')
+    parser_prebill.add_argument('--interval', type=float,
+                                help='keep running, every INTERVAL seconds')
+    parser_prebill.set_defaults(func=aggregate_prebill)
+
+    parser_rollups = subparsers.add_parser(
+        'refresh-rollups', help='merge new samples into statistics rollups')
+    parser_rollups.add_argument('--interval', type=float,
+                                help='keep running, every INTERVAL seconds')
+    parser_rollups.set_defaults(func=refresh_rollups)
+
+    parser_roots = subparsers.add_parser(
+        'refresh-image-roots', help='rebuild the root base images table')
+    parser_roots.set_defaults(func=refresh_image_roots)
+
+    parser_latest = subparsers.add_parser(
+        'rebuild-meter-latest',
+        help='rebuild the latest samples of meters and resources')
+    parser_latest.set_defaults(func=rebuild_meter_latest)
+
+    parser_summary = subparsers.add_parser(
+        'rebuild-resource-summary', help='rebuild the resource summaries')
+    parser_summary.set_defaults(func=rebuild_resource_summary)
+
+    parser_expire = subparsers.add_parser(
+        'expire', help='delete expired samples in throttled chunks')
+    parser_expire.add_argument('ttl', type=int,
+                               help='seconds to keep samples for')
+    parser_expire.set_defaults(func=expire)
+
+    parser_invalidate = subparsers.add_parser(
+        'invalidate-stats',
+        help='drop cached statistics of all driver instances, e.g. after'
+             ' a backfill')
+    parser_invalidate.add_argument('--meter', action='append',
+                                   help='meter name, may be repeated')
+    parser_invalidate.set_defaults(func=invalidate_stats)
+
+    parser_partitions = subparsers.add_parser(
+        'create-partitions', help='create the coming samples partitions')
+    parser_partitions.set_defaults(func=create_partitions)
+
+    args = parser.parse_args(argv)
+    cfg.CONF(['--config-file', args.config_file] if args.config_file else [],
+             project='ceilometer')
+    args.func(impl_postgresql.Connection(cfg.CONF), args)
+
+
+if __name__ == '__main__':
+    main()
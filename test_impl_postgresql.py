@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Tests of the helpers of the PostgreSQL driver which need no database."""
+
+import collections
+import datetime
+import unittest
+
+from ceilometer import storage
+from ceilometer.storage.postgresql import impl_postgresql
+from ceilometer.storage.postgresql import utils
+
+Connection = impl_postgresql.Connection
+Aggregate = collections.namedtuple('Aggregate', ['func', 'param'])
+
+
+def sample_filter(**kwargs):
+    kwargs.setdefault('meter', 'cpu_util')
+    return storage.SampleFilter(**kwargs)
+
+
+class RollupSizeTest(unittest.TestCase):
+
+    def test_aligned_window_takes_coarsest_rollup(self):
+        start = datetime.datetime(2014, 1, 1)
+        end = datetime.datetime(2014, 1, 3)
+        self.assertEqual(86400, Connection._rollup_size(
+            sample_filter(start=start, end=end), None, None, start, end))
+
+    def test_hour_aligned_window(self):
+        start = datetime.datetime(2014, 1, 1, 5)
+        end = datetime.datetime(2014, 1, 1, 9)
+        self.assertEqual(3600, Connection._rollup_size(
+            sample_filter(start=start, end=end), None, None, start, end))
+
+    def test_unaligned_window_takes_finest_rollup(self):
+        start = datetime.datetime(2014, 1, 1, 0, 30, 15)
+        end = datetime.datetime(2014, 1, 1, 10, 0, 30)
+        self.assertEqual(60, Connection._rollup_size(
+            sample_filter(start=start, end=end), None, None, start, end))
+
+    def test_period_tiled_by_rollups(self):
+        start = datetime.datetime(2014, 1, 1, 5)
+        self.assertEqual(3600, Connection._rollup_size(
+            sample_filter(), None, 7200, start, None))
+
+    def test_period_not_divided_by_any_rollup(self):
+        start = datetime.datetime(2014, 1, 1)
+        self.assertIsNone(Connection._rollup_size(
+            sample_filter(), None, 90, start, None))
+
+    def test_period_start_not_aligned(self):
+        start = datetime.datetime(2014, 1, 1, 0, 0, 30)
+        self.assertIsNone(Connection._rollup_size(
+            sample_filter(), None, 3600, start, None))
+
+    def test_gt_and_le_fall_back_to_samples(self):
+        start = datetime.datetime(2014, 1, 1)
+        end = datetime.datetime(2014, 1, 2)
+        for ops in ({'start_timestamp_op': 'gt'},
+                    {'end_timestamp_op': 'le'}):
+            self.assertIsNone(Connection._rollup_size(
+                sample_filter(start=start, end=end, **ops), None, None,
+                start, end))
+
+    def test_aggregate_with_param_falls_back_to_samples(self):
+        self.assertIsNone(Connection._rollup_size(
+            sample_filter(), [Aggregate('cardinality', 'resource_id')],
+            None, None, None))
+
+
+class RollupStatsQueryTest(unittest.TestCase):
+
+    def test_aligned_window(self):
+        start = datetime.datetime(2014, 1, 1)
+        end = datetime.datetime(2014, 1, 3)
+        query, values = Connection._make_rollup_stats_query(
+            sample_filter(start=start, end=end), None, None)
+        self.assertIn('rollup_86400', query)
+        self.assertIn(start, values)
+        self.assertIn(end, values)
+
+    def test_unaligned_window_edges_read_from_samples(self):
+        start = datetime.datetime(2014, 1, 1, 0, 30, 15)
+        end = datetime.datetime(2014, 1, 1, 10, 0, 30)
+        query, values = Connection._make_rollup_stats_query(
+            sample_filter(start=start, end=end), None, None)
+        self.assertIn('rollup_60', query)
+        self.assertIn(datetime.datetime(2014, 1, 1, 0, 31), values)
+        self.assertIn(datetime.datetime(2014, 1, 1, 10), values)
+        self.assertIn('samples.timestamp < %s', query)
+        self.assertIn('samples.timestamp >= %s', query)
+
+    def test_period_buckets(self):
+        start = datetime.datetime(2014, 1, 1)
+        end = datetime.datetime(2014, 1, 2)
+        query, values = Connection._make_rollup_stats_query(
+            sample_filter(), None, None, 3600, start, end)
+        self.assertIn('rollup_3600', query)
+        self.assertIn('ORDER BY bucket', query)
+
+    def test_period_not_divided_by_any_rollup(self):
+        start = datetime.datetime(2014, 1, 1)
+        end = datetime.datetime(2014, 1, 2)
+        self.assertIsNone(Connection._make_rollup_stats_query(
+            sample_filter(), None, None, 90, start, end))
+
+    def test_gt_falls_back_to_samples(self):
+        start = datetime.datetime(2014, 1, 1)
+        end = datetime.datetime(2014, 1, 2)
+        self.assertIsNone(Connection._make_rollup_stats_query(
+            sample_filter(start=start, start_timestamp_op='gt', end=end),
+            None, None))
+
+    def test_empty_window(self):
+        start = datetime.datetime(2014, 1, 1, 0, 0, 10)
+        end = datetime.datetime(2014, 1, 1, 0, 0, 50)
+        self.assertIsNone(Connection._make_rollup_stats_query(
+            sample_filter(start=start, end=end), None, None))
+
+
+class MemoryLRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        size = utils.approx_size('a') + utils.approx_size(1)
+        cache = utils.MemoryLRUCache(size * 2)
+        cache.put('a', 1)
+        cache.put('b', 1)
+        cache.get('a')
+        cache.put('c', 1)
+        self.assertEqual(['a', 'c'], sorted(cache.keys()))
+        self.assertEqual(size * 2, cache.bytes)
+
+    def test_entry_larger_than_cache_is_not_cached(self):
+        cache = utils.MemoryLRUCache(utils.approx_size('a'))
+        cache.put('a', 'x' * 1000)
+        self.assertEqual([], cache.keys())
+        self.assertEqual(0, cache.bytes)
+
+    def test_pop_and_clear_give_bytes_back(self):
+        cache = utils.MemoryLRUCache(1024 * 1024)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.pop('a')
+        self.assertEqual(utils.approx_size('b') + utils.approx_size(2),
+                         cache.bytes)
+        cache.clear()
+        self.assertEqual(0, cache.bytes)
+        self.assertEqual(0, len(cache))
+
+    def test_replaced_entry_is_counted_once(self):
+        cache = utils.MemoryLRUCache(1024 * 1024)
+        cache.put('a', 1)
+        cache.put('a', 2)
+        self.assertEqual(utils.approx_size('a') + utils.approx_size(2),
+                         cache.bytes)
+        self.assertEqual(2, cache.get('a'))
+
+    def test_disabled(self):
+        cache = utils.MemoryLRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class CompileQueryTest(unittest.TestCase):
+
+    def test_placeholders_numbered(self):
+        template = utils.compile_query(
+            "SELECT * FROM samples WHERE meter_id = %s AND volume > %s;")
+        self.assertEqual("SELECT * FROM samples WHERE meter_id = $1"
+                         " AND volume > $2", template.statement)
+        self.assertEqual(2, template.params)
+
+    def test_escaped_percent(self):
+        template = utils.compile_query(
+            "SELECT * FROM meters WHERE name LIKE 'cpu%%' AND unit = %s")
+        self.assertEqual("SELECT * FROM meters WHERE name LIKE 'cpu%'"
+                         " AND unit = $1", template.statement)
+        self.assertEqual(1, template.params)
+
+    def test_named_placeholders_not_compiled(self):
+        self.assertIsNone(utils.compile_query(
+            "SELECT * FROM samples WHERE id > %(start)s"))
+
+    def test_name_of_query_shape(self):
+        query = "SELECT * FROM samples WHERE meter_id = %s"
+        self.assertEqual(utils.compile_query(query).name,
+                         utils.compile_query(query + ';').name)
+        self.assertNotEqual(
+            utils.compile_query(query).name,
+            utils.compile_query(query + " AND volume > %s").name)
+
+
+class MarkerTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = ['2014-01-01T00:00:00', 42]
+        marker = utils.encode_marker(values)
+        self.assertEqual(values, utils.decode_marker(marker, 2))
+
+    def test_wrong_length(self):
+        marker = utils.encode_marker([1, 2])
+        self.assertRaises(utils.InvalidMarker, utils.decode_marker,
+                          marker, 3)
+
+    def test_garbage(self):
+        for marker in ('not a marker', utils.encode_marker({'a': 1})):
+            self.assertRaises(utils.InvalidMarker, utils.decode_marker,
+                              marker, 1)
+
+
+class PartitionStartTest(unittest.TestCase):
+
+    def test_day(self):
+        self.assertEqual(
+            datetime.datetime(2014, 1, 8),
+            Connection._partition_start(
+                datetime.datetime(2014, 1, 8, 13, 45), 'day'))
+
+    def test_week_starts_on_monday(self):
+        self.assertEqual(
+            datetime.datetime(2014, 1, 6),
+            Connection._partition_start(
+                datetime.datetime(2014, 1, 8, 13, 45), 'week'))
+        self.assertEqual(
+            datetime.datetime(2014, 1, 6),
+            Connection._partition_start(datetime.datetime(2014, 1, 6),
+                                        'week'))
+
+
+class StatsCacheKeyTest(unittest.TestCase):
+
+    def test_period_keyed_by_start_only(self):
+        start = datetime.datetime(2014, 1, 1)
+        one = Connection._stats_cache_key(
+            sample_filter(end=datetime.datetime(2014, 1, 2)), 3600, start,
+            None, None)
+        other = Connection._stats_cache_key(
+            sample_filter(end=datetime.datetime(2014, 1, 3)), 3600, start,
+            None, None)
+        self.assertEqual(one, other)
+
+    def test_window_and_ops(self):
+        start = datetime.datetime(2014, 1, 1)
+        end = datetime.datetime(2014, 1, 2)
+        default = Connection._stats_cache_key(
+            sample_filter(start=start, end=end), None, None, None, None)
+        explicit = Connection._stats_cache_key(
+            sample_filter(start=start, start_timestamp_op='ge', end=end,
+                          end_timestamp_op='lt'), None, None, None, None)
+        exclusive = Connection._stats_cache_key(
+            sample_filter(start=start, start_timestamp_op='gt', end=end),
+            None, None, None, None)
+        self.assertEqual(default, explicit)
+        self.assertNotEqual(default, exclusive)
+
+    def test_groupby_aggregate_and_metaquery_order(self):
+        one = Connection._stats_cache_key(
+            sample_filter(metaquery={'metadata.a': 1, 'metadata.b': 2}),
+            None, None, ['user_id', 'project_id'],
+            [Aggregate('max', None), Aggregate('min', None)])
+        other = Connection._stats_cache_key(
+            sample_filter(metaquery={'metadata.b': 2, 'metadata.a': 1}),
+            None, None, ['project_id', 'user_id'],
+            [Aggregate('min', None), Aggregate('max', None)])
+        self.assertEqual(one, other)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,7 +18,19 @@
 # under the License.
 
 
+import base64
+import collections
+import hashlib
+import json
+import re
+import sys
+import time
+import uuid
+import weakref
+
+import psycopg2
 import six
+from psycopg2.extensions import connection as _connection
 from psycopg2.extras import NamedTupleCursor
 from psycopg2.extras import Json
 
@@ -54,6 +66,316 @@ class PoolConnection(object):
         self._pool.put(self._conn)
 
 
+def stream_query(pool, query, values, itersize,
+                 cursor_factory=NamedTupleCursor):
+    """Yield rows of a query read through a server-side cursor.
+
+    Rows are fetched `itersize` at a time. The connection is checked out of
+    the pool until the generator is exhausted, closed or garbage collected.
+    """
+    conn = pool.get()
+    try:
+        cur = conn.cursor(name='stream_{0}'.format(uuid.uuid4().hex),
+                          cursor_factory=cursor_factory)
+        cur.execute(query, values)
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        try:
+            conn.rollback()
+        finally:
+            pool.put(conn)
+
+
+class LRUCache(object):
+
+    """Bounded mapping which evicts the least recently used keys.
+
+    Connections are shared by green threads only, so no locking is needed.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, items):
+        for key, value in six.iteritems(items):
+            self.put(key, value)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+def approx_size(value):
+    """Return the approximate memory size in bytes of nested containers."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v)
+                    for k, v in six.iteritems(value))
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(v) for v in value)
+    return size
+
+
+class MemoryLRUCache(LRUCache):
+
+    """LRU cache bounded by the approximate memory size of its entries.
+
+    `maxsize` is a number of bytes here.
+    """
+
+    def __init__(self, maxsize):
+        super(MemoryLRUCache, self).__init__(maxsize)
+        self.bytes = 0
+        self._sizes = {}
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.pop(key)
+        size = approx_size(key) + approx_size(value)
+        if size > self.maxsize:
+            return
+        self._data[key] = value
+        self._sizes[key] = size
+        self.bytes += size
+        while self.bytes > self.maxsize:
+            old_key, _value = self._data.popitem(last=False)
+            self.bytes -= self._sizes.pop(old_key)
+
+    def pop(self, key):
+        if key in self._data:
+            del self._data[key]
+            self.bytes -= self._sizes.pop(key)
+
+    def keys(self):
+        return list(self._data)
+
+    def clear(self):
+        super(MemoryLRUCache, self).clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    def stats(self):
+        stats = super(MemoryLRUCache, self).stats()
+        lookups = self.hits + self.misses
+        stats['bytes'] = self.bytes
+        stats['hit_ratio'] = float(self.hits) / lookups if lookups else 0.0
+        return stats
+
+
+def upsert(cur, select, insert, values):
+    """Select the id of a row or insert it.
+
+    The insert has to be INSERT ... ON CONFLICT DO UPDATE ... RETURNING id,
+    so a row inserted concurrently is returned instead of being duplicated.
+    """
+    cur.execute(select, values)
+    res = cur.fetchone()
+    if not res:
+        cur.execute(insert, values)
+        res = cur.fetchone()
+    return res[0]
+
+
+class PreparingConnection(_connection):
+
+    """Connection keeping the names of the statements prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# NOTE: names of the statements prepared on connections not made by
+# PreparingConnection, forgotten together with the connection.
+_prepared = weakref.WeakKeyDictionary()
+
+
+def _prepared_names(conn):
+    prepared = getattr(conn, 'prepared', None)
+    if prepared is None:
+        prepared = _prepared.setdefault(conn, set())
+    return prepared
+
+
+def execute_prepared(cur, name, types, statement, values):
+    """Execute a statement prepared once per connection.
+
+    `statement` refers to the parameters as $1, $2, ..., their types are
+    listed in `types`.
+    """
+    prepared = _prepared_names(cur.connection)
+    if name not in prepared:
+        cur.execute('PREPARE {0} ({1}) AS {2}'.format(
+            name, ', '.join(types), statement))
+        prepared.add(name)
+    cur.execute('EXECUTE {0} ({1})'.format(
+        name, ', '.join(['%s'] * len(types))), values)
+
+
+QueryTemplate = collections.namedtuple('QueryTemplate',
+                                       ['name', 'statement', 'params'])
+
+_PLACEHOLDER = re.compile('%[s%]')
+
+
+def compile_query(query):
+    """Return the template of a query built with %s placeholders, or None.
+
+    Placeholders become $1, $2, ..., the types of the parameters are left
+    to the server to infer from their use. Queries with named placeholders
+    are not compiled.
+    """
+    if '%(' in query:
+        return None
+    params = [0]
+
+    def placeholder(match):
+        if match.group() == '%%':
+            return '%'
+        params[0] += 1
+        return '${0}'.format(params[0])
+    statement = _PLACEHOLDER.sub(placeholder, query).rstrip().rstrip(';')
+    name = 'q_' + hashlib.md5(statement.encode('utf-8')).hexdigest()[:16]
+    return QueryTemplate(name, statement, params[0])
+
+
+class QueryTemplates(object):
+
+    """Read queries compiled once per shape and prepared on connections.
+
+    Query builders make the same text for filters of the same shape, the
+    fields set, their ops, the groupby and the aggregates, values being
+    parameters, so the text is the key of its template. Every connection
+    prepares a template on its first use and EXECUTEs it afterwards,
+    skipping parsing and, once the server settles on a generic plan,
+    planning.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._templates = LRUCache(maxsize)
+        self.prepares = 0
+        self.executes = 0
+
+    def get(self, query):
+        """Return the template of a query, False if it is not compilable."""
+        template = self._templates.get(query)
+        if template is None:
+            template = compile_query(query) or False
+            self._templates.put(query, template)
+        return template
+
+    @staticmethod
+    def _prepare(cur, template):
+        """Prepare a template, return False if the server rejects it.
+
+        The server may fail to infer the type of a parameter, the
+        transaction is then rolled back to before the PREPARE only.
+        """
+        savepoint = not cur.connection.autocommit
+        if savepoint:
+            cur.execute('SAVEPOINT prepare_template')
+        try:
+            cur.execute('PREPARE {0} AS {1}'.format(template.name,
+                                                    template.statement))
+        except psycopg2.ProgrammingError:
+            if savepoint:
+                cur.execute('ROLLBACK TO SAVEPOINT prepare_template')
+            return False
+        if savepoint:
+            cur.execute('RELEASE SAVEPOINT prepare_template')
+        return True
+
+    def execute(self, cur, query, values):
+        """Execute a query on the cursor through its prepared template."""
+        template = self.get(query) if self.maxsize > 0 else False
+        if (not template or len(values) != template.params or
+                any(isinstance(v, (tuple, dict)) for v in values)):
+            cur.execute(query, values)
+            return
+        prepared = _prepared_names(cur.connection)
+        if template.name not in prepared:
+            if len(prepared) >= self.maxsize:
+                # NOTE: templates evicted from the cache stay prepared on
+                # the connections, they are all dropped at once here.
+                cur.execute('DEALLOCATE ALL')
+                prepared.clear()
+            if not self._prepare(cur, template):
+                self._templates.put(query, False)
+                cur.execute(query, values)
+                return
+            prepared.add(template.name)
+            self.prepares += 1
+        if template.params:
+            cur.execute('EXECUTE {0} ({1})'.format(
+                template.name, ', '.join(['%s'] * template.params)), values)
+        else:
+            cur.execute('EXECUTE {0}'.format(template.name))
+        self.executes += 1
+
+    def stats(self):
+        stats = self._templates.stats()
+        stats.update(prepares=self.prepares, executes=self.executes)
+        return stats
+
+
+class InvalidMarker(ValueError):
+    """Raised for a pagination marker not made by encode_marker."""
+
+
+def encode_marker(values):
+    """Return an opaque pagination marker of the sort key values."""
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_marker(marker, length):
+    """Return the `length` sort key values of a pagination marker."""
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(str(marker)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise InvalidMarker('Invalid marker %s' % marker)
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidMarker('Invalid marker %s' % marker)
+    return values
+
+
 def make_metaquery(metastr, value):
     elements = metastr.split('.')[1:]
     if not elements:
@@ -67,70 +389,188 @@ def make_metaquery(metastr, value):
     return jsq
 
 
-def apply_metaquery_filter(metaquery):
+def apply_metaquery_filter(metaquery, column='samples.metadata_id'):
+    """Return the condition on the sample_metadata id `column` matching
+    the metaquery and its value.
+    """
     meta_filter = dict()
     for key, value in six.iteritems(metaquery):
         meta_filter.update(make_metaquery(key, value))
-    return ('metadata @> %s', Json(meta_filter))
+    return ('{0} IN (SELECT id FROM sample_metadata'
+            ' WHERE metadata @> %s)'.format(column), Json(meta_filter))
+
+
+# NOTE: columns of samples the sample fields of queries are compared with.
+# A (column, lookup) pair compares the dimension id column with the ids
+# the lookup, formatted with the operator, selects, so no join is needed.
+SAMPLE_FIELDS = {
+    'counter_name': ('meter_id', 'SELECT id FROM meters WHERE name {0} %s'),
+    'counter_type': ('meter_id', 'SELECT id FROM meters WHERE type {0} %s'),
+    'counter_unit': ('meter_id', 'SELECT id FROM meters WHERE unit {0} %s'),
+    'resource_id': ('resource_id',
+                    'SELECT id FROM resources WHERE resource_id {0} %s'),
+    'user_id': ('user_id', 'SELECT id FROM users WHERE uuid {0} %s'),
+    'project_id': ('project_id', 'SELECT id FROM projects WHERE uuid {0} %s'),
+    'source_id': ('source_id', 'SELECT id FROM sources WHERE name {0} %s'),
+    'counter_volume': 'volume',
+    'timestamp': 'timestamp',
+    'recorded_at': 'recorded_at',
+    'message_id': 'message_id',
+    'message_signature': 'message_signature',
+}
+# NOTE: sample filter attributes and the sample fields they match.
+SAMPLE_FILTER_FIELDS = (
+    ('meter', 'counter_name'),
+    ('source', 'source_id'),
+    ('user', 'user_id'),
+    ('project', 'project_id'),
+    ('resource', 'resource_id'),
+)
+
+
+class DimensionResolver(object):
+
+    """Resolves external ids of dimensions into their integer ids.
+
+    Dimensions are the sample fields of SAMPLE_FIELDS with a lookup. Ids,
+    and values without any, are cached for `ttl` seconds, so a dimension
+    row created meanwhile is found once the entry of its value expires.
+
+    A value missed by the cache is compared through the subselect of its
+    lookup, so a query stays one statement on one connection. Missed
+    values are resolved afterwards by resolve_pending on the connection
+    of the query.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.ttl = ttl
+        self._ids = LRUCache(maxsize)
+        self._pending = set()
+        self.lookups = 0
+
+    def cached(self, field, value):
+        """Return the cached sorted ids of a field value, None if missed."""
+        entry = self._ids.get((field, value))
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def resolve_pending(self, cur):
+        """Cache the ids of the values missed so far with one lookup."""
+        if not self._pending:
+            return
+        pending = sorted(self._pending)
+        self._pending.clear()
+        cur.execute(' UNION ALL '.join(
+            'SELECT {0} as n, id FROM ({1}) as ids'.format(
+                n, SAMPLE_FIELDS[field][1].format('='))
+            for n, (field, value) in enumerate(pending)),
+            [value for field, value in pending])
+        ids = [[] for _key in pending]
+        for row in cur.fetchall():
+            ids[row[0]].append(row[1])
+        self.lookups += 1
+        expiry = time.time() + self.ttl
+        for key, key_ids in zip(pending, ids):
+            self._ids.put(key, (expiry, sorted(key_ids)))
+
+    def condition(self, field, value, column=None):
+        """Return the condition matching the ids of a field value on
+        `column`, the samples column of the field by default, and its
+        values.
+        """
+        column = column or SAMPLE_FIELDS[field][0]
+        ids = self.cached(field, value)
+        if ids is None:
+            if len(self._pending) < self._ids.maxsize:
+                self._pending.add((field, value))
+            return ('{0} IN ({1})'.format(
+                column, SAMPLE_FIELDS[field][1].format('=')), [value])
+        return '{0} = ANY(%s)'.format(column), [ids]
+
+    def stats(self):
+        stats = self._ids.stats()
+        stats['lookups'] = self.lookups
+        stats['pending'] = len(self._pending)
+        return stats
+
+
+def sample_field_condition(field, op, prefix=''):
+    """Return the condition comparing a sample field with a value.
+
+    `prefix` qualifies the samples column. Fields without a samples column
+    raise KeyError.
+    """
+    column = SAMPLE_FIELDS[field]
+    if isinstance(column, tuple):
+        column, lookup = column
+        return '{0}{1} IN ({2})'.format(prefix, column, lookup.format(op))
+    return '{0}{1} {2} %s'.format(prefix, column, op)
 
 
 def make_sql_query_from_filter(query, sample_filter,
-                               limit=None, require_meter=True):
-    sql_where_body = ''
+                               limit=None, require_meter=True,
+                               conditions=(), resolver=None):
+    """Append the WHERE clause of the sample filter to the query.
+
+    Conditions apply to the samples columns, dimensions are not joined.
+    With a DimensionResolver dimension values are compared as their ids,
+    otherwise through subselects. `conditions` is a sequence of extra
+    (condition, values) pairs.
+    """
+    where = []
     sql_limit_body = ''
-    subq_and = ' AND {}'
     values = []
-    if sample_filter.meter:
-        sql_where_body += subq_and.format('meters.name = %s')
-        values.append(sample_filter.meter)
-    elif require_meter:
+    if not sample_filter.meter and require_meter:
         raise RuntimeError('Missing required meter specifier')
-    if sample_filter.source:
-        sql_where_body += subq_and.format('sources.name = %s')
-        values.append(sample_filter.source)
-    if sample_filter.user:
-        sql_where_body += subq_and.format('users.uuid = %s')
-        values.append(sample_filter.user)
-    if sample_filter.project:
-        sql_where_body += subq_and.format('projects.uuid = %s')
-        values.append(sample_filter.project)
-    if sample_filter.resource:
-        sql_where_body += subq_and.format('resources.resource_id = %s')
-        values.append(sample_filter.resource)
+    for attr, field in SAMPLE_FILTER_FIELDS:
+        value = getattr(sample_filter, attr)
+        if value and resolver:
+            condition, condition_values = resolver.condition(
+                field, value, 'samples.' + SAMPLE_FIELDS[field][0])
+            where.append(condition)
+            values.extend(condition_values)
+        elif value:
+            where.append(sample_field_condition(field, '=', 'samples.'))
+            values.append(value)
     if sample_filter.message_id:
-        sql_where_body += subq_and.format('samples.message_id = %s')
+        where.append('samples.message_id = %s')
         values.append(sample_filter.message_id)
     if sample_filter.metaquery:
         q, v = apply_metaquery_filter(sample_filter.metaquery)
-        sql_where_body += subq_and.format(q)
+        where.append(q)
         values.append(v)
     if sample_filter.start:
         ts_start = sample_filter.start
         if sample_filter.start_timestamp_op == 'gt':
-            sql_where_body += subq_and.format('samples.timestamp > %s')
+            where.append('samples.timestamp > %s')
         else:
-            sql_where_body += subq_and.format('samples.timestamp >= %s')
+            where.append('samples.timestamp >= %s')
         values.append(ts_start)
     if sample_filter.end:
         ts_end = sample_filter.end
         if sample_filter.end_timestamp_op == 'le':
-            sql_where_body += subq_and.format('samples.timestamp <= %s')
+            where.append('samples.timestamp <= %s')
         else:
-            sql_where_body += subq_and.format('samples.timestamp < %s')
+            where.append('samples.timestamp < %s')
         values.append(ts_end)
+    for condition, condition_values in conditions:
+        where.append(condition)
+        values.extend(condition_values)
     if limit:
         sql_limit_body = " LIMIT %s"
         values.append(limit)
-    sql_where_body = sql_where_body.replace(' AND', ' WHERE', 1)
-    query = query + sql_where_body + sql_limit_body
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += sql_limit_body
     return query, values
 complex_operators = ['and', 'or', 'not']
 
 
-def _handle_complex_op(complex_op, nodes, values):
+def _handle_complex_op(complex_op, nodes, values, pushdown, resolver):
     items = []
     for node in nodes:
-        node_str = _transform_filter(node, values)
+        node_str = _transform_filter(node, values, pushdown, resolver)
         items.append(node_str)
     if complex_op == 'or':
         return '(' + ' {} '.format(complex_op).join(items) + ')'
@@ -138,27 +578,42 @@ def _handle_complex_op(complex_op, nodes, values):
         return ' {} '.format(complex_op).join(items)
 
 
-def _handle_simple_op(simple_op, nodes, values):
-    if nodes.keys()[0].startswith('resource_metadata'):
-        q, v = apply_metaquery_filter(nodes)
+def _handle_simple_op(simple_op, nodes, values, pushdown, resolver):
+    field, value = nodes.keys()[0], nodes.values()[0]
+    if field.startswith('resource_metadata'):
+        q, v = apply_metaquery_filter(nodes, 'metadata_id')
         values.append(v)
         return q
-    values.append(nodes.values()[0])
-    return "%s %s %%s" % (nodes.keys()[0], simple_op)
+    if (pushdown and resolver and simple_op == '=' and
+            isinstance(SAMPLE_FIELDS[field], tuple)):
+        condition, condition_values = resolver.condition(field, value)
+        values.extend(condition_values)
+        return condition
+    values.append(value)
+    if pushdown:
+        return sample_field_condition(field, simple_op)
+    return "%s %s %%s" % (field, simple_op)
 
 
-def _transform_filter(tree, values):
+def _transform_filter(tree, values, pushdown=False, resolver=None):
     operator = tree.keys()[0]
     nodes = tree.values()[0]
     if operator in complex_operators:
-        return _handle_complex_op(operator, nodes, values)
+        return _handle_complex_op(operator, nodes, values, pushdown,
+                                  resolver)
     else:
-        return _handle_simple_op(operator, nodes, values)
+        return _handle_simple_op(operator, nodes, values, pushdown, resolver)
+
 
+def transform_filter(tree, pushdown=False, resolver=None):
+    """Return the WHERE clause of a complex query filter and its values.
 
-def transform_filter(tree):
+    With pushdown sample fields are compared with the samples columns, see
+    SAMPLE_FIELDS, and other fields raise KeyError. Equality on dimensions
+    is then compared as ids of the DimensionResolver, if any.
+    """
     values = []
-    res = _transform_filter(tree, values)
+    res = _transform_filter(tree, values, pushdown, resolver)
     return ' WHERE ' + res, values
 
 
@@ -166,3 +621,18 @@ def transform_orderby(orderby):
     return ' ORDER BY ' + ', '.join(['%s %s' % (x.keys()[0], x.values()[0])
                                      for x in orderby])
 
+
+def make_copy_row(values):
+    """Format values as one line of the COPY text format."""
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append('\\N')
+        elif isinstance(value, float):
+            fields.append(repr(value))
+        else:
+            fields.append(six.text_type(value).replace('\\', '\\\\')
+                          .replace('\t', '\\t')
+                          .replace('\n', '\\n')
+                          .replace('\r', '\\r'))
+    return '\t'.join(fields) + '\n'
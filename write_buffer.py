@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+# Copyright © 2015 Servionica, LLC (I-Teco)
+#
+# Authors: Dmirty Kubatkin <kubatkin@servionica.ru>
+#          Alexander Chadin <joker946@gmail.com>
+#          Alexander Stavitsky <alexandr.stavitsky@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Write-behind buffer of samples
+"""
+
+import collections
+import time
+
+import eventlet
+from eventlet.green import threading
+
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'error')
+
+
+class BufferFull(Exception):
+    """Raised when a sample is put into a full buffer."""
+
+
+class WriteBehindBuffer(object):
+
+    """Bounded buffer of samples written in batches by a green thread.
+
+    A batch is written as soon as `batch_size` samples are queued or the
+    oldest queued sample is `max_age` seconds old. When the buffer holds
+    `max_size` samples, a new one either blocks the caller until there is
+    room, pushes out the oldest queued sample or raises BufferFull,
+    depending on the `overflow` policy.
+    """
+
+    def __init__(self, write_func, max_size, batch_size, max_age,
+                 overflow='block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s' % overflow)
+        self._write_func = write_func
+        self._max_size = max_size
+        self._batch_size = batch_size
+        self._max_age = max_age
+        self._overflow = overflow
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        # NOTE: batches taken off the queue and not written yet.
+        self._in_flight = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.last_flush_time = 0.0
+        self._thread = eventlet.spawn(self._run)
+
+    def put(self, sample):
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('Write buffer is stopped')
+            while len(self._queue) >= self._max_size:
+                if self._overflow == 'error':
+                    raise BufferFull('Write buffer holds %d samples'
+                                     % len(self._queue))
+                elif self._overflow == 'drop-oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._cond.wait()
+            self._queue.append((time.time(), sample))
+            if len(self._queue) in (1, self._batch_size):
+                self._cond.notify_all()
+
+    def _pop_batch(self):
+        batch = [self._queue.popleft()[1]
+                 for _i in range(min(self._batch_size, len(self._queue)))]
+        if batch:
+            self._in_flight += 1
+        self._cond.notify_all()
+        return batch
+
+    def _wait_batch(self):
+        """Wait until a batch is due and take it off the queue."""
+        with self._cond:
+            while not self._queue and not self._stopped:
+                self._cond.wait()
+            while (self._queue and not self._stopped and
+                   len(self._queue) < self._batch_size):
+                remaining = self._queue[0][0] + self._max_age - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._pop_batch()
+
+    def _run(self):
+        while True:
+            batch = self._wait_batch()
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        started = time.time()
+        try:
+            failures = self._write_func(batch)
+        except Exception:
+            LOG.exception(_("Failed to write {0} buffered samples".format(
+                len(batch))))
+            self.failed += len(batch)
+        else:
+            self.failed += len(failures)
+            self.written += len(batch) - len(failures)
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+        self.last_flush_time = time.time() - started
+        self.flush_time += self.last_flush_time
+        self.flushes += 1
+
+    def flush(self):
+        """Write all the queued samples in the calling green thread.
+
+        Returns once the batches the writing green thread has taken off the
+        queue are written too.
+        """
+        while True:
+            with self._cond:
+                batch = self._pop_batch()
+            if not batch:
+                break
+            self._write(batch)
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+
+    def stop(self):
+        """Drain the buffer and stop the writing green thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.wait()
+        self.flush()
+
+    def stats(self):
+        return {'queue_depth': len(self._queue),
+                'max_size': self._max_size,
+                'written': self.written,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'flushes': self.flushes,
+                'last_flush_latency': self.last_flush_time,
+                'avg_flush_latency': (self.flush_time / self.flushes
+                                      if self.flushes else 0.0)}